@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""
+Benchmark of reconciling a database against a local fake InfluxDB, see
+benchmarks.fake_influx. Measures the wall time, round trips and peak
+memory of process_database across scenarios, measurement counts, request
+latencies and error rates, and compares them with earlier results.
+
+    python -m benchmarks.bench_reconcile --measurements 1000,100000 \\
+        --latency 0s,20ms --output results.json --compare previous.json
+"""
+import argparse
+import copy
+import json
+import logging
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from influxdb import InfluxDBClient
+
+from benchmarks.fake_influx import FakeInfluxServer
+from influxdb_aggregation import main as aggregation
+from influxdb_aggregation.conf import config, thaw
+from influxdb_aggregation.durations import SECOND, parse_duration
+from influxdb_aggregation.pool import ClientPool
+
+DATABASE = 'prometheus'
+
+
+def reconcile(db_config):
+    """
+    Runs process_database with a client of its own, as a run would.
+    """
+    with ClientPool(InfluxDBClient, config['connection_pool_size']) as pool:
+        aggregation.process_database(db_config, pool=pool)
+
+
+def create(db_config):
+    """
+    Nothing exists yet, every policy and query is created.
+    """
+    return db_config
+
+
+def unchanged(db_config):
+    """
+    The database is in the desired state, nothing is applied.
+    """
+    reconcile(db_config)
+    return db_config
+
+
+def add_policy(db_config):
+    """
+    A policy is added, with a query for every measurement.
+    """
+    reconcile(db_config)
+    db_config = copy.deepcopy(db_config)
+    db_config['desired_policies'].append(dict(
+        db_config['desired_policies'][-1], rollup='6h', retention='520w'
+    ))
+    return db_config
+
+
+def change_retention(db_config):
+    """
+    The retention of a policy changes, only the policy is altered.
+    """
+    reconcile(db_config)
+    db_config = copy.deepcopy(db_config)
+    policy = db_config['desired_policies'][0]
+    policy['retention'] = '{}s'.format(
+        parse_duration(policy['retention']) // SECOND + 3600
+    )
+    return db_config
+
+
+SCENARIOS = [
+    ('create', create),
+    ('unchanged', unchanged),
+    ('add_policy', add_policy),
+    ('change_retention', change_retention),
+]
+
+
+def measure(prepare, measurements, latency, error_rate, trace):
+    """
+    Prepares a fake server for a scenario, then measures one reconciliation.
+
+    :param prepare: Gets the server into the state of the scenario from a
+                    database configuration, returns the configuration
+                    measured
+    :param measurements: Number of measurements in the database
+    :param latency: Seconds every request is delayed
+    :param error_rate: Fraction of the writing requests failing
+    :param trace: Measures the peak memory instead of the time, tracing
+                  allocations slows everything down
+    :return: Dictionary of the measures
+    """
+    db_config = thaw(config['configs'][0])
+    with FakeInfluxServer(databases=[DATABASE], measurements=measurements,
+                          latency=latency) as server:
+        db_config.update(host='127.0.0.1', port=server.port,
+                         database=DATABASE)
+        db_config = prepare(db_config)
+        server.reset_counters()
+        server.error_rate = error_rate
+
+        error = None
+        if trace:
+            tracemalloc.start()
+        start = time.time()
+        try:
+            reconcile(db_config)
+        except Exception as e:
+            error = str(e)
+        wall = time.time() - start
+        if trace:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            return dict(peak_memory=peak)
+
+        return dict(
+            wall=wall,
+            requests=server.requests,
+            statements=server.statements,
+            injected_errors=server.errors,
+            error=error
+        )
+
+
+def run_scenario(name, prepare, measurements, latency, error_rate,
+                 memory=True):
+    """
+    Measures a scenario, see measure.
+
+    :param name: Name of the scenario
+    :param memory: Also measures the peak memory, in a run of its own
+    :return: Result dictionary
+    """
+    result = dict(
+        scenario=name,
+        measurements=measurements,
+        latency=latency,
+        error_rate=error_rate,
+        peak_memory=None
+    )
+    result.update(
+        measure(prepare, measurements, latency, error_rate, trace=False)
+    )
+    if memory:
+        result.update(
+            measure(prepare, measurements, latency, error_rate, trace=True)
+        )
+    return result
+
+
+def result_key(result):
+    return (result['scenario'], result['measurements'], result['latency'],
+            result['error_rate'])
+
+
+def version():
+    """
+    :return: Commit of the working tree, None outside of a git checkout
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            stderr=subprocess.DEVNULL
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous, threshold):
+    """
+    Prints the change of every result against the previous results.
+
+    :param results: List of result dictionaries
+    :param previous: List of the previous result dictionaries
+    :param threshold: Ratio above which a change is a regression
+    :return: Number of regressions
+    """
+    previous = {result_key(result): result for result in previous}
+    regressions = 0
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        changes = []
+        for metric in ['wall', 'requests', 'peak_memory']:
+            if not result[metric] or not old[metric]:
+                continue
+            ratio = float(result[metric]) / old[metric]
+            flag = ''
+            if ratio > threshold:
+                flag = ' REGRESSION'
+                regressions += 1
+            changes.append('{} {:.2f}x{}'.format(metric, ratio, flag))
+        print('{:<17} {:>7} {:>6.3f}s {:>5.2f}  {}'.format(
+            result['scenario'], result['measurements'], result['latency'],
+            result['error_rate'], ', '.join(changes)
+        ))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--measurements', default='100,1000,10000',
+                        help='Comma separated measurement counts')
+    parser.add_argument('--latency', default='0s,20ms',
+                        help='Comma separated request latencies')
+    parser.add_argument('--error-rate', default='0',
+                        help='Comma separated fractions of the writing '
+                             'requests failing with a timeout')
+    parser.add_argument('--scenarios',
+                        default=','.join(name for name, _ in SCENARIOS))
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Statements per second of the apply rate '
+                             'limiter, unlimited if not given')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='Skip measuring the peak memory, which takes '
+                             'a run of its own')
+    parser.add_argument('--output', help='File the results are saved to')
+    parser.add_argument('--compare',
+                        help='File of earlier results to compare with')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='Ratio to the earlier results above which a '
+                             'change is a regression')
+    args = parser.parse_args(argv)
+
+    # Failures are reported in the results, not by every retry
+    logging.basicConfig(level=logging.CRITICAL)
+    configuration = config.copy()
+    configuration['apply'].update(rate=args.rate, retry_delay='10ms')
+    config.replace(configuration)
+    scenarios = dict(SCENARIOS)
+    results = []
+    print('{:<17} {:>7} {:>7} {:>5} {:>9} {:>9} {:>10} {:>9}'.format(
+        'scenario', 'measure', 'latency', 'errors', 'wall', 'requests',
+        'statements', 'peak'
+    ))
+    for name in args.scenarios.split(','):
+        for measurements in args.measurements.split(','):
+            for latency in args.latency.split(','):
+                for error_rate in args.error_rate.split(','):
+                    result = run_scenario(
+                        name, scenarios[name], int(measurements),
+                        parse_duration(latency) / SECOND, float(error_rate),
+                        args.memory
+                    )
+                    results.append(result)
+                    print('{:<17} {:>7} {:>6.3f}s {:>5.2f} {:>8.2f}s {:>9} '
+                          '{:>10} {:>7.1f}MB{}'.format(
+                              name, result['measurements'],
+                              result['latency'], result['error_rate'],
+                              result['wall'], result['requests'],
+                              result['statements'],
+                              (result['peak_memory'] or 0) / 1e6,
+                              ' failed: {}'.format(result['error'])
+                              if result['error'] else ''
+                          ))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(dict(
+                version=version(),
+                python=platform.python_version(),
+                time=time.time(),
+                results=results
+            ), output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as previous:
+            previous = json.load(previous)
+        print('\nCompared with {}:'.format(previous.get('version')))
+        if compare(results, previous['results'], args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
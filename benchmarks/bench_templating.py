@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of continuous query rendering, comparing the compiled
+templates with formatting and stripping the configured templates on
+every call.
+
+    python -m benchmarks.bench_templating [measurements]
+"""
+import sys
+import timeit
+
+from influxdb_aggregation import templating as tpl
+from influxdb_aggregation.conf import config, thaw
+
+
+def naive_continuous_query_create(policy, measurement, database):
+    """
+    Renders a create query the way it was done before templates were
+    compiled, formatting and stripping the templates on every call.
+    """
+    policy_name = config['policy_name_template'].format(
+        rollup=policy['rollup']
+    )
+    query = tpl.strip_query(
+        config['continuous_query_template'].format(
+            measurement=measurement,
+            policy=policy_name,
+            database=database,
+            source='input',
+            offset='',
+            group_by='*',
+            **policy
+        )
+    )
+    return tpl.strip_query(
+        config['create_continuous_query_template'].format(
+            name=config['query_name_template'].format(
+                policy=policy_name,
+                measurement=measurement
+            ),
+            measurement=measurement,
+            policy=policy_name,
+            database=database,
+            resample='',
+            query=query,
+            **policy
+        )
+    )
+
+
+def bench(render, measurements, repeat):
+    policies = thaw(config['configs'][0]['desired_policies'])
+
+    def run():
+        for policy in policies:
+            for measurement in measurements:
+                render(policy, measurement, 'prometheus')
+
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+    return best / (len(policies) * len(measurements))
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    count = int(argv[0]) if argv else 10000
+    measurements = ['measurement_{}'.format(i) for i in range(count)]
+
+    policy = thaw(config['configs'][0]['desired_policies'][0])
+    assert (naive_continuous_query_create(policy, 'm', 'prometheus') ==
+            tpl.continuous_query_create(policy, 'm', 'prometheus'))
+
+    naive = bench(naive_continuous_query_create, measurements, 3)
+    compiled = bench(tpl.continuous_query_create, measurements, 3)
+
+    print("naive:    {:.2f}us per continuous query".format(naive * 1e6))
+    print("compiled: {:.2f}us per continuous query".format(compiled * 1e6))
+    print("speedup:  {:.1f}x".format(naive / compiled))
+
+
+if __name__ == '__main__':
+    main()
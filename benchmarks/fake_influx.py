@@ -0,0 +1,392 @@
+"""
+A local InfluxDB 1.x HTTP server for benchmarks, keeping real state for
+the meta statements the aggregator sends: SHOW, CREATE, ALTER and DROP
+of retention policies and continuous queries. Measurements are generated,
+and every measurement has the same tag keys and series.
+
+    with FakeInfluxServer(measurements=1000, latency=0.02) as server:
+        client = InfluxDBClient(port=server.port, database='prometheus')
+"""
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+from influxdb_aggregation.durations import (
+    DAY, HOUR, WEEK, format_go_duration, parse_duration
+)
+
+__all__ = ['FakeInfluxServer', 'FakeInfluxState', 'StatementError']
+
+_separator = re.compile(r';\s*')
+_limit = re.compile(r'LIMIT (\d+)(?: OFFSET (\d+))?', re.IGNORECASE)
+_from = re.compile(r'\bFROM (.*?)(?: WHERE | GROUP BY |$)', re.IGNORECASE)
+_policy = re.compile(
+    r'^(CREATE|ALTER) RETENTION POLICY (\S+) ON (\S+)(.*)$',
+    re.IGNORECASE | re.DOTALL
+)
+_query = re.compile(
+    r'^CREATE CONTINUOUS QUERY (\S+) ON (\S+)\s', re.IGNORECASE
+)
+_drop = re.compile(
+    r'^DROP (RETENTION POLICY|CONTINUOUS QUERY) (\S+) ON (\S+)$',
+    re.IGNORECASE
+)
+_clause = re.compile(
+    r'(SHARD DURATION|DURATION|REPLICATION|DEFAULT)\s*(\S*)', re.IGNORECASE
+)
+
+
+class StatementError(Exception):
+    """
+    An error InfluxDB reports for a statement.
+    """
+
+
+def _unquote(identifier):
+    return identifier.strip('"')
+
+
+def default_shard_duration(duration):
+    """
+    The shard group duration InfluxDB picks for a retention duration.
+    """
+    if duration == 0 or duration >= 26 * WEEK:
+        return WEEK
+    if duration >= 2 * DAY:
+        return DAY
+    return HOUR
+
+
+class FakeInfluxState(object):
+    """
+    Databases with their retention policies and continuous queries.
+    """
+
+    def __init__(self, databases=('prometheus',), measurements=0,
+                 tag_keys=('host',), series=1):
+        """
+        :param databases: Names of the databases, each with an input policy
+        :param measurements: Number of measurements in every database
+        :param tag_keys: Tag keys of every measurement
+        :param series: Number of series of every measurement
+        """
+        self.lock = threading.Lock()
+        self.tag_keys = list(tag_keys)
+        self.series = series
+        self.measurements = [
+            'measurement_{:07d}'.format(i) for i in range(measurements)
+        ]
+        self.databases = {
+            name: dict(policies={
+                'input': dict(duration=2 * HOUR, shard=HOUR, replication=1,
+                              default=True)
+            }, queries={})
+            for name in databases
+        }
+
+    def execute(self, statement, database):
+        """
+        Runs one statement.
+
+        :param statement: InfluxQL statement
+        :param database: Database of the request
+        :return: List of series
+        :raises StatementError: As InfluxDB would report it
+        """
+        keyword = ' '.join(statement.split()[:3]).upper()
+        with self.lock:
+            if keyword.startswith('SHOW RETENTION POLICIES'):
+                return self.show_policies(database)
+            if keyword.startswith('SHOW CONTINUOUS QUERIES'):
+                return self.show_queries()
+            if keyword.startswith('SHOW MEASUREMENTS'):
+                return self.show_measurements(statement)
+            if keyword.startswith('SHOW TAG KEYS'):
+                return [
+                    dict(name=name, columns=['tagKey'],
+                         values=[[key] for key in self.tag_keys])
+                    for name in self.sources(statement)
+                ]
+            if keyword.startswith('SHOW SERIES EXACT'):
+                return [
+                    dict(name=name, columns=['count'],
+                         values=[[self.series]])
+                    for name in self.sources(statement)
+                ]
+            if keyword.startswith('SHOW SERIES'):
+                return self.show_series(statement)
+            if keyword.startswith('SELECT'):
+                if re.search(r'\bINTO\b', statement, re.IGNORECASE):
+                    return []
+                return [
+                    dict(name=name, columns=['time', 'count_value'],
+                         values=[[0, self.series]])
+                    for name in self.sources(statement)
+                ]
+            if keyword.endswith('RETENTION POLICY'):
+                if keyword.startswith('DROP'):
+                    return self.drop(statement)
+                return self.write_policy(statement)
+            if keyword.startswith('CREATE CONTINUOUS QUERY'):
+                return self.create_query(statement)
+            if keyword.startswith('DROP CONTINUOUS QUERY'):
+                return self.drop(statement)
+        raise StatementError('error parsing query: {}'.format(statement))
+
+    def database(self, name):
+        if name not in self.databases:
+            raise StatementError('database not found: {}'.format(name))
+        return self.databases[name]
+
+    def sources(self, statement):
+        """
+        Names of the existing measurements in the FROM clause.
+        """
+        match = _from.search(statement)
+        names = [
+            _unquote(source.split('.')[-1])
+            for source in match.group(1).split(',')
+        ] if match else []
+        known = set(self.measurements)
+        return [name.strip() for name in names if name.strip() in known]
+
+    def show_policies(self, database):
+        policies = self.database(database)['policies']
+        return [dict(
+            columns=['name', 'duration', 'shardGroupDuration', 'replicaN',
+                     'default'],
+            values=[
+                [name, format_go_duration(p['duration']),
+                 format_go_duration(p['shard']), p['replication'],
+                 p['default']]
+                for name, p in sorted(policies.items())
+            ]
+        )]
+
+    def show_queries(self):
+        return [
+            dict(name=name, columns=['name', 'query'],
+                 values=sorted(database['queries'].items()))
+            for name, database in sorted(self.databases.items())
+        ]
+
+    def show_measurements(self, statement):
+        measurements = self.measurements
+        match = _limit.search(statement)
+        if match:
+            offset = int(match.group(2) or 0)
+            measurements = measurements[offset:offset + int(match.group(1))]
+        if not measurements:
+            return []
+        return [dict(name='measurements', columns=['name'],
+                     values=[[name] for name in measurements])]
+
+    def show_series(self, statement):
+        values = [
+            [','.join([name] + [
+                '{}={}'.format(key, i) for key in self.tag_keys
+            ])]
+            for name in self.sources(statement)
+            for i in range(self.series)
+        ]
+        return [dict(columns=['key'], values=values)] if values else []
+
+    def write_policy(self, statement):
+        match = _policy.match(statement.strip())
+        if match is None:
+            raise StatementError('error parsing query: {}'.format(statement))
+        verb, name, database, clauses = match.groups()
+        policies = self.database(_unquote(database))['policies']
+        name = _unquote(name)
+        settings = {}
+        for clause, value in _clause.findall(clauses):
+            clause = clause.upper()
+            if clause == 'DURATION':
+                settings['duration'] = parse_duration(value)
+            elif clause == 'SHARD DURATION':
+                settings['shard'] = parse_duration(value)
+            elif clause == 'REPLICATION':
+                settings['replication'] = int(value)
+            else:
+                settings['default'] = True
+
+        if verb.upper() == 'ALTER':
+            if name not in policies:
+                raise StatementError('retention policy not found')
+            policy = policies[name]
+        else:
+            policy = dict(duration=0, shard=0, replication=1, default=False)
+            policy.update(settings)
+            if not policy['shard']:
+                policy['shard'] = default_shard_duration(policy['duration'])
+            if name in policies:
+                if policies[name] != policy:
+                    raise StatementError('retention policy already exists')
+                return []
+            policies[name] = policy
+        policy.update(settings)
+        if settings.get('shard') == 0:
+            policy['shard'] = default_shard_duration(policy['duration'])
+        if settings.get('default'):
+            for other in policies.values():
+                other['default'] = other is policy
+        return []
+
+    def create_query(self, statement):
+        match = _query.match(statement.strip())
+        if match is None:
+            raise StatementError('error parsing query: {}'.format(statement))
+        name, database = (_unquote(group) for group in match.groups())
+        queries = self.database(database)['queries']
+        query = ' '.join(statement.split())
+        if name in queries:
+            if queries[name] != query:
+                raise StatementError('continuous query already exists')
+            return []
+        queries[name] = query
+        return []
+
+    def drop(self, statement):
+        match = _drop.match(' '.join(statement.split()))
+        if match is None:
+            raise StatementError('error parsing query: {}'.format(statement))
+        kind, name, database = match.groups()
+        database = self.database(_unquote(database))
+        entries = database[
+            'policies' if kind.upper() == 'RETENTION POLICY' else 'queries'
+        ]
+        if _unquote(name) not in entries:
+            raise StatementError('{} not found'.format(kind.lower()))
+        del entries[_unquote(name)]
+        return []
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_query(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        params = parse_qs(urlparse(self.path).query)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            params.update(parse_qs(self.rfile.read(length).decode('utf-8')))
+        self.handle_query(params)
+
+    def handle_query(self, params):
+        fake = self.server.fake
+        if not self.path.startswith('/query'):
+            return self.respond(404, {'error': 'not found'})
+        query = params.get('q', [''])[0]
+        database = params.get('db', [None])[0]
+        statements = [s for s in _separator.split(query) if s.strip()]
+        fake.count(statements)
+        if fake.latency:
+            time.sleep(fake.latency)
+        if fake.inject_error(statements):
+            return self.respond(500, {'error': 'timeout'})
+
+        results = []
+        for statement_id, statement in enumerate(statements):
+            try:
+                series = fake.state.execute(statement, database)
+            except StatementError as e:
+                results.append(dict(statement_id=statement_id, error=str(e)))
+                break
+            result = dict(statement_id=statement_id)
+            if series:
+                result['series'] = series
+            results.append(result)
+        self.respond(200, {'results': results})
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeInfluxServer(object):
+    """
+    Serves a FakeInfluxState on a local port from a thread, counting the
+    requests. Every request is delayed by the latency, and requests with
+    writing statements fail with an HTTP 500 at the error rate.
+    """
+
+    def __init__(self, state=None, latency=0, error_rate=0, seed=0,
+                 **kwargs):
+        """
+        :param state: FakeInfluxState, made from kwargs if not given
+        :param latency: Seconds every request is delayed
+        :param error_rate: Fraction of the requests with CREATE, ALTER or
+                           DROP statements failing with a timeout
+        :param seed: Seed of the error injection
+        """
+        self.state = state if state is not None else FakeInfluxState(**kwargs)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.statements = 0
+        self.errors = 0
+        self.server = None
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def count(self, statements):
+        with self.lock:
+            self.requests += 1
+            self.statements += len(statements)
+
+    def inject_error(self, statements):
+        writes = any(
+            s.split(None, 1)[0].upper() in ('CREATE', 'ALTER', 'DROP')
+            for s in statements
+        )
+        with self.lock:
+            if writes and self.random.random() < self.error_rate:
+                self.errors += 1
+                return True
+        return False
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = self.statements = self.errors = 0
+
+    def start(self):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.fake = self
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs=dict(poll_interval=0.05)
+        )
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
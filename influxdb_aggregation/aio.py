@@ -0,0 +1,394 @@
+import asyncio
+import logging
+import time
+
+from influxdb.exceptions import InfluxDBClientError
+from influxdb.resultset import ResultSet
+
+from influxdb_aggregation import main, metrics
+from influxdb_aggregation.apply import (
+    STATEMENT_SEPARATOR, ApplyError, batch_statements, check_results,
+    failed_statement
+)
+from influxdb_aggregation.conf import config
+from influxdb_aggregation.cost import (
+    budget_tag_keys, parse_stats, stats_query
+)
+from influxdb_aggregation.durations import parse_duration
+from influxdb_aggregation.hibernation import (
+    activity_query, hibernation_window, iter_batches
+)
+from influxdb_aggregation.tags import has_tag_lists, tag_keys_query
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+__all__ = ['AsyncInfluxClient', 'reconcile_database', 'process_databases',
+           'run']
+
+# The asyncio engine shares the planning with the synchronous engine in
+# main, and only replaces reading the state and applying the statements
+# with non-blocking requests. It requires aiohttp.
+
+logger = logging.getLogger(__name__)
+
+
+def get_points(result):
+    """
+    Turns a raw query result into points, like ResultSet.get_points.
+
+    :param result: Raw result dictionary of one statement
+    :return: List of point dictionaries
+    """
+    return [
+        dict(zip(series['columns'], values))
+        for series in result.get('series', [])
+        for values in series.get('values', [])
+    ]
+
+
+class AsyncInfluxClient(object):
+    """
+    Non-blocking client for the query endpoint of one database.
+    """
+
+    def __init__(self, session, host, port, database):
+        """
+        :param session: aiohttp.ClientSession, may be shared
+        :param host: Hostname of the influx server
+        :param port: Port of the influx server
+        :param database: Name of the database
+        """
+        self.session = session
+        self.url = 'http://{}:{}/query'.format(host, port)
+        self.database = database
+
+    async def query(self, query):
+        """
+        Runs one or more statements.
+
+        :param query: Statements, separated by ;
+        :return: List of raw result dictionaries, one per statement
+        :raises InfluxDBClientError: When influx rejects the request
+        """
+        params = {'db': self.database}
+        if query.startswith('SHOW '):
+            method, data = 'GET', None
+            params['q'] = query
+        else:
+            # Influx only runs statements changing the database when posted,
+            # with the statements in the form body
+            method, data = 'POST', {'q': query}
+        kind = metrics.statement_type(query)
+        start = time.time()
+        try:
+            async with self.session.request(method, self.url, params=params,
+                                            data=data) as response:
+                data = await response.json(content_type=None)
+                if response.status != 200:
+                    raise InfluxDBClientError(
+                        data.get('error', response.reason), response.status
+                    )
+                return data.get('results', [])
+        except Exception:
+            metrics.inc('request_errors_total', type=kind)
+            raise
+        finally:
+            metrics.observe('request_seconds', time.time() - start,
+                            type=kind)
+
+    async def points(self, query):
+        """
+        Runs a single statement and returns its points.
+
+        :param query: Statement
+        :return: List of point dictionaries
+        """
+        results = await self.query(query)
+        if not results:
+            return []
+        if results[0].get('error') is not None:
+            raise InfluxDBClientError(results[0]['error'])
+        return get_points(results[0])
+
+
+async def iter_measurements(client, page_size, shifts=None):
+    """
+    Reads the measurements of a database page by page, see
+    main.iter_measurements.
+
+    :param client: AsyncInfluxClient
+    :param page_size: Number of measurements read per request, at least 2
+    :param shifts: List the offsets of the pages that shifted are added
+                   to, if given
+    :return: List of measurement names
+    """
+    page_size = max(page_size, 2)
+    measurements = []
+    offset = 0
+    previous = None
+    while True:
+        page = [
+            m['name'] for m in await client.points(
+                'SHOW MEASUREMENTS LIMIT {} OFFSET {}'.format(
+                    page_size, offset
+                )
+            )
+        ]
+        if previous is not None and page[:1] != [previous]:
+            logger.warning(
+                "Measurements changed while reading them at {}".format(
+                    offset
+                )
+            )
+            if shifts is not None:
+                shifts.append(offset)
+        for measurement in page:
+            if not measurements or measurement > measurements[-1]:
+                measurements.append(measurement)
+        if len(page) < page_size:
+            return measurements
+        previous = page[-1]
+        offset += page_size - 1
+
+
+async def active_measurements(client, db_config, measurements, idle):
+    """
+    Filters measurements down to those written to within the hibernation
+    window, see hibernation.active_measurements.
+
+    :param client: AsyncInfluxClient
+    :param db_config: configuration dictionary for this database
+    :param measurements: List of measurement names
+    :param idle: Set the idle measurements are added to
+    :return: List of active measurement names, in the same order
+    """
+    window = hibernation_window(db_config)
+    if not window:
+        return measurements
+
+    settings = config['hibernation']
+    limit = asyncio.Semaphore(max(settings['workers'], 1))
+
+    async def check(batch):
+        async with limit:
+            results = await client.query(
+                activity_query(db_config['database'], batch, window)
+            )
+        for result in results:
+            if result.get('error') is not None:
+                raise InfluxDBClientError(result['error'])
+        return [
+            measurement for measurement, result in zip(batch, results)
+            if result.get('series')
+        ]
+
+    active = set()
+    for names in await asyncio.gather(*[
+            check(batch)
+            for batch in iter_batches(measurements, settings['batch_size'])
+    ]):
+        active.update(names)
+    idle.update(m for m in measurements if m not in active)
+    return [m for m in measurements if m in active]
+
+
+async def collect_stats(client, db_config, measurements):
+    """
+    Reads the stats of measurements for the cost budget, see
+    cost.collect_stats.
+
+    :param client: AsyncInfluxClient
+    :param db_config: configuration dictionary for this database
+    :param measurements: List of measurement names
+    :return: Dictionary of stats by measurement, None without a budget
+    """
+    if not db_config.get('cost_budget'):
+        return None
+
+    settings = config['cost']
+    window = parse_duration(settings['rate_window'])
+    tag_keys = budget_tag_keys(db_config)
+    stats = {}
+    for batch in iter_batches(measurements, settings['batch_size']):
+        results = await client.query(
+            stats_query(db_config['database'], batch, window, tag_keys)
+        )
+        stats.update(parse_stats(
+            [ResultSet(result) for result in results], window, tag_keys
+        ))
+    return stats
+
+
+async def collect_tag_keys(client, db_config, measurements):
+    """
+    Reads the tag keys of measurements, see tags.collect_tag_keys.
+
+    :param client: AsyncInfluxClient
+    :param db_config: configuration dictionary for this database
+    :param measurements: List of measurement names
+    :return: Dictionary of tag keys by measurement
+    """
+    if (db_config.get('continuous_query_mode') == main.WILDCARD or
+            not any(has_tag_lists(policy)
+                    for policy in db_config['desired_policies'])):
+        return {}
+
+    tag_keys = {}
+    for batch in iter_batches(measurements, config['tags']['batch_size']):
+        results = await client.query(
+            tag_keys_query(db_config['database'], batch)
+        )
+        if results and results[0].get('error') is not None:
+            raise InfluxDBClientError(results[0]['error'])
+        for measurement in batch:
+            tag_keys[measurement] = []
+        for series in (results[0].get('series', []) if results else []):
+            tag_keys[series['name']] = [
+                point['tagKey'] for point in get_points({'series': [series]})
+            ]
+    return tag_keys
+
+
+async def reconcile_database(client, db_config):
+    """
+    Gets one database into the desired state.
+
+    :param client: AsyncInfluxClient for the database
+    :param db_config: configuration dictionary for this database
+    :return: Number of requests applying changes
+    :raises ApplyError: With the statement that failed
+    """
+    existing_policies = {
+        p['name']: p
+        for p in await client.points('SHOW RETENTION POLICIES')
+    }
+    existing_index = {
+        q['name']: main.query_digest(q['query'])
+        for q in await client.points('SHOW CONTINUOUS QUERIES')
+    }
+    shifts = []
+    measurements = await iter_measurements(
+        client, config['measurement_page_size'], shifts
+    )
+    idle = set()
+    measurements = await active_measurements(
+        client, db_config, measurements, idle
+    )
+    stats = await collect_stats(client, db_config, measurements)
+    tag_keys = await collect_tag_keys(client, db_config, measurements)
+
+    requests = 0
+    for batch in batch_statements(
+            main.plan_from_state(
+                db_config, existing_policies, existing_index, measurements,
+                idle, stats=stats, tag_keys=tag_keys, shifts=shifts
+            ),
+            config['apply']['batch_statements'],
+            config['apply']['batch_bytes']):
+        for statement in batch:
+            logger.info(statement.description)
+        try:
+            results = await client.query(
+                STATEMENT_SEPARATOR.join(s.query for s in batch)
+            )
+        except InfluxDBClientError as e:
+            raise ApplyError(failed_statement(batch, e), e)
+        check_results(batch, results)
+        requests += 1
+    return requests
+
+
+async def process_databases(db_configs, client_factory, concurrency=100,
+                            per_host=4, timeout=60):
+    """
+    Handles the policy+query management for many databases concurrently.
+    Every database is isolated like in main.process_databases, and progress
+    is logged as databases finish.
+
+    :param db_configs: List of database configuration dictionaries
+    :param client_factory: Creates a client from a database configuration
+    :param concurrency: Number of databases processed at the same time
+    :param per_host: Number of databases processed at the same time on the
+                     same host:port
+    :param timeout: Seconds a database may take
+    :return: List of main.DatabaseResult, in the same order as db_configs
+    """
+    limit = asyncio.Semaphore(max(concurrency, 1))
+    host_limits = {
+        (db_config['host'], db_config['port']):
+            asyncio.Semaphore(max(per_host, 1))
+        for db_config in db_configs
+    }
+    done = [0]
+
+    async def run_one(db_config):
+        # Waiting for the host first, so a database waiting for its host
+        # does not hold a place another host could use
+        async with host_limits[(db_config['host'], db_config['port'])], \
+                limit:
+            start = time.time()
+            error = None
+            try:
+                await asyncio.wait_for(
+                    reconcile_database(client_factory(db_config), db_config),
+                    timeout
+                )
+            except Exception as e:
+                logger.exception("Failed processing {} on {}:{}".format(
+                    db_config['database'], db_config['host'],
+                    db_config['port']
+                ))
+                error = e
+            done[0] += 1
+            logger.info("[{}/{}] {}:{}/{} {}".format(
+                done[0], len(db_configs), db_config['host'],
+                db_config['port'], db_config['database'],
+                "failed" if error else "done"
+            ))
+            return main.DatabaseResult(
+                host=db_config['host'],
+                port=db_config['port'],
+                database=db_config['database'],
+                error=error,
+                duration=time.time() - start
+            )
+
+    return await asyncio.gather(*[
+        run_one(db_config) for db_config in db_configs
+    ])
+
+
+def run(db_configs, concurrency=100, per_host=4, timeout=60,
+        request_timeout=30):
+    """
+    Runs the asyncio engine over databases.
+
+    :param db_configs: List of database configuration dictionaries
+    :param concurrency: Number of databases processed at the same time
+    :param per_host: Number of databases processed at the same time on the
+                     same host:port
+    :param timeout: Seconds a database may take
+    :param request_timeout: Seconds a request may take
+    :return: List of main.DatabaseResult, in the same order as db_configs
+    """
+    if aiohttp is None:
+        raise RuntimeError("The asyncio engine requires aiohttp")
+
+    async def run_all():
+        async with aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=request_timeout),
+                connector=aiohttp.TCPConnector(limit_per_host=per_host)
+        ) as session:
+            return await process_databases(
+                db_configs,
+                lambda db_config: AsyncInfluxClient(
+                    session, db_config['host'], db_config['port'],
+                    db_config['database']
+                ),
+                concurrency=concurrency, per_host=per_host, timeout=timeout
+            )
+
+    return asyncio.run(run_all())
@@ -0,0 +1,533 @@
+import hashlib
+import logging
+import random
+import re
+import threading
+import time
+from collections import namedtuple
+
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from requests.exceptions import RequestException
+
+from influxdb_aggregation import metrics
+from influxdb_aggregation.cache import load_json, save_json
+from influxdb_aggregation.conf import config
+from influxdb_aggregation.durations import SECOND, parse_duration
+
+__all__ = ['Statement', 'ApplyError', 'RateLimiter', 'ApplyJournal',
+           'order_statements', 'batch_statements', 'apply_statements',
+           'apply_with_retry', 'apply_options', 'host_limiter',
+           'is_transient', 'retry_delay', 'failed_statement', 'check_results',
+           'POLICY_CREATE', 'QUERY_DROP', 'QUERY_CREATE', 'QUERY_RETIRE',
+           'POLICY_DROP']
+
+logger = logging.getLogger(__name__)
+
+# Phases statements are applied in, retention policies must exist before
+# queries write into them, and a query must be dropped before it can be
+# re-created under the same name. Queries being replaced under another name
+# are retired after their replacements exist, to avoid gaps.
+POLICY_CREATE = 0
+QUERY_DROP = 1
+QUERY_CREATE = 2
+QUERY_RETIRE = 3
+POLICY_DROP = 4
+
+STATEMENT_SEPARATOR = "; "
+
+Statement = namedtuple('Statement', ['phase', 'query', 'description'])
+
+# Errors of a busy or restarting server, worth trying again
+TRANSIENT_ERRORS = re.compile(
+    r'timeout|timed out|unavailable|too many requests|raft|'
+    r'connection (?:refused|reset)|not the leader|no leader',
+    re.IGNORECASE
+)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class ApplyError(Exception):
+    """
+    Raised when a statement could not be applied.
+    Statements preceding it have been applied, the rest have not.
+    """
+
+    def __init__(self, statement, error):
+        super(ApplyError, self).__init__(
+            "{} failed: {} ({})".format(
+                statement.description, error, statement.query
+            )
+        )
+        self.statement = statement
+        self.error = error
+
+
+class RateLimiter(object):
+    """
+    Limits the rate statements are sent to a server at, adapting it to the
+    latency of the server (AIMD): the rate grows by a step while requests
+    are answered within the target latency, and is cut by a factor when
+    they are slower or fail. Shared by the threads applying to the server.
+    """
+
+    def __init__(self, rate, min_rate, max_rate, target_latency, increase,
+                 decrease):
+        """
+        :param rate: Statements per second to start with
+        :param min_rate: Lowest statements per second
+        :param max_rate: Highest statements per second
+        :param target_latency: Seconds a request may take before the rate
+                               is cut
+        :param increase: Statements per second added after a fast request
+        :param decrease: Factor the rate is multiplied with after a slow or
+                         failed request
+        """
+        self.rate = float(rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.target_latency = target_latency
+        self.increase = increase
+        self.decrease = decrease
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def wait(self, statements):
+        """
+        Waits until statements may be sent, reserving their share of the
+        rate.
+
+        :param statements: Number of statements about to be sent
+        """
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_time)
+            self.next_time = start + statements / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+    def observe(self, latency):
+        """
+        Adapts the rate to the latency of a request.
+
+        :param latency: Seconds the request took
+        """
+        if latency > self.target_latency:
+            self.backoff()
+            return
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def backoff(self):
+        """
+        Cuts the rate, after a slow or failed request.
+        """
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            logger.debug("Applying at {:.1f} statements/s".format(self.rate))
+
+
+class ApplyJournal(object):
+    """
+    Statements of saved plans applied to databases whose plans are not all
+    applied yet, stored in a JSON file. An interrupted or failed run leaves
+    them, so applying the same plan again skips them. The entries of a
+    database are scoped to its plan, see plan_key, and forgotten once all
+    its statements are applied.
+
+    Plans made from the live state are never checked against the journal,
+    they already leave out what is applied, and a statement applied before
+    may be needed again, like the drop of a query re-created with changes.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the journal file
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = load_json(path)
+
+    @staticmethod
+    def digest(statement):
+        """
+        :param statement: Statement
+        :return: Digest of the statement in the journal
+        """
+        return hashlib.sha1(statement.query.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def plan_key(key, statements):
+        """
+        Scopes the entries of a database to a plan, the statements applied
+        for one plan are not skipped when applying another.
+
+        :param key: host:port/database
+        :param statements: List of Statement of the plan, in order
+        :return: Key of the plan in the journal
+        """
+        digest = hashlib.sha1()
+        for statement in statements:
+            digest.update(statement.query.encode('utf-8') + b'\n')
+        return '{}#{}'.format(key, digest.hexdigest())
+
+    def start(self, key):
+        """
+        Forgets the entries of the other plans of a database, about to
+        apply a plan. Their statements were applied to a database that has
+        changed since.
+
+        :param key: Key of the plan, see plan_key
+        """
+        database = key.rpartition('#')[0]
+        with self.lock:
+            stale = [
+                other for other in self.entries
+                if other != key and other.rpartition('#')[0] == database
+            ]
+            for other in stale:
+                del self.entries[other]
+            if stale:
+                save_json(self.path, self.entries)
+
+    def applied(self, key, statement):
+        """
+        :param key: Key of the plan, see plan_key
+        :param statement: Statement
+        :return: True if the statement was applied for the plan
+        """
+        with self.lock:
+            return self.digest(statement) in self.entries.get(key, ())
+
+    def record(self, key, statements):
+        """
+        Records statements of a plan as applied.
+
+        :param key: Key of the plan, see plan_key
+        :param statements: List of Statement
+        """
+        if not statements:
+            return
+        with self.lock:
+            applied = self.entries.setdefault(key, [])
+            applied.extend(self.digest(s) for s in statements)
+            save_json(self.path, self.entries)
+
+    def complete(self, key):
+        """
+        Forgets a plan, all its statements are applied.
+
+        :param key: Key of the plan, see plan_key
+        """
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                save_json(self.path, self.entries)
+
+
+def host_limiter(db_config):
+    """
+    :param db_config: configuration dictionary for a database
+    :return: RateLimiter shared by the databases on the same host:port,
+             None if the apply settings have no rate
+    """
+    settings = config['apply']
+    if not settings.get('rate'):
+        return None
+    key = (db_config['host'], db_config['port'])
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(
+                rate=settings['rate'],
+                min_rate=settings['min_rate'],
+                max_rate=settings['max_rate'],
+                target_latency=(
+                    parse_duration(settings['target_latency']) / SECOND
+                ),
+                increase=settings['increase'],
+                decrease=settings['decrease']
+            )
+        return _limiters[key]
+
+
+def apply_options(db_config, journal=None):
+    """
+    Keyword arguments of apply_statements from the apply settings.
+
+    :param db_config: configuration dictionary for the database
+    :param journal: ApplyJournal, if given
+    :return: Dictionary
+    """
+    settings = config['apply']
+    return dict(
+        max_statements=settings['batch_statements'],
+        max_bytes=settings['batch_bytes'],
+        limiter=host_limiter(db_config),
+        retries=settings['retries'],
+        delay=parse_duration(settings['retry_delay']) / SECOND,
+        max_delay=parse_duration(settings['max_retry_delay']) / SECOND,
+        journal=journal,
+        key='{}:{}/{}'.format(
+            db_config['host'], db_config['port'], db_config['database']
+        )
+    )
+
+
+def is_transient(error):
+    """
+    :param error: Exception or error message of a request or statement
+    :return: True if trying again later could succeed
+    """
+    if isinstance(error, (InfluxDBServerError, RequestException)):
+        return True
+    if getattr(error, 'code', None) in (408, 429, 503):
+        return True
+    return TRANSIENT_ERRORS.search(str(error)) is not None
+
+
+def retry_delay(attempt, delay, max_delay):
+    """
+    Exponential backoff with jitter, so clients failing together do not
+    retry together.
+
+    :param attempt: Number of the retry, from 0
+    :param delay: Seconds before the first retry
+    :param max_delay: Most seconds before a retry
+    :return: Seconds to wait, between half and all of the backoff
+    """
+    backoff = min(max_delay, delay * 2 ** attempt)
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+def order_statements(statements):
+    """
+    Orders statements by phase, keeping the planned order within a phase.
+
+    :param statements: Iterable of Statement
+    :return: List of Statement
+    """
+    return sorted(statements, key=lambda statement: statement.phase)
+
+
+def batch_statements(statements, max_statements, max_bytes):
+    """
+    Packs statements into batches to be sent in one request.
+    A statement larger than max_bytes is sent in a batch of its own.
+
+    :param statements: Iterable of Statement, in the order to apply them
+    :param max_statements: Maximum number of statements in a batch
+    :param max_bytes: Maximum size of the joined statements in a batch
+    :return: Generator of lists of Statement
+    """
+    batch = []
+    size = 0
+    for statement in statements:
+        length = len(statement.query.encode('utf-8'))
+        if batch and (len(batch) >= max_statements or
+                      size + len(STATEMENT_SEPARATOR) + length > max_bytes):
+            yield batch
+            batch = []
+            size = 0
+        if batch:
+            size += len(STATEMENT_SEPARATOR)
+        batch.append(statement)
+        size += length
+    if batch:
+        yield batch
+
+
+def _statement_at(batch, offset):
+    """
+    Finds the statement at a character offset in a joined batch.
+
+    :param batch: List of Statement
+    :param offset: Character offset into the joined batch
+    :return: Statement
+    """
+    position = 0
+    for statement in batch:
+        position += len(statement.query) + len(STATEMENT_SEPARATOR)
+        if offset < position:
+            return statement
+    return batch[-1]
+
+
+def failed_statement(batch, error):
+    """
+    Maps an error for a whole request back to the statement causing it,
+    parse errors report the character offset into the request.
+
+    :param batch: List of Statement
+    :param error: Error message
+    :return: Statement
+    """
+    if len(batch) == 1:
+        return batch[0]
+    match = re.search(r'line \d+, char (\d+)', str(error))
+    if match is None:
+        return batch[0]
+    return _statement_at(batch, int(match.group(1)) - 1)
+
+
+def apply_batch(client, batch):
+    """
+    Sends a batch of statements in one request.
+
+    :param client: Influx client (connection)
+    :param batch: List of Statement
+    :raises ApplyError: With the statement that failed
+    """
+    for statement in batch:
+        logger.info(statement.description)
+
+    try:
+        results = client.query(
+            STATEMENT_SEPARATOR.join(s.query for s in batch),
+            raise_errors=False,
+            # Influx only runs statements changing the database when posted
+            method='POST'
+        )
+    except InfluxDBClientError as e:
+        raise ApplyError(failed_statement(batch, e), e)
+    except (InfluxDBServerError, RequestException) as e:
+        # Nothing tells how far the server got, the batch is tried again
+        # from its start
+        raise ApplyError(batch[0], e)
+
+    if not isinstance(results, list):
+        results = [results]
+
+    try:
+        check_results(batch, [result.raw for result in results])
+    except ApplyError as e:
+        _count_applied(batch[:batch.index(e.statement)])
+        raise
+    _count_applied(batch)
+
+
+def _count_applied(statements):
+    for statement in statements:
+        metrics.inc('statements_applied_total',
+                    help='Statements applied, by type',
+                    type=metrics.statement_type(statement.query))
+
+
+def check_results(batch, results):
+    """
+    Checks the results of a batch for errors.
+
+    :param batch: List of Statement
+    :param results: List of raw result dictionaries, one per statement
+    :raises ApplyError: With the statement that failed
+    """
+    for index, result in enumerate(results):
+        if result.get('error') is not None:
+            statement_id = result.get('statement_id', index)
+            raise ApplyError(batch[statement_id], result['error'])
+
+
+def apply_with_retry(client, batch, limiter=None, retries=0, delay=1,
+                     max_delay=30, journal=None, key=None):
+    """
+    Sends a batch of statements, retrying transient errors from the
+    statement that failed.
+
+    :param client: Influx client (connection)
+    :param batch: List of Statement
+    :param limiter: RateLimiter of the server, if given
+    :param retries: Number of times a transient error is retried
+    :param delay: Seconds before the first retry, doubling every retry
+    :param max_delay: Most seconds before a retry
+    :param journal: ApplyJournal the applied statements are recorded in,
+                    if given
+    :param key: Key of the plan in the journal
+    :return: Number of requests sent
+    :raises ApplyError: With the statement that failed
+    """
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.wait(len(batch))
+        start = time.time()
+        try:
+            with metrics.span('apply'):
+                apply_batch(client, batch)
+        except ApplyError as e:
+            metrics.inc('statement_errors_total',
+                        help='Statements that failed, by type',
+                        type=metrics.statement_type(e.statement.query))
+            applied = batch[:batch.index(e.statement)]
+            if journal is not None:
+                journal.record(key, applied)
+            if limiter is not None:
+                limiter.backoff()
+            if attempt >= retries or not is_transient(e.error):
+                raise
+            wait = retry_delay(attempt, delay, max_delay)
+            logger.warning("{}, retrying in {:.1f}s".format(e, wait))
+            metrics.inc('retries_total',
+                        help='Requests retried after a transient error')
+            time.sleep(wait)
+            batch = batch[len(applied):]
+            attempt += 1
+            continue
+
+        if limiter is not None:
+            limiter.observe(time.time() - start)
+        if journal is not None:
+            journal.record(key, batch)
+        return attempt + 1
+
+
+def apply_statements(client, statements, max_statements=1,
+                     max_bytes=65536, in_order=False, limiter=None,
+                     retries=0, delay=1, max_delay=30, journal=None,
+                     key=None):
+    """
+    Applies statements in dependency order, batching them into as few
+    requests as the limits allow.
+
+    :param client: Influx client (connection)
+    :param statements: Iterable of Statement
+    :param max_statements: Maximum number of statements in one request
+    :param max_bytes: Maximum size of one request
+    :param in_order: The statements are already in the order to apply them,
+                     they are applied as they are generated instead of
+                     being collected and ordered first
+    :param limiter: RateLimiter of the server, if given
+    :param retries: Number of times a transient error is retried
+    :param delay: Seconds before the first retry, doubling every retry
+    :param max_delay: Most seconds before a retry
+    :param journal: ApplyJournal, statements it has for the key are
+                    skipped and the applied ones are recorded, if given.
+                    Only for statements of a saved plan
+    :param key: Key of the plan in the journal, see ApplyJournal.plan_key
+    :return: Number of requests sent
+    :raises ApplyError: With the statement that failed
+    """
+    if not in_order:
+        statements = order_statements(statements)
+    if journal is not None:
+        statements = _skip_applied(statements, journal, key)
+
+    requests = 0
+    for batch in batch_statements(statements, max_statements, max_bytes):
+        requests += apply_with_retry(
+            client, batch, limiter, retries, delay, max_delay, journal, key
+        )
+    if journal is not None:
+        journal.complete(key)
+    return requests
+
+
+def _skip_applied(statements, journal, key):
+    """
+    Passes statements through, leaving out those in the journal.
+    """
+    for statement in statements:
+        if journal.applied(key, statement):
+            logger.info("{}: applied by an earlier run, skipping".format(
+                statement.description
+            ))
+            continue
+        yield statement
@@ -0,0 +1,362 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from influxdb_aggregation import templating as tpl
+from influxdb_aggregation.cache import load_json, save_json
+from influxdb_aggregation.conf import config
+from influxdb_aggregation.durations import SECOND, parse_duration
+from influxdb_aggregation.influxql import group_by_time
+
+__all__ = ['select_query', 'backfill_query', 'source_policy', 'data_age',
+           'BackfillQueue', 'run_backfill']
+
+# New continuous queries only aggregate the data written after they were
+# created. The backfill runs the SELECT ... INTO of such a query over the
+# existing data, one chunk of time at a time from the newest to the oldest.
+# The queue of unfinished backfills is kept in a checkpoint file, so an
+# interrupted backfill resumes where it stopped.
+
+logger = logging.getLogger(__name__)
+
+_body = re.compile(r'\bBEGIN\b(.*)\bEND\s*$', re.DOTALL | re.IGNORECASE)
+_group_by = re.compile(r'\sGROUP\s+BY\s', re.IGNORECASE)
+_where = re.compile(r'\sWHERE\s', re.IGNORECASE)
+
+
+def select_query(create_query):
+    """
+    Extracts the SELECT ... INTO query of a continuous query.
+
+    :param create_query: Continuous query creation query
+    :return: Query between BEGIN and END
+    :raises ValueError: If the query has no BEGIN ... END
+    """
+    match = _body.search(create_query)
+    if match is None:
+        raise ValueError("Not a continuous query: {!r}".format(create_query))
+    return match.group(1).strip()
+
+
+def backfill_query(query, start, end):
+    """
+    Limits a SELECT ... INTO query to a range of time. The condition of a
+    query with a WHERE clause is kept, and the range added to it.
+
+    :param query: SELECT ... INTO query, with a GROUP BY clause
+    :param start: Start of the range in nanoseconds, inclusive
+    :param end: End of the range in nanoseconds, exclusive
+    :return: Bounded query
+    """
+    bounds = 'time >= {} AND time < {}'.format(start, end)
+    positions = [match.start() for match in _group_by.finditer(query)]
+    clauses = query[positions[-1]:].lstrip() if positions else ''
+    query = query[:positions[-1]] if positions else query
+    wheres = list(_where.finditer(query))
+    if wheres:
+        condition = query[wheres[-1].end():].strip()
+        query = '{} WHERE {} AND ({})'.format(
+            query[:wheres[-1].start()], bounds, condition
+        )
+    else:
+        query = '{} WHERE {}'.format(query, bounds)
+    return '{} {}'.format(query, clauses) if clauses else query
+
+
+def source_policy(db_config, info):
+    """
+    Finds the policy a continuous query reads from, the input policy or,
+    when rollups are chained, the next finer rollup.
+
+    :param db_config: configuration dictionary for this database
+    :param info: Query info, with the policy of the query
+    :return: Policy config dictionary
+    """
+    if db_config.get('chained_rollups') and \
+            db_config.get('continuous_query_mode') != 'wildcard':
+        name = tpl.policy_name(info)
+        for policy, source in tpl.chain_policies(
+                db_config['desired_policies']):
+            if source and tpl.policy_name(policy) == name:
+                return source
+    return db_config['default_policy']
+
+
+def data_age(db_config, info, max_age):
+    """
+    Works out how far back a continuous query has data to read and keep,
+    bounded by the retention of the policy it reads from and of its own.
+
+    :param db_config: configuration dictionary for this database
+    :param info: Query info, with the policy of the query
+    :param max_age: Furthest back in nanoseconds, for infinite retentions
+    :return: Age in nanoseconds
+    """
+    retentions = [
+        parse_duration(source_policy(db_config, info)['retention']),
+        parse_duration(info['retention']),
+        max_age
+    ]
+    return min([age for age in retentions if age] or [0])
+
+
+class BackfillQueue(object):
+    """
+    Backfills waiting to run or interrupted, stored in the checkpoint file.
+    Every entry is the next chunk of time to fill of one query, and moves
+    back in time until the start is reached.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the checkpoint file, None keeps the queue in
+                     memory only
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = load_json(path) if path else {}
+
+    def save(self):
+        """
+        Writes the checkpoint file, when there is one.
+        """
+        if self.path:
+            save_json(self.path, self.entries)
+
+    @staticmethod
+    def key(db_config, query_name):
+        """
+        :param db_config: configuration dictionary for a database
+        :param query_name: Name of the continuous query
+        :return: Key of the backfill
+        """
+        return '{}:{}/{}/{}'.format(
+            db_config['host'], db_config['port'], db_config['database'],
+            query_name
+        )
+
+    def add(self, db_config, created, now=None):
+        """
+        Queues the backfill of newly created continuous queries.
+
+        :param db_config: configuration dictionary for this database
+        :param created: List of (query name, query info) tuples, the info
+                        having the query, policy and measurement or
+                        pattern
+        :param now: Time the queries were created, in nanoseconds
+        """
+        if not created:
+            return
+        now = int(time.time() * SECOND) if now is None else now
+        max_age = parse_duration(config['backfill']['max_age'])
+        chunk = parse_duration(config['backfill']['chunk'])
+
+        entries = {}
+        for name, info in created:
+            query = select_query(info['query'])
+            grouping = group_by_time(query)
+            if grouping is None:
+                logger.warning("Not backfilling {}, it has no GROUP BY "
+                               "time()".format(name))
+                continue
+            interval, offset = grouping
+            # Chunks and the range hold whole intervals, a partly filled
+            # interval would overwrite the complete one
+            end = (now - offset) // interval * interval + offset
+            entries[self.key(db_config, name)] = self.entry(
+                db_config, info, query, interval, chunk,
+                end - data_age(db_config, info, max_age) // interval *
+                interval, end
+            )
+
+        with self.lock:
+            self.entries.update(entries)
+            self.save()
+
+    def add_windows(self, db_config, windows):
+        """
+        Queues the backfill of windows of time of existing continuous
+        queries, like the windows the verifier found missing or wrong.
+
+        :param db_config: configuration dictionary for this database
+        :param windows: List of (query name, query info, start, end) tuples,
+                        the windows holding whole intervals
+        """
+        chunk = parse_duration(config['backfill']['chunk'])
+        entries = {}
+        for name, info, start, end in windows:
+            query = select_query(info['query'])
+            grouping = group_by_time(query)
+            if grouping is None:
+                logger.warning("Not backfilling {}, it has no GROUP BY "
+                               "time()".format(name))
+                continue
+            key = '{}@{}'.format(self.key(db_config, name), start)
+            entries[key] = self.entry(db_config, info, query, grouping[0],
+                                      chunk, start, end)
+
+        with self.lock:
+            self.entries.update(entries)
+            self.save()
+
+    @staticmethod
+    def entry(db_config, info, query, interval, chunk, start, end):
+        """
+        :param db_config: configuration dictionary for this database
+        :param info: Query info, with the measurement or pattern
+        :param query: SELECT ... INTO query
+        :param interval: GROUP BY time() interval in nanoseconds
+        :param chunk: Time filled by one query in nanoseconds
+        :param start: Start of the range to fill in nanoseconds
+        :param end: End of the range to fill in nanoseconds
+        :return: Queue entry
+        """
+        return dict(
+            host=db_config['host'],
+            port=db_config['port'],
+            database=db_config['database'],
+            # Queries of a group run in order, finer rollups first, so
+            # chained rollups read from filled policies
+            group=info.get('measurement', info.get('pattern')),
+            rollup=interval,
+            query=query,
+            step=max(chunk // interval, 1) * interval,
+            start=start,
+            end=end
+        )
+
+    def advance(self, key, end):
+        """
+        Records that a backfill was filled back to end, and forgets it when
+        it is complete.
+
+        :param key: Key of the entry
+        :param end: New end of the range left to fill
+        """
+        with self.lock:
+            entry = self.entries[key]
+            if end <= entry['start']:
+                del self.entries[key]
+            else:
+                entry['end'] = end
+            self.save()
+
+    def groups(self):
+        """
+        :return: Lists of (key, entry) tuples running in order, by group
+        """
+        groups = OrderedDict()
+        with self.lock:
+            for key, entry in sorted(self.entries.items()):
+                groups.setdefault(
+                    (entry['host'], entry['port'], entry['database'],
+                     entry['group']),
+                    []
+                ).append((key, dict(entry)))
+        return [
+            sorted(group, key=lambda item: item[1]['rollup'])
+            for group in groups.values()
+        ]
+
+
+def run_backfill(queue, pool, workers=4, workers_per_host=1, pause=1,
+                 stop=None):
+    """
+    Runs the queued backfills. Groups run in parallel, one chunk per query
+    at a time, and every worker pauses between chunks so the live
+    continuous queries are not starved.
+
+    :param queue: BackfillQueue
+    :param pool: ClientPool the clients are taken from
+    :param workers: Number of chunks running at the same time
+    :param workers_per_host: Number of chunks running at the same time on
+                             one host:port
+    :param pause: Seconds to wait after every chunk
+    :param stop: threading.Event interrupting the backfill, progress is kept
+    :return: Number of backfills that failed
+    """
+    stop = threading.Event() if stop is None else stop
+
+    def chunks(group):
+        # Runs one chunk at every step, yielding 1 when it failed
+        for key, entry in group:
+            client = pool.client(entry)
+            end = entry['end']
+            while end > entry['start']:
+                start = max(end - entry['step'], entry['start'])
+                try:
+                    client.query(
+                        backfill_query(entry['query'], start, end),
+                        method='POST'
+                    )
+                except Exception:
+                    logger.exception("Backfilling {} failed".format(key))
+                    yield 1
+                    return
+                queue.advance(key, start)
+                end = start
+                yield 0
+            logger.info("Backfilled {}".format(key))
+
+    # Groups wait in a queue per host like the databases of
+    # main.run_isolated, and go back to the end of it after every chunk, so
+    # a worker never waits for a host while groups of other hosts could run
+    pending = OrderedDict()
+    groups = queue.groups()
+    for group in groups:
+        key, entry = group[0]
+        pending.setdefault((entry['host'], entry['port']), deque()).append(
+            chunks(group)
+        )
+    running = dict.fromkeys(pending, 0)
+    changed = threading.Condition()
+    # Groups taken from their queue and not done yet
+    taken = [0]
+
+    def take():
+        with changed:
+            while pending or taken[0]:
+                for host, steps in pending.items():
+                    if running[host] < max(workers_per_host, 1):
+                        running[host] += 1
+                        taken[0] += 1
+                        group = steps.popleft()
+                        if not steps:
+                            del pending[host]
+                        return host, group
+                changed.wait()
+            return None
+
+    def work():
+        failed = 0
+        while True:
+            task = take()
+            if task is None:
+                return failed
+            host, group = task
+            step = None
+            try:
+                if not stop.is_set():
+                    step = next(group, None)
+            finally:
+                with changed:
+                    running[host] -= 1
+                    if step is None or step:
+                        taken[0] -= 1
+                    changed.notify_all()
+            if step:
+                failed += 1
+            elif step is not None:
+                stop.wait(pause)
+                with changed:
+                    pending.setdefault(host, deque()).append(group)
+                    taken[0] -= 1
+                    changed.notify_all()
+
+    workers = min(max(workers, 1), max(len(groups), 1))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(future.result() for future in
+                   [executor.submit(work) for _ in range(workers)])
@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+__all__ = ['StateCache', 'load_json', 'save_json']
+
+logger = logging.getLogger(__name__)
+
+
+def load_json(path):
+    """
+    Reads a JSON state file, a missing or broken file is an empty state.
+
+    :param path: Path of the file
+    :return: Dictionary
+    """
+    try:
+        with open(path) as state_file:
+            data = json.load(state_file)
+    except (IOError, OSError, ValueError) as e:
+        if os.path.exists(path):
+            logger.warning("Ignoring state file {}: {}".format(path, e))
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def save_json(path, data):
+    """
+    Writes a JSON state file, replacing it atomically.
+
+    :param path: Path of the file
+    :param data: Dictionary
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'w') as state_file:
+            json.dump(data, state_file, sort_keys=True)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+class StateCache(object):
+    """
+    Fingerprints of databases found in the desired state, stored in a JSON
+    file. A database with an unchanged fingerprint does not have to be
+    planned again until the entry expires.
+    """
+
+    def __init__(self, path, ttl):
+        """
+        :param path: Path of the cache file
+        :param ttl: Seconds an entry stays valid
+        """
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self):
+        """
+        Reads the cache file, a missing or broken file is an empty cache.
+
+        :return: Dictionary of entries by key
+        """
+        return load_json(self.path)
+
+    def save(self):
+        """
+        Writes the cache file, replacing it atomically.
+        """
+        save_json(self.path, self.entries)
+
+    @staticmethod
+    def key(db_config):
+        """
+        :param db_config: configuration dictionary for a database
+        :return: Cache key of the database
+        """
+        return '{}:{}/{}'.format(
+            db_config['host'], db_config['port'], db_config['database']
+        )
+
+    def is_fresh(self, key, fingerprint):
+        """
+        :param key: Cache key of the database
+        :param fingerprint: Current fingerprint of the database
+        :return: True if the database was in the desired state with this
+                 fingerprint less than ttl seconds ago
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+        return (
+            entry is not None and
+            entry['fingerprint'] == fingerprint and
+            time.time() - entry['time'] < self.ttl
+        )
+
+    def update(self, key, fingerprint):
+        """
+        Records that the database is in the desired state.
+
+        :param key: Cache key of the database
+        :param fingerprint: Current fingerprint of the database
+        """
+        with self.lock:
+            self.entries[key] = dict(fingerprint=fingerprint, time=time.time())
+            self.save()
+
+    def invalidate(self, key=None):
+        """
+        Forgets a database, or all of them.
+
+        :param key: Cache key of the database, None for all
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+            self.save()
@@ -1,6 +1,34 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections.abc import Mapping
+from contextlib import contextmanager
+from string import Formatter
+from types import MappingProxyType
+
 import yaml
 
-__main__ = ['config']
+from influxdb_aggregation.cache import load_json, save_json
+from influxdb_aggregation.durations import parse_duration
+
+__all__ = ['config', 'ConfigError', 'LazyConfig', 'SCHEMA', 'CONFIG_ENV',
+           'CACHE_ENV', 'default_cache_path', 'read_sources',
+           'validate', 'compile_config', 'load_config', 'load', 'freeze',
+           'thaw']
+
+logger = logging.getLogger(__name__)
+
+# Configuration files loaded when the configuration is first used, separated
+# like PATH, and the file the compiled configuration is cached in, empty to
+# disable the cache. --config and --config-cache take precedence.
+CONFIG_ENV = 'INFLUX_AGGREGATION_CONFIG'
+CACHE_ENV = 'INFLUX_AGGREGATION_CONFIG_CACHE'
+
+# Bumped when compile_config changes, invalidating the cached configurations
+COMPILED_VERSION = 1
 
 default_policy = """
 default_policy:
@@ -26,6 +54,44 @@ desired_policies:
     retention: 0s
     shard_duration: 2w
 
+# Layout of the continuous queries:
+# "measurement" creates one query per measurement and policy,
+# "wildcard" creates one query per policy and partition, writing to
+# :MEASUREMENT in the policy.
+continuous_query_mode: measurement
+# Regular expressions splitting the measurements between wildcard queries,
+# every measurement should match exactly one of them.
+wildcard_partitions:
+  - ".*"
+# Build every rollup from the next finer rollup instead of the input policy.
+# Every rollup must be a multiple of the next finer one.
+# Only applies to the "measurement" continuous_query_mode.
+chained_rollups: false
+# Spread the continuous queries of a policy over its rollup interval instead
+# of running them all on the interval boundary, by offsetting GROUP BY time()
+# with a hash of the measurement name.
+stagger: false
+# Limits the spread of staggered queries, defaults to the rollup interval.
+stagger_window: null
+# What happens to continuous queries made by this tool that are not desired
+# any more, for dropped measurements, removed policies or partitions:
+# "keep" leaves them, "report" logs them, "drop" drops them.
+orphaned_queries: keep
+# Most orphaned queries dropped in one run, the rest are left for later runs.
+max_orphan_drops: 100
+# Drop the continuous queries of measurements without points in the input
+# policy for this long, they are re-created when writes resume.
+# null keeps the queries of all measurements.
+# Only applies to the "measurement" continuous_query_mode.
+hibernate_after: null
+# Limits the cost of one run of a continuous query, estimated from the series
+# cardinality and the point rate of the measurement, null for no limit:
+#   max_points: points read by one run
+#   max_series: series written by one run
+#   action: "flag" logs the queries over the budget, "refuse" does not
+#           create them
+cost_budget: null
+
 continuous_query_template: |
   SELECT
     mean(value) AS value,
@@ -33,10 +99,44 @@ continuous_query_template: |
     min(value) AS min_value
   INTO {database}.{policy}.{measurement}
   FROM {database}.input.{measurement}
-  GROUP BY *, time({rollup})
+  GROUP BY {group_by}, time({rollup}{offset})
+
+wildcard_continuous_query_template: |
+  SELECT
+    mean(value) AS value,
+    max(value) AS max_value,
+    min(value) AS min_value
+  INTO {database}.{policy}.:MEASUREMENT
+  FROM {database}.input./{pattern}/
+  GROUP BY {group_by}, time({rollup}{offset})
+
+# Used instead of continuous_query_template when rollups are chained,
+# for the finest policy reading from input, and the policies reading from
+# the next finer policy. The mean is composed from sums and counts.
+chained_input_continuous_query_template: |
+  SELECT
+    mean(value) AS value,
+    max(value) AS max_value,
+    min(value) AS min_value,
+    sum(value) AS sum_value,
+    count(value) AS count_value
+  INTO {database}.{policy}.{measurement}
+  FROM {database}.input.{measurement}
+  GROUP BY {group_by}, time({rollup}{offset})
+
+chained_continuous_query_template: |
+  SELECT
+    sum(sum_value) / sum(count_value) AS value,
+    max(max_value) AS max_value,
+    min(min_value) AS min_value,
+    sum(sum_value) AS sum_value,
+    sum(count_value) AS count_value
+  INTO {database}.{policy}.{measurement}
+  FROM {database}.{source}.{measurement}
+  GROUP BY {group_by}, time({rollup}{offset})
 
 create_continuous_query_template: |
-  CREATE CONTINUOUS QUERY {measurement}_{policy} ON {database}
+  CREATE CONTINUOUS QUERY {name} ON {database} {resample}
   BEGIN
     {query}
   END
@@ -48,13 +148,159 @@ policy_template: |
   SHARD DURATION {shard_duration}
 
 policy_update_template: |
-  ALTER RETENTION POLICY  {policy} ON {database}
-  DURATION {retention}
-  REPLICATION {replication}
-  SHARD DURATION {shard_duration}
+  ALTER RETENTION POLICY {policy} ON {database}
+  {changes}
 
 policy_name_template: "rollup_{rollup}"
 query_name_template: "{measurement}_{policy}"
+wildcard_query_name_template: "{policy}_wildcard_{partition}"
+
+concurrency:
+  # Number of databases processed at the same time
+  workers: 8
+  # Number of databases processed at the same time on one host:port
+  workers_per_host: 2
+
+# Connections kept open per host:port, shared by the databases on it
+connection_pool_size: 10
+
+# Number of measurements read per SHOW MEASUREMENTS request, and of series
+# per SHOW SERIES request
+measurement_page_size: 10000
+
+state_cache:
+  # File databases found in the desired state are remembered in, they are
+  # skipped while unchanged. Disabled when not set.
+  path: null
+  # How long an unchanged database is skipped
+  ttl: 1d
+
+daemon:
+  # Time between polls for new measurements
+  poll_interval: 1m
+  # Longest time between polls when backing off a slow or failing server
+  max_poll_interval: 30m
+  # A poll taking longer than this backs off
+  slow_poll: 10s
+  # Time between full reconciliations, picking up changed configuration
+  full_interval: 1h
+
+async_engine:
+  # Settings for --async, the asyncio engine for fleets of many servers
+  # Number of databases processed at the same time
+  concurrency: 100
+  # Number of databases processed at the same time on one host:port
+  per_host: 4
+  # Time one database may take
+  timeout: 10m
+  # Time one request may take
+  request_timeout: 30s
+
+cost:
+  # How measurements are measured for cost_budget
+  # Time the point rate is measured over
+  rate_window: 10m
+  # Number of measurements measured by one request
+  batch_size: 100
+  # Number of the most costly queries of a database logged
+  report: 10
+
+tags:
+  # Number of measurements whose tag keys are read by one request, for
+  # policies with keep_tags or drop_tags
+  batch_size: 100
+
+hibernation:
+  # Number of measurements checked for recent points by one query
+  batch_size: 100
+  # Number of those queries running at the same time, per database
+  workers: 4
+
+backfill:
+  # Settings for --backfill, filling new continuous queries with the
+  # existing data of the input policy
+  # File keeping the unfinished backfills, so they resume when interrupted
+  checkpoint: influx_backfill.json
+  # Time filled by one query, rounded to whole rollup intervals
+  chunk: 1d
+  # Oldest data filled, also limited by the retention of the policy read
+  # from, the input policy or the rollup a chained rollup reads, and of the
+  # policy written to
+  max_age: 30d
+  # Number of queries running at the same time
+  workers: 4
+  # Number of queries running at the same time on one host:port
+  workers_per_host: 1
+  # Time every worker waits between queries, leaving room for the live
+  # continuous queries
+  pause: 1s
+
+apply:
+  # Maximum number of statements sent to influx in one request
+  batch_statements: 100
+  # Maximum size in bytes of the statements sent in one request
+  batch_bytes: 65536
+  # Statements per second sent to one host:port to start with, the rate
+  # adapts to the latency of the server. null sends them without a limit
+  rate: 50
+  min_rate: 1
+  max_rate: 1000
+  # Latency of a request above which the rate is cut
+  target_latency: 500ms
+  # Statements per second added to the rate after a fast request
+  increase: 5
+  # Factor the rate is multiplied with after a slow or failed request
+  decrease: 0.5
+  # Number of times a request failing with a transient error is retried,
+  # waiting retry_delay, doubling up to max_retry_delay, with jitter
+  retries: 5
+  retry_delay: 1s
+  max_retry_delay: 1m
+  # File recording the statements of a plan applied with --apply-plan until
+  # all of them are, so applying it again after a failure skips them. null
+  # for no journal
+  journal: null
+
+metrics:
+  # File the metrics of a run are written to, in the Prometheus text format
+  # for the node_exporter textfile collector. null for none
+  textfile: null
+  # Port /metrics is served on with --daemon, null for none
+  port: null
+  # Address /metrics is served on, all addresses if empty
+  address: ''
+
+rollup:
+  # Settings for --rollup, building the rollups of a line protocol file
+  # Number of points aggregated at a time
+  chunk_size: 1000000
+  # Number of files the partial aggregates are spilled to, by series, each
+  # is combined on its own. More partitions use less memory
+  partitions: 16
+  # Directory of the spilled files, the system temporary directory if null
+  temporary_directory: null
+
+verify:
+  # Settings for --verify, checking that the continuous queries write what
+  # they should over sampled windows of time
+  # Number of windows checked per continuous query
+  samples: 10
+  # Number of GROUP BY time() intervals in a window
+  intervals: 4
+  # Number of the latest intervals not checked, they may not be written yet
+  recent_intervals: 2
+  # Oldest data checked, also limited by the retention of the policies read
+  # from and written to
+  max_age: 7d
+  # Number of continuous queries checked per database, picked at random,
+  # null checks them all
+  queries: null
+  # Relative and absolute difference allowed between values
+  tolerance: 1.0e-9
+  # Number of requests running at the same time
+  workers: 8
+  # Number of requests running at the same time on one host:port
+  workers_per_host: 2
 
 configs:
   - database: prometheus
@@ -67,27 +313,212 @@ configs:
     # desired_policies:
 """
 
+# Digest of the built-in defaults, part of the key of the cached configuration
+DEFAULTS_DIGEST = hashlib.sha256('{}\n{}'.format(
+    COMPILED_VERSION, default_policy
+).encode('utf-8')).hexdigest()
+
+# Keys of the global configuration, and of the database configuration which
+# can be set globally or per database
+GLOBAL_KEYS = ['continuous_query_template', 'policy_update_template',
+               'create_continuous_query_template', 'policy_template',
+               'policy_name_template', 'query_name_template',
+               'wildcard_continuous_query_template',
+               'wildcard_query_name_template',
+               'chained_input_continuous_query_template',
+               'chained_continuous_query_template', 'concurrency',
+               'connection_pool_size', 'measurement_page_size',
+               'state_cache', 'daemon', 'async_engine', 'hibernation',
+               'cost', 'tags', 'backfill', 'apply', 'metrics', 'rollup',
+               'verify']
+DATABASE_KEYS = ['database', 'host', 'port', 'desired_policies',
+                 'continuous_query_mode', 'wildcard_partitions',
+                 'chained_rollups', 'stagger', 'stagger_window',
+                 'orphaned_queries', 'max_orphan_drops', 'hibernate_after',
+                 'cost_budget']
+
+
+class ConfigError(ValueError):
+    """
+    A configuration file that cannot be read or does not match the schema.
+    """
+
+
+class Nullable(object):
+    """
+    Schema of a value that may also be null.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+
+
+# Markers of values checked beyond their type
+DURATION = 'duration'
+TEMPLATE = 'template'
+NUMBER = (int, float)
+# Key of a mapping schema allowing keys it does not list, with their schema
+ANY_KEY = '*'
+
+POLICY = {
+    'rollup': DURATION,
+    'retention': DURATION,
+    'replication': int,
+    'shard_duration': DURATION,
+    'keep_tags': [str],
+    'drop_tags': [str],
+    # Custom templates may use other fields of the policies
+    ANY_KEY: object,
+}
+
+DATABASE = {
+    'database': str,
+    'host': str,
+    'port': int,
+    'default_policy': POLICY,
+    'desired_policies': [POLICY],
+    'continuous_query_mode': frozenset(['measurement', 'wildcard']),
+    'wildcard_partitions': [str],
+    'chained_rollups': bool,
+    'stagger': bool,
+    'stagger_window': Nullable(DURATION),
+    'orphaned_queries': frozenset(['keep', 'report', 'drop']),
+    'max_orphan_drops': int,
+    'hibernate_after': Nullable(DURATION),
+    'cost_budget': Nullable({
+        'max_points': Nullable(int),
+        'max_series': Nullable(int),
+        'action': frozenset(['flag', 'refuse']),
+    }),
+}
+
+SCHEMA = dict(DATABASE, **{
+    'include': Nullable((str, list)),
+    'configs': [DATABASE],
+    'continuous_query_template': TEMPLATE,
+    'wildcard_continuous_query_template': TEMPLATE,
+    'chained_input_continuous_query_template': TEMPLATE,
+    'chained_continuous_query_template': TEMPLATE,
+    'create_continuous_query_template': TEMPLATE,
+    'policy_template': TEMPLATE,
+    'policy_update_template': TEMPLATE,
+    'policy_name_template': TEMPLATE,
+    'query_name_template': TEMPLATE,
+    'wildcard_query_name_template': TEMPLATE,
+    'concurrency': {'workers': int, 'workers_per_host': int},
+    'connection_pool_size': int,
+    'measurement_page_size': int,
+    'state_cache': {'path': Nullable(str), 'ttl': DURATION},
+    'daemon': {'poll_interval': DURATION, 'max_poll_interval': DURATION,
+               'slow_poll': DURATION, 'full_interval': DURATION},
+    'async_engine': {'concurrency': int, 'per_host': int,
+                     'timeout': DURATION, 'request_timeout': DURATION},
+    'cost': {'rate_window': DURATION, 'batch_size': int, 'report': int},
+    'tags': {'batch_size': int},
+    'hibernation': {'batch_size': int, 'workers': int},
+    'backfill': {'checkpoint': str, 'chunk': DURATION, 'max_age': DURATION,
+                 'workers': int, 'workers_per_host': int,
+                 'pause': DURATION},
+    'apply': {'batch_statements': int, 'batch_bytes': int,
+              'rate': Nullable(NUMBER), 'min_rate': NUMBER,
+              'max_rate': NUMBER, 'target_latency': DURATION,
+              'increase': NUMBER, 'decrease': NUMBER, 'retries': int,
+              'retry_delay': DURATION, 'max_retry_delay': DURATION,
+              'journal': Nullable(str)},
+    'metrics': {'textfile': Nullable(str), 'port': Nullable(int),
+                'address': str},
+    'rollup': {'chunk_size': int, 'partitions': int,
+               'temporary_directory': Nullable(str)},
+    'verify': {'samples': int, 'intervals': int, 'recent_intervals': int,
+               'max_age': DURATION, 'queries': Nullable(int),
+               'tolerance': NUMBER, 'workers': int, 'workers_per_host': int},
+})
+
+
+def validate(value, schema, path):
+    """
+    Checks configuration values against a schema. Keys missing from a
+    mapping are not errors, they are filled from the defaults.
+
+    :param value: Configuration value
+    :param schema: Type or tuple of types, frozenset of the allowed values,
+                   dictionary of the schemas of the keys of a mapping,
+                   list of the schema of the items of a list, Nullable,
+                   DURATION or TEMPLATE
+    :param path: Where the value is, for the error message
+    :raises ConfigError: If the value does not match the schema
+    """
+    if isinstance(schema, Nullable):
+        if value is None:
+            return
+        schema = schema.schema
+
+    if schema == DURATION:
+        try:
+            parse_duration(value)
+        except ValueError:
+            raise ConfigError('{}: invalid duration {!r}'.format(path, value))
+    elif schema == TEMPLATE:
+        if not isinstance(value, str):
+            raise ConfigError('{}: expected a string'.format(path))
+        try:
+            list(Formatter().parse(value))
+        except ValueError as e:
+            raise ConfigError('{}: invalid template: {}'.format(path, e))
+    elif isinstance(schema, frozenset):
+        if value not in schema:
+            raise ConfigError('{}: expected one of {}, not {!r}'.format(
+                path, ', '.join(sorted(schema)), value
+            ))
+    elif isinstance(schema, dict):
+        if not isinstance(value, dict):
+            raise ConfigError('{}: expected a mapping'.format(path))
+        for key, item in value.items():
+            if key in schema:
+                validate(item, schema[key], '{}.{}'.format(path, key))
+            elif ANY_KEY not in schema:
+                raise ConfigError('{}: unknown key {!r}'.format(path, key))
+    elif isinstance(schema, list):
+        if not isinstance(value, list):
+            raise ConfigError('{}: expected a list'.format(path))
+        for index, item in enumerate(value):
+            validate(item, schema[0], '{}[{}]'.format(path, index))
+    elif schema is not object and (
+            not isinstance(value, schema) or
+            isinstance(value, bool) and schema is not bool):
+        types = schema if isinstance(schema, tuple) else (schema,)
+        raise ConfigError('{}: expected {}, not {!r}'.format(
+            path, ' or '.join(t.__name__ for t in types), value
+        ))
+
+
+def _merge(current, value):
+    """
+    Merges a mapping one level deep into the value it overrides, so a file
+    only has to set the keys of a section it changes.
+    """
+    if isinstance(current, dict) and isinstance(value, dict):
+        return dict(current, **value)
+    return value
+
 
 def update_config(configuration, server_base, config_data):
     """
     Updates the configuration with new values.
-    It only does a update, so there is no recursive support, but it should
-    be enough for most use cases.
+    Sections are merged one level deep, other values and lists are replaced.
 
     :param configuration: Destination configuration dictionary
     :param server_base: Server intermediate configuration dictionary
     :param config_data: Source data
     """
-    for key in ['continuous_query_template', 'policy_update_template',
-                'create_continuous_query_template', 'policy_template',
-                'policy_name_template', 'query_name_template']:
+    for key in GLOBAL_KEYS:
         if key in config_data:
-            configuration[key] = config_data[key]
+            configuration[key] = _merge(configuration.get(key),
+                                        config_data[key])
 
-    for key in ['default_policy', 'database', 'host', 'port',
-                'desired_policies', 'configs']:
+    for key in ['default_policy', 'configs'] + DATABASE_KEYS:
         if key in config_data:
-            server_base[key] = config_data[key]
+            server_base[key] = _merge(server_base.get(key), config_data[key])
 
 
 def make_db_configs(configuration, server_base):
@@ -95,45 +526,333 @@ def make_db_configs(configuration, server_base):
     Processes a server intermediate configuration dictionary into final
     configuration dictionary.
     This populates defaults so any subsequent usage of the config do not have
-    to worry about them.
+    to worry about them. Every database gets values of its own, changing
+    one does not change the others.
 
     :param configuration: Destination configuration dictionary
     :param server_base: Server intermediate configuration dictionary
     """
-    standard_config = {
-        'default_policy': server_base['default_policy'],
-        'database': server_base['database'],
-        'host': server_base['host'],
-        'port': server_base['port'],
-        'desired_policies': server_base['desired_policies']
-    }
+    standard_config = {key: server_base[key] for key in DATABASE_KEYS}
+    standard_config['default_policy'] = server_base['default_policy']
 
     databases = []
     configuration['configs'] = databases
 
-    for conf in server_base['configs']:
-        db_config = dict(standard_config)
+    for index, conf in enumerate(server_base['configs']):
+        db_config = copy.deepcopy(standard_config)
         databases.append(db_config)
-        for var in ['database', 'host', 'port', 'desired_policies']:
+        for var in DATABASE_KEYS:
             if var in conf:
-                db_config[var] = conf[var]
+                db_config[var] = copy.deepcopy(conf[var])
         if 'default_policy' in conf:
             db_config['default_policy'].update(conf['default_policy'])
 
         defaulted_policies = []
-        for policy in db_config['desired_policies']:
+        for number, policy in enumerate(db_config['desired_policies']):
             new_policy = dict(db_config['default_policy'])
             new_policy.update(policy)
+            for key in ['rollup', 'retention', 'replication',
+                        'shard_duration']:
+                if key not in new_policy:
+                    raise ConfigError(
+                        'configs[{}].desired_policies[{}]: missing {}'.format(
+                            index, number, key
+                        )
+                    )
             defaulted_policies.append(new_policy)
         db_config['desired_policies'] = defaulted_policies
 
 
-config = {}
-server_conf_base = {}
+def _read_file(path, sources, files, seen):
+    """
+    Reads a configuration file, or the .yaml and .yml files of a directory
+    in name order, after the files it includes.
+
+    :param path: Path of the file or directory
+    :param sources: List (path, data) of the files read are added to
+    :param files: List [path, mtime, size, digest] of the files and
+                  directories read are added to
+    :param seen: Paths of the files including this one
+    :raises ConfigError: On a missing or invalid file, or an include loop
+    """
+    path = os.path.abspath(path)
+    if path in seen:
+        raise ConfigError('{}: included by itself'.format(path))
+    try:
+        stat = os.stat(path)
+        if os.path.isdir(path):
+            names = sorted(
+                name for name in os.listdir(path)
+                if name.endswith(('.yaml', '.yml'))
+            )
+            content = '\n'.join(names).encode('utf-8')
+        else:
+            with open(path, 'rb') as config_file:
+                content = config_file.read()
+    except (IOError, OSError) as e:
+        raise ConfigError('Cannot read {}: {}'.format(path, e))
+    files.append([path, stat.st_mtime_ns, stat.st_size,
+                  hashlib.sha256(content).hexdigest()])
+
+    if os.path.isdir(path):
+        for name in names:
+            _read_file(os.path.join(path, name), sources, files, seen)
+        return
+
+    try:
+        data = yaml.safe_load(content) or {}
+    except yaml.YAMLError as e:
+        raise ConfigError('{}: {}'.format(path, e))
+    if not isinstance(data, dict):
+        raise ConfigError('{}: expected a mapping'.format(path))
+    validate(data, SCHEMA, path)
+
+    includes = data.pop('include', None) or []
+    if isinstance(includes, str):
+        includes = [includes]
+    for include in includes:
+        _read_file(os.path.join(os.path.dirname(path), include), sources,
+                   files, seen + (path,))
+    sources.append((path, data))
+
+
+def read_sources(paths):
+    """
+    Reads configuration files. A file may include other files, or
+    directories, with include, relative to itself; they are read before
+    it, so it overrides them.
+
+    :param paths: Paths of the files or directories, later ones override
+                  earlier ones
+    :return: List of (path, data) of the files in the order they apply, and
+             list of [path, mtime, size, digest] of the files and
+             directories read
+    :raises ConfigError: On a missing or invalid file
+    """
+    sources = []
+    files = []
+    for path in paths:
+        _read_file(path, sources, files, ())
+    return sources, files
+
+
+def compile_config(sources=()):
+    """
+    Compiles the configuration from the defaults and configuration files,
+    filling in the defaults of every database and policy.
+
+    :param sources: List of (path, data) from read_sources
+    :return: Configuration dictionary
+    :raises ConfigError: If the result is not a valid configuration
+    """
+    configuration = {}
+    server_base = {}
+    update_config(configuration, server_base, yaml.safe_load(default_policy))
+    for _, data in sources:
+        update_config(configuration, server_base, data)
+    make_db_configs(configuration, server_base)
+    return configuration
+
+
+def default_cache_path():
+    """
+    :return: Path of the cache of the compiled configuration, in the user
+             cache directory
+    """
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or
+        os.path.join(os.path.expanduser('~'), '.cache'),
+        'influx_aggregation', 'config.json'
+    )
+
+
+def _unchanged(files):
+    """
+    Checks the files a configuration was compiled from: unchanged when their
+    modification times and sizes are, or else when their contents are.
+
+    :param files: List of [path, mtime, size, digest], the modification
+                  times and sizes of touched files are updated
+    :return: True when unchanged, False if not, None when only the
+             modification times changed
+    """
+    touched = False
+    for entry in files:
+        path, mtime, size, digest = entry
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if stat.st_mtime_ns == mtime and stat.st_size == size:
+            continue
+        touched = True
+        entry[1:3] = [stat.st_mtime_ns, stat.st_size]
+        try:
+            if os.path.isdir(path):
+                content = '\n'.join(sorted(
+                    name for name in os.listdir(path)
+                    if name.endswith(('.yaml', '.yml'))
+                )).encode('utf-8')
+            else:
+                with open(path, 'rb') as config_file:
+                    content = config_file.read()
+        except (IOError, OSError):
+            return False
+        if hashlib.sha256(content).hexdigest() != digest:
+            return False
+    return None if touched else True
+
+
+def load_config(paths=(), cache=None):
+    """
+    Loads the configuration from the defaults and configuration files,
+    from the cache while the files are unchanged.
+
+    :param paths: Paths of the configuration files or directories
+    :param cache: Path of the cache of compiled configurations, disabled
+                  if empty or without configuration files
+    :return: Configuration dictionary
+    :raises ConfigError: On a missing or invalid file
+    """
+    if not paths:
+        # Nothing to save compiling the defaults alone
+        cache = None
+    key = json.dumps([os.path.abspath(path) for path in paths])
+    entries = load_json(cache) if cache else {}
+    entry = entries.get(key)
+    if entry is not None and entry.get('defaults') == DEFAULTS_DIGEST:
+        unchanged = _unchanged(entry['files'])
+        if unchanged:
+            return entry['config']
+        if unchanged is None:
+            # Touched but not changed, remember the new modification times
+            _save_cache(cache, entries)
+            return entry['config']
 
-default_base = yaml.safe_load(default_policy)
+    sources, files = read_sources(paths)
+    configuration = compile_config(sources)
+    if cache:
+        entries[key] = dict(defaults=DEFAULTS_DIGEST, files=files,
+                            config=configuration)
+        _save_cache(cache, entries)
+    return configuration
 
-# Possible to add a file load with update here.
-update_config(config, server_conf_base, default_base)
 
-make_db_configs(config, server_conf_base)
+def _save_cache(cache, entries):
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(cache)), exist_ok=True)
+        save_json(cache, entries)
+    except (IOError, OSError, TypeError, ValueError) as e:
+        logger.warning("Not caching the configuration in {}: {}".format(
+            cache, e
+        ))
+
+
+def freeze(value):
+    """
+    Turns a configuration value into a read-only one, mappings into
+    read-only views and lists into tuples.
+
+    :param value: Configuration value
+    :return: Read-only configuration value
+    """
+    if isinstance(value, Mapping):
+        return MappingProxyType({
+            key: freeze(item) for key, item in value.items()
+        })
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    """
+    Copies a read-only configuration value into one that can be changed,
+    like the dictionaries configuration files are compiled to.
+
+    :param value: Configuration value, see freeze
+    :return: Configuration value of dictionaries and lists
+    """
+    if isinstance(value, Mapping):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(item) for item in value]
+    return value
+
+
+class LazyConfig(Mapping):
+    """
+    The configuration, loaded the first time it is used rather than when
+    it is imported, from the files in INFLUX_AGGREGATION_CONFIG unless load
+    was called first. It is read-only, shared by every thread: replace or
+    override it as a whole, and thaw the values that are changed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = None
+
+    def replace(self, data):
+        """
+        Replaces the configuration, for every module using it.
+
+        :param data: Configuration dictionary
+        """
+        data = freeze(data)
+        with self.lock:
+            self.data = data
+
+    @contextmanager
+    def override(self, values):
+        """
+        Overrides configuration values until the context exits, sections
+        are merged one level deep like in configuration files.
+
+        :param values: Dictionary of configuration values
+        """
+        original = self._loaded()
+        configuration = thaw(original)
+        for key, value in values.items():
+            configuration[key] = _merge(configuration.get(key), value)
+        self.replace(configuration)
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.data = original
+
+    def _loaded(self):
+        if self.data is None:
+            with self.lock:
+                if self.data is None:
+                    environment = os.environ.get(CONFIG_ENV)
+                    self.data = freeze(load_config(
+                        environment.split(os.pathsep) if environment else (),
+                        os.environ.get(CACHE_ENV, default_cache_path())
+                    ))
+        return self.data
+
+    def __getitem__(self, key):
+        return self._loaded()[key]
+
+    def __iter__(self):
+        return iter(self._loaded())
+
+    def __len__(self):
+        return len(self._loaded())
+
+    def copy(self):
+        """
+        :return: Configuration dictionary that can be changed
+        """
+        return thaw(self._loaded())
+
+
+config = LazyConfig()
+
+
+def load(paths=(), cache=None):
+    """
+    Loads the configuration used by every module, see load_config.
+    """
+    config.replace(load_config(paths, cache))
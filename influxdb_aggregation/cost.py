@@ -0,0 +1,279 @@
+import heapq
+import logging
+from functools import reduce
+from operator import mul
+
+from influxdb_aggregation import templating as tpl
+from influxdb_aggregation.conf import config
+from influxdb_aggregation.durations import SECOND, parse_duration
+from influxdb_aggregation.hibernation import iter_batches
+from influxdb_aggregation.influxql import quote_identifier
+from influxdb_aggregation.tags import has_tag_lists
+
+__all__ = ['FLAG', 'REFUSE', 'stats_query', 'parse_stats', 'budget_tag_keys',
+           'collect_stats', 'series_written', 'query_cost', 'within_budget']
+
+# With a cost_budget, the series cardinality and the point rate of every
+# measurement are read while planning, and the continuous queries costing
+# more than the budget per run are flagged or not created. The number of
+# values of the tags named by keep_tags and drop_tags is read as well, to
+# estimate the series of the queries not grouping by *.
+
+logger = logging.getLogger(__name__)
+
+FLAG = 'flag'
+REFUSE = 'refuse'
+
+
+def stats_query(database, measurements, window, tag_keys=()):
+    """
+    Renders the statements reading the series cardinality and the number of
+    points written within the window of measurements, and the number of
+    values of tag keys.
+
+    :param database: Name of the database
+    :param measurements: List of measurement names
+    :param window: Window in nanoseconds
+    :param tag_keys: List of the tag keys counting their values
+    :return: Query of two statements, and one per tag key
+    """
+    sources = ', '.join(
+        '{}.{}.{}'.format(
+            quote_identifier(database), tpl.policy_name({}),
+            quote_identifier(measurement)
+        )
+        for measurement in measurements
+    )
+    return '; '.join([
+        'SHOW SERIES EXACT CARDINALITY FROM {}'.format(sources),
+        'SELECT count(*) FROM {} WHERE time > now() - {}s'.format(
+            sources, window // SECOND
+        )
+    ] + [
+        'SHOW TAG VALUES EXACT CARDINALITY FROM {} WITH KEY = {}'.format(
+            sources, quote_identifier(key)
+        )
+        for key in tag_keys
+    ])
+
+
+def _new_stats():
+    return dict(series=0, rate=0.0, tags={})
+
+
+def parse_stats(results, window, tag_keys=()):
+    """
+    Reads the results of stats_query.
+
+    :param results: List of the ResultSet
+    :param window: Window in nanoseconds
+    :param tag_keys: List of the tag keys counting their values
+    :return: Dictionary of dict(series=..., rate=..., tags=...) by
+             measurement, the rate in points per second and the number of
+             values by tag key, for the tag keys the measurement has
+    """
+    cardinality, counts = results[:2]
+    stats = {}
+    for (measurement, _), points in cardinality.items():
+        stats[measurement] = _new_stats()
+        stats[measurement]['series'] = sum(
+            point.get('count') or 0 for point in points
+        )
+    for (measurement, _), points in counts.items():
+        # Points have several fields, the most counted field is the closest
+        # to the number of points written
+        written = max(
+            [value or 0 for point in points
+             for key, value in point.items() if key.startswith('count')] or
+            [0]
+        )
+        stats.setdefault(measurement, _new_stats())
+        stats[measurement]['rate'] = written / (window / SECOND)
+    for key, values in zip(tag_keys, results[2:]):
+        for (measurement, _), points in values.items():
+            stats.setdefault(measurement, _new_stats())
+            stats[measurement]['tags'][key] = sum(
+                point.get('count') or 0 for point in points
+            )
+    return stats
+
+
+def budget_tag_keys(db_config):
+    """
+    :param db_config: configuration dictionary for this database
+    :return: Sorted list of the tag keys of the keep_tags and drop_tags of
+             the policies, their values are counted for the cost budget
+    """
+    if db_config.get('continuous_query_mode') == 'wildcard':
+        return []
+    keys = set()
+    for policy in db_config['desired_policies']:
+        if has_tag_lists(policy):
+            keys.update(policy.get('keep_tags') or ())
+            keys.update(policy.get('drop_tags') or ())
+    return sorted(keys)
+
+
+def collect_stats(client, db_config, measurements, stats):
+    """
+    Reads the stats of measurements in batches while they are iterated,
+    when the database has a cost budget.
+
+    :param client: Influx client (connection)
+    :param db_config: configuration dictionary for this database
+    :param measurements: Iterable of measurement names, iterated lazily
+    :param stats: Dictionary the stats are added to by measurement name
+    :return: Generator of the measurement names, their stats are in stats
+             once they are yielded
+    """
+    if not db_config.get('cost_budget'):
+        for measurement in measurements:
+            yield measurement
+        return
+
+    settings = config['cost']
+    window = parse_duration(settings['rate_window'])
+    tag_keys = budget_tag_keys(db_config)
+    for batch in iter_batches(measurements, settings['batch_size']):
+        results = client.query(
+            stats_query(db_config['database'], batch, window, tag_keys)
+        )
+        stats.update(parse_stats(results, window, tag_keys))
+        for measurement in batch:
+            yield measurement
+
+
+def series_written(stats, tags=None):
+    """
+    Estimates the number of series a continuous query writes. Grouping by
+    tags whose values are all counted, it writes at most one series per
+    combination of their values. Otherwise, the input series are merged by
+    at most the number of values of the tags counted and left out.
+
+    :param stats: Stats of the measurement, see parse_stats
+    :param tags: Tag keys grouped by, None for GROUP BY *
+    :return: Number of series
+    """
+    series = stats['series']
+    if tags is None or not series:
+        return series
+    values = stats.get('tags', {})
+    if all(tag in values for tag in tags):
+        return min(series, reduce(mul, (values[tag] for tag in tags), 1))
+    merged = reduce(mul, (
+        count for tag, count in values.items() if tag not in tags and count
+    ), 1)
+    return max(series // merged, 1)
+
+
+def query_cost(stats, interval, tags=None, source=None):
+    """
+    Estimates the cost of one run of a continuous query. A query reading
+    the input reads the points written during one interval, a chained
+    rollup reads one point per interval of the rollup it reads, for every
+    series that rollup writes.
+
+    :param stats: Stats of the measurement, see parse_stats
+    :param interval: Rollup interval in nanoseconds
+    :param tags: Tag keys grouped by, None for GROUP BY *
+    :param source: (rollup interval in nanoseconds, series written) of the
+                   rollup read when rollups are chained, None for the input
+    :return: dict(points=points read, series=series written)
+    """
+    if source is None:
+        points = int(stats['rate'] * interval / SECOND)
+    else:
+        points = source[1] * (interval // source[0])
+    return dict(points=points, series=series_written(stats, tags))
+
+
+def _chained_sources(db_config):
+    """
+    :param db_config: configuration dictionary for this database
+    :return: Dictionary of the policy read by policy name, for the chained
+             rollups not reading the input
+    """
+    if not db_config.get('chained_rollups'):
+        return {}
+    return {
+        tpl.policy_name(policy): source
+        for policy, source in tpl.chain_policies(
+            db_config['desired_policies'])
+        if source
+    }
+
+
+def within_budget(db_config, query_info, stats, refused=None):
+    """
+    Checks the desired continuous queries against the cost budget of the
+    database, and reports the most costly ones when done.
+
+    :param db_config: configuration dictionary for this database
+    :param query_info: Iterable of (query name, query info) tuples
+    :param stats: Stats by measurement, filled by collect_stats
+    :param refused: Set the names of the refused queries are added to, if
+                    given
+    :return: Generator of the (query name, query info) tuples to create
+    """
+    budget = db_config.get('cost_budget')
+    if not budget:
+        for item in query_info:
+            yield item
+        return
+
+    heaviest = []
+    report = config['cost']['report']
+    sources = _chained_sources(db_config)
+    # Series written by the queries of the current measurement, by policy
+    # name, the queries of a measurement come finest first
+    written = {}
+    measurement = None
+    for name, info in query_info:
+        if info.get('measurement') not in stats:
+            yield name, info
+            continue
+
+        if info['measurement'] != measurement:
+            measurement = info['measurement']
+            written = {}
+        source = sources.get(tpl.policy_name(info))
+        if source is not None:
+            source = (
+                parse_duration(source['rollup']),
+                written.get(tpl.policy_name(source),
+                            stats[measurement]['series'])
+            )
+        cost = query_cost(
+            stats[measurement], parse_duration(info['rollup']),
+            info.get('tags'), source
+        )
+        written[tpl.policy_name(info)] = cost['series']
+        entry = (cost['points'], cost['series'], name)
+        if len(heaviest) < report:
+            heapq.heappush(heaviest, entry)
+        elif report:
+            heapq.heappushpop(heaviest, entry)
+
+        over = [
+            key for key in ['points', 'series']
+            if budget.get('max_' + key) is not None and
+            cost[key] > budget['max_' + key]
+        ]
+        if not over:
+            yield name, info
+        elif budget.get('action', FLAG) == REFUSE:
+            logger.warning("Not creating {}, over the {} budget: {}".format(
+                name, ' and '.join(over), cost
+            ))
+            if refused is not None:
+                refused.add(name)
+        else:
+            logger.warning("{} is over the {} budget: {}".format(
+                name, ' and '.join(over), cost
+            ))
+            yield name, info
+
+    for points, series, name in sorted(heaviest, reverse=True):
+        logger.info("Cost of {} per run: {} points, {} series".format(
+            name, points, series
+        ))
@@ -0,0 +1,205 @@
+import logging
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from influxdb_aggregation import main, metrics
+from influxdb_aggregation.apply import apply_options, apply_statements
+from influxdb_aggregation.conf import config
+from influxdb_aggregation.durations import SECOND, parse_duration
+from influxdb_aggregation.pool import ClientPool
+
+__all__ = ['DatabaseWatcher', 'run_daemon']
+
+logger = logging.getLogger(__name__)
+
+
+def _seconds(duration):
+    return parse_duration(duration) / SECOND
+
+
+class DatabaseWatcher(object):
+    """
+    Keeps one database in the desired state with a long lived client.
+    Polls only look for new measurements and create their queries, the
+    whole database is reconciled every full_interval.
+    The poll interval backs off when polls are slow or fail, and recovers
+    when they are fast again.
+    """
+
+    def __init__(self, client, db_config, poll_interval, max_poll_interval,
+                 slow_poll, full_interval):
+        """
+        :param client: Influx client (connection), kept open
+        :param db_config: configuration dictionary for this database
+        :param poll_interval: Seconds between polls
+        :param max_poll_interval: Longest seconds between polls when
+                                  backing off
+        :param slow_poll: Seconds a poll may take before backing off
+        :param full_interval: Seconds between full reconciliations
+        """
+        self.client = metrics.instrument(client)
+        self.db_config = db_config
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.slow_poll = slow_poll
+        self.full_interval = full_interval
+
+        self.interval = poll_interval
+        self.known = None
+        self.next_poll = 0
+        self.next_full = 0
+
+    @property
+    def name(self):
+        return '{}:{}/{}'.format(
+            self.db_config['host'], self.db_config['port'],
+            self.db_config['database']
+        )
+
+    def poll(self, now=None):
+        """
+        Runs a full reconciliation when due, otherwise creates the queries
+        of measurements added since the last poll, and schedules the next
+        poll.
+
+        :param now: Monotonic time of the poll
+        """
+        now = time.monotonic() if now is None else now
+        start = time.monotonic()
+        failed = False
+        try:
+            if self.known is None or now >= self.next_full:
+                self.reconcile()
+                self.next_full = now + self.full_interval
+            elif (self.db_config.get('continuous_query_mode') !=
+                  main.WILDCARD):
+                with metrics.span('discover'):
+                    self.discover()
+        except Exception:
+            logger.exception("Polling {} failed".format(self.name))
+            failed = True
+        metrics.inc('polls_total', help='Polls of the databases',
+                    result='failed' if failed else 'ok')
+
+        duration = time.monotonic() - start
+        if failed or duration > self.slow_poll:
+            self.interval = min(self.interval * 2, self.max_poll_interval)
+            logger.warning("Backing off {} to {:.0f}s".format(
+                self.name, self.interval
+            ))
+        else:
+            self.interval = max(self.interval / 2, self.poll_interval)
+        self.next_poll = now + self.interval
+
+    def reconcile(self):
+        """
+        Gets the whole database into the desired state, and remembers its
+        measurements.
+        """
+        seen = set()
+        main.reconcile_database(self.client, self.db_config, seen=seen)
+        self.known = seen
+
+    def discover(self):
+        """
+        Creates the continuous queries of measurements that were not there
+        at the last poll, like a full reconciliation would: idle
+        measurements get none, queries over the cost budget are refused or
+        flagged, and queries that already exist are only re-created when
+        they changed.
+        """
+        new = [
+            measurement for measurement in main.iter_measurements(
+                self.client, config['measurement_page_size']
+            )
+            if measurement not in self.known
+        ]
+        if not new:
+            return
+
+        logger.info("Found {} new measurements in {}".format(
+            len(new), self.name
+        ))
+        # A measurement that comes back may still have its queries, kept as
+        # orphans or refused, they are re-created only when they changed
+        existing_index = {
+            q['name']: main.query_digest(q['query'])
+            for q in self.client.query(
+                'SHOW CONTINUOUS QUERIES'
+            ).get_points()
+        }
+        idle = set()
+        stats = {}
+        tag_keys = {}
+        active = main.filter_measurements(
+            self.client, self.db_config, new, idle, stats, tag_keys
+        )
+        apply_statements(
+            self.client,
+            main.plan_queries(
+                self.db_config,
+                main.desired_queries(self.db_config, active, stats, tag_keys),
+                existing_index, set()
+            ),
+            in_order=True,
+            **apply_options(self.db_config)
+        )
+        # Idle measurements get their queries from a full reconciliation
+        # once they are written to
+        self.known.update(new)
+
+
+def run_daemon(db_configs, workers=1, stop=None):
+    """
+    Polls the databases until stopped, by SIGTERM, SIGINT or the stop event.
+    Polls running when stopped are finished first.
+
+    :param db_configs: List of database configuration dictionaries
+    :param workers: Number of databases polled at the same time
+    :param stop: threading.Event stopping the daemon, created if not given
+    """
+    stop = threading.Event() if stop is None else stop
+
+    def handle_signal(signum, frame):
+        logger.info("Received signal {}, stopping".format(signum))
+        stop.set()
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, handle_signal)
+        signal.signal(signal.SIGINT, handle_signal)
+
+    settings = config['daemon']
+    pool = ClientPool(main.InfluxDBClient, config['connection_pool_size'])
+    watchers = [
+        DatabaseWatcher(
+            pool.client(db_config),
+            db_config,
+            poll_interval=_seconds(settings['poll_interval']),
+            max_poll_interval=_seconds(settings['max_poll_interval']),
+            slow_poll=_seconds(settings['slow_poll']),
+            full_interval=_seconds(settings['full_interval'])
+        )
+        for db_config in db_configs
+    ]
+    running = {}
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            while not stop.is_set():
+                now = time.monotonic()
+                for watcher in watchers:
+                    if watcher not in running and watcher.next_poll <= now:
+                        running[watcher] = executor.submit(watcher.poll, now)
+
+                for watcher, future in list(running.items()):
+                    if future.done():
+                        del running[watcher]
+
+                waiting = [w.next_poll for w in watchers if w not in running]
+                timeout = min(waiting) - time.monotonic() if waiting else 1
+                stop.wait(min(max(timeout, 0.1), 1))
+    finally:
+        pool.close()
+    logger.info("Stopped")
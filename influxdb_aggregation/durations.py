@@ -0,0 +1,88 @@
+import re
+
+__all__ = ['parse_duration', 'format_duration', 'format_go_duration']
+
+NANOSECOND = 1
+MICROSECOND = 1000 * NANOSECOND
+MILLISECOND = 1000 * MICROSECOND
+SECOND = 1000 * MILLISECOND
+MINUTE = 60 * SECOND
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+
+UNITS = {
+    'ns': NANOSECOND,
+    'u': MICROSECOND,
+    'µ': MICROSECOND,
+    'us': MICROSECOND,
+    'ms': MILLISECOND,
+    's': SECOND,
+    'm': MINUTE,
+    'h': HOUR,
+    'd': DAY,
+    'w': WEEK,
+}
+
+_duration_part = re.compile(r'(\d+)(ns|us|u|µ|ms|s|m|h|d|w)')
+
+
+def parse_duration(duration):
+    """
+    Parses an InfluxQL duration, like 5m, 1h30m or 48h0m0s.
+    INF is the infinite duration, and is returned as 0 like influx does.
+
+    :param duration: Duration string
+    :return: Duration in nanoseconds
+    :raises ValueError: If the string is not a valid duration
+    """
+    duration = str(duration).strip()
+    if duration.upper() == 'INF':
+        return 0
+
+    total = 0
+    position = 0
+    for match in _duration_part.finditer(duration):
+        if match.start() != position:
+            break
+        total += int(match.group(1)) * UNITS[match.group(2)]
+        position = match.end()
+
+    if position == 0 or position != len(duration):
+        raise ValueError("Invalid duration {!r}".format(duration))
+    return total
+
+
+def format_duration(duration):
+    """
+    Formats a duration the way influx writes durations into queries,
+    using the largest unit that represents it exactly.
+
+    :param duration: Duration in nanoseconds
+    :return: Duration string
+    """
+    if duration == 0:
+        return '0s'
+    for unit in ['w', 'd', 'h', 'm', 's', 'ms', 'u']:
+        if duration % UNITS[unit] == 0:
+            return '{}{}'.format(duration // UNITS[unit], unit)
+    return '{}ns'.format(duration)
+
+
+def format_go_duration(duration):
+    """
+    Formats a duration the way influx shows retention policy durations,
+    like 48h0m0s.
+
+    :param duration: Duration in nanoseconds
+    :return: Duration string
+    """
+    if duration % SECOND:
+        return format_duration(duration)
+    hours, rest = divmod(duration, HOUR)
+    minutes, seconds = divmod(rest, MINUTE)
+    if hours:
+        return '{}h{}m{}s'.format(hours, minutes, seconds // SECOND)
+    if minutes:
+        return '{}m{}s'.format(minutes, seconds // SECOND)
+    return '{}s'.format(seconds // SECOND)
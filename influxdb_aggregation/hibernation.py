@@ -0,0 +1,117 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from influxdb_aggregation import templating as tpl
+from influxdb_aggregation.conf import config
+from influxdb_aggregation.durations import format_duration, parse_duration
+from influxdb_aggregation.influxql import quote_identifier
+
+__all__ = ['hibernation_window', 'activity_query', 'iter_batches',
+           'active_measurements']
+
+# Measurements without points in the input policy for hibernate_after get
+# no continuous queries, their queries are dropped and re-created by the
+# first run after writes resume.
+
+
+def hibernation_window(db_config):
+    """
+    :param db_config: configuration dictionary for this database
+    :return: Hibernation window in nanoseconds, 0 when hibernation is off
+    """
+    window = db_config.get('hibernate_after')
+    if not window or db_config.get('continuous_query_mode') == 'wildcard':
+        return 0
+    return parse_duration(window)
+
+
+def activity_query(database, measurements, window):
+    """
+    Renders a statement per measurement returning a point when it has
+    points in the input policy within the window. Influx stops at the
+    first point, instead of counting every point of the window.
+
+    :param database: Name of the database
+    :param measurements: List of measurement names
+    :param window: Window in nanoseconds
+    :return: Query
+    """
+    return '; '.join(
+        'SELECT * FROM {}.{}.{} WHERE time > now() - {} LIMIT 1'.format(
+            quote_identifier(database), tpl.policy_name({}),
+            quote_identifier(measurement), format_duration(window)
+        )
+        for measurement in measurements
+    )
+
+
+def iter_batches(items, size):
+    """
+    Splits an iterable into lists of at most size items.
+
+    :param items: Iterable
+    :param size: Items per batch
+    :return: Generator of lists
+    """
+    items = iter(items)
+    while True:
+        batch = list(islice(items, max(size, 1)))
+        if not batch:
+            return
+        yield batch
+
+
+def _active(client, database, batch, window):
+    results = client.query(activity_query(database, batch, window))
+    if not isinstance(results, list):
+        results = [results]
+    return set(
+        measurement for measurement, result in zip(batch, results)
+        if result.keys()
+    )
+
+
+def active_measurements(client, db_config, measurements, idle):
+    """
+    Filters measurements down to those written to within the hibernation
+    window. The measurements are checked in batches, one query per batch,
+    with several queries running at the same time.
+
+    :param client: Influx client (connection)
+    :param db_config: configuration dictionary for this database
+    :param measurements: Iterable of measurement names, iterated lazily
+    :param idle: Set the idle measurements are added to
+    :return: Generator of active measurement names, in the same order
+    """
+    window = hibernation_window(db_config)
+    if not window:
+        for measurement in measurements:
+            yield measurement
+        return
+
+    settings = config['hibernation']
+    workers = max(settings['workers'], 1)
+    pending = deque()
+
+    def finish():
+        batch, future = pending.popleft()
+        active = future.result()
+        for measurement in batch:
+            if measurement in active:
+                yield measurement
+            else:
+                idle.add(measurement)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in iter_batches(measurements, settings['batch_size']):
+            pending.append((batch, executor.submit(
+                _active, client, db_config['database'], batch, window
+            )))
+            # Bounds the measurements held in memory
+            if len(pending) > 2 * workers:
+                for measurement in finish():
+                    yield measurement
+        while pending:
+            for measurement in finish():
+                yield measurement
@@ -0,0 +1,269 @@
+import re
+from collections import namedtuple
+
+from influxdb_aggregation.durations import format_duration, parse_duration
+
+__all__ = ['Token', 'tokenize', 'canonical_query', 'quote_identifier',
+           'group_by_time']
+
+KEYWORDS = frozenset([
+    'ALL', 'ALTER', 'ANALYZE', 'ANY', 'AS', 'ASC', 'BEGIN', 'BY',
+    'CARDINALITY', 'CREATE', 'CONTINUOUS', 'DATABASE', 'DATABASES',
+    'DEFAULT', 'DELETE', 'DESC', 'DESTINATIONS', 'DIAGNOSTICS', 'DISTINCT',
+    'DROP', 'DURATION', 'END', 'EVERY', 'EXACT', 'EXPLAIN', 'FIELD', 'FOR',
+    'FROM', 'GRANT', 'GRANTS', 'GROUP', 'GROUPS', 'IN', 'INF', 'INSERT',
+    'INTO', 'KEY', 'KEYS', 'KILL', 'LIMIT', 'MEASUREMENT', 'MEASUREMENTS',
+    'NAME', 'OFFSET', 'ON', 'ORDER', 'PASSWORD', 'POLICY', 'POLICIES',
+    'PRIVILEGES', 'QUERIES', 'QUERY', 'READ', 'REPLICATION', 'RESAMPLE',
+    'RETENTION', 'REVOKE', 'SELECT', 'SERIES', 'SET', 'SHARD', 'SHARDS',
+    'SLIMIT', 'SOFFSET', 'STATS', 'SUBSCRIPTION', 'SUBSCRIPTIONS', 'TAG',
+    'TO', 'USER', 'USERS', 'VALUES', 'WHERE', 'WITH', 'WRITE', 'AND', 'OR',
+    'TRUE', 'FALSE',
+])
+
+# Tokens after which a / starts a regular expression instead of a division
+REGEX_PRECEDERS = frozenset(['FROM', 'SELECT', '.', ',', '=~', '!~'])
+
+# Functions following the dimensions of a GROUP BY clause
+GROUP_BY_OPTIONS = frozenset(['fill', 'tz'])
+
+IDENTIFIER = 'identifier'
+KEYWORD = 'keyword'
+DURATION = 'duration'
+NUMBER = 'number'
+STRING = 'string'
+REGEX = 'regex'
+PUNCTUATION = 'punctuation'
+
+Token = namedtuple('Token', ['kind', 'value'])
+
+_bare_identifier = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+_token = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<quoted>"(?:[^"\\]|\\.)*")
+  | (?P<string>'(?:[^'\\]|\\.)*')
+  | (?P<duration>(?:\d+(?:ns|us|u|µ|ms|s|m|h|d|w))+(?![A-Za-z0-9_]))
+  | (?P<number>\d+(?:\.\d+)?)
+  | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<operator>=~|!~|!=|<>|<=|>=)
+  | (?P<slash>/)
+  | (?P<other>.)
+''', re.VERBOSE)
+
+_regex = re.compile(r'/(?:[^/\\]|\\.)*/')
+
+
+def tokenize(query):
+    """
+    Splits an InfluxQL query into tokens.
+    Keywords are upper cased, quoted identifiers are unquoted, and
+    durations are kept as nanoseconds.
+
+    :param query: InfluxQL query
+    :return: List of Token
+    """
+    tokens = []
+    position = 0
+    while position < len(query):
+        match = _token.match(query, position)
+        kind = match.lastgroup
+        text = match.group()
+        position = match.end()
+
+        if kind == 'space':
+            continue
+        elif kind == 'quoted':
+            tokens.append(Token(IDENTIFIER, re.sub(r'\\(.)', r'\1',
+                                                   text[1:-1])))
+        elif kind == 'string':
+            tokens.append(Token(STRING, text))
+        elif kind == 'duration':
+            tokens.append(Token(DURATION, parse_duration(text)))
+        elif kind == 'number':
+            tokens.append(Token(NUMBER, text))
+        elif kind == 'word':
+            if text.upper() in KEYWORDS:
+                tokens.append(Token(KEYWORD, text.upper()))
+            else:
+                tokens.append(Token(IDENTIFIER, text))
+        elif kind == 'slash' and (
+                tokens and tokens[-1].value in REGEX_PRECEDERS):
+            regex = _regex.match(query, match.start())
+            if regex is None:
+                tokens.append(Token(PUNCTUATION, text))
+            else:
+                tokens.append(Token(REGEX, regex.group()))
+                position = regex.end()
+        else:
+            tokens.append(Token(PUNCTUATION, text))
+    return tokens
+
+
+def quote_identifier(identifier):
+    """
+    Quotes an identifier the way influx does, only when it is needed.
+
+    :param identifier: Unquoted identifier
+    :return: Identifier as written in a query
+    """
+    if (_bare_identifier.match(identifier) and
+            identifier.upper() not in KEYWORDS):
+        return identifier
+    return '"{}"'.format(
+        identifier.replace('\\', '\\\\').replace('"', '\\"')
+    )
+
+
+def _split_dimensions(tokens):
+    """
+    Splits the tokens of a GROUP BY clause into dimensions, at the commas
+    outside of parentheses.
+
+    :param tokens: List of Token
+    :return: List of lists of Token
+    """
+    dimensions = [[]]
+    depth = 0
+    for token in tokens:
+        if token.kind == PUNCTUATION and token.value == '(':
+            depth += 1
+        elif token.kind == PUNCTUATION and token.value == ')':
+            depth -= 1
+        if depth == 0 and token.kind == PUNCTUATION and token.value == ',':
+            dimensions.append([])
+        else:
+            dimensions[-1].append(token)
+    return dimensions
+
+
+def _sort_group_by(tokens):
+    """
+    Sorts the dimensions of GROUP BY clauses, their order does not matter.
+
+    :param tokens: List of canonical strings and Token
+    :return: List of Token
+    """
+    result = []
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        result.append(token)
+        index += 1
+        if not (token == Token(KEYWORD, 'GROUP') and
+                index < len(tokens) and tokens[index] == Token(KEYWORD, 'BY')):
+            continue
+
+        result.append(tokens[index])
+        index += 1
+        end = index
+        depth = 0
+        while end < len(tokens):
+            if tokens[end].kind == PUNCTUATION and tokens[end].value == '(':
+                depth += 1
+            elif tokens[end].kind == PUNCTUATION and tokens[end].value == ')':
+                if depth == 0:
+                    break
+                depth -= 1
+            elif depth == 0 and tokens[end].kind == KEYWORD:
+                break
+            elif (depth == 0 and tokens[end].kind == IDENTIFIER and
+                  tokens[end].value in GROUP_BY_OPTIONS and
+                  tokens[end + 1:end + 2] == [Token(PUNCTUATION, '(')]):
+                break
+            end += 1
+
+        dimensions = sorted(
+            _split_dimensions(tokens[index:end]),
+            key=lambda dimension: [_render(t) for t in dimension]
+        )
+        for number, dimension in enumerate(dimensions):
+            if number:
+                result.append(Token(PUNCTUATION, ','))
+            result.extend(dimension)
+        index = end
+    return result
+
+
+def _render(token):
+    """
+    Renders a token in its canonical form.
+    """
+    if token.kind == IDENTIFIER:
+        return quote_identifier(token.value)
+    if token.kind == DURATION:
+        return format_duration(token.value)
+    return token.value
+
+
+def _drop_default_fill(tokens):
+    """
+    Leaves out fill(null), the default influx does not store.
+
+    :param tokens: List of Token, with lower cased function names
+    :return: List of Token
+    """
+    result = []
+    index = 0
+    while index < len(tokens):
+        if (tokens[index] == Token(IDENTIFIER, 'fill') and
+                [t.kind for t in tokens[index + 1:index + 4]] ==
+                [PUNCTUATION, IDENTIFIER, PUNCTUATION] and
+                tokens[index + 1].value == '(' and
+                tokens[index + 2].value.lower() == 'null' and
+                tokens[index + 3].value == ')'):
+            index += 4
+            continue
+        result.append(tokens[index])
+        index += 1
+    return result
+
+
+def canonical_query(query):
+    """
+    Renders an InfluxQL query in a canonical form, so queries influx
+    considers the same compare equal. Influx rewrites continuous queries
+    when storing them, quoting identifiers, normalizing durations,
+    changing the case of keywords, reordering the GROUP BY dimensions and
+    dropping fill(null).
+
+    :param query: InfluxQL query
+    :return: Canonical query
+    """
+    tokens = tokenize(query)
+    # Function names are case insensitive
+    tokens = [
+        Token(IDENTIFIER, token.value.lower())
+        if token.kind == IDENTIFIER and index + 1 < len(tokens) and
+        tokens[index + 1] == Token(PUNCTUATION, '(')
+        else token
+        for index, token in enumerate(tokens)
+    ]
+    tokens = _drop_default_fill(tokens)
+    return ' '.join(_render(token) for token in _sort_group_by(tokens))
+
+
+def group_by_time(query):
+    """
+    Finds the GROUP BY time() interval and offset of a query.
+
+    :param query: InfluxQL query
+    :return: (interval, offset) in nanoseconds, None without GROUP BY time()
+    """
+    tokens = tokenize(query)
+    grouping = False
+    for index, token in enumerate(tokens):
+        if token == Token(KEYWORD, 'BY') and index and \
+                tokens[index - 1] == Token(KEYWORD, 'GROUP'):
+            grouping = True
+        elif grouping and token.kind == KEYWORD:
+            grouping = False
+        elif grouping and token.kind == IDENTIFIER and \
+                token.value.lower() == 'time':
+            arguments = [
+                t.value for t in tokens[index + 2:index + 5]
+                if t.kind == DURATION
+            ]
+            if arguments:
+                return arguments[0], (arguments[1:] or [0])[0]
+    return None
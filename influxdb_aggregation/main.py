@@ -1,36 +1,119 @@
 #!/usr/bin/env python
+import argparse
+import hashlib
+import json
 import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 
 from influxdb import InfluxDBClient
 
+from influxdb_aggregation import conf, metrics
 from influxdb_aggregation import templating as tpl
+from influxdb_aggregation.apply import (
+    POLICY_CREATE, POLICY_DROP, QUERY_CREATE, QUERY_DROP, QUERY_RETIRE,
+    ApplyJournal, Statement, apply_options, apply_statements, order_statements
+)
+from influxdb_aggregation.backfill import BackfillQueue, run_backfill
+from influxdb_aggregation.cache import StateCache
 from influxdb_aggregation.conf import config
+from influxdb_aggregation.cost import collect_stats, within_budget
+from influxdb_aggregation.durations import (
+    SECOND, format_go_duration, parse_duration
+)
+from influxdb_aggregation.hibernation import active_measurements
+from influxdb_aggregation.influxql import canonical_query
+from influxdb_aggregation.pool import ClientPool
+from influxdb_aggregation.tags import (
+    collect_tag_keys, group_by_clause, policy_tags, report_cardinality
+)
 
 logger = logging.getLogger(__name__)
 
+WILDCARD = 'wildcard'
 
-def get_database_state(client, db_config):
+DatabaseResult = namedtuple(
+    'DatabaseResult', ['host', 'port', 'database', 'error', 'duration']
+)
+
+
+def stagger_offset(db_config, policy, key):
     """
-    Queries the database to get the current state of affairs,
-    and renders "desired policies"
+    Works out the GROUP BY time() offset of a continuous query, when
+    staggering is enabled for the database.
 
-    :param client: Influx client (connection)
     :param db_config: configuration dictionary for this database
-    :return: existing_policies, existing_queries, policy_info, query_info
+    :param policy: Policy config dictionary
+    :param key: Measurement name or pattern identifying the query
+    :return: Offset in nanoseconds
     """
-    measurements = [
-        m['name'] for m
-        in client.query('SHOW MEASUREMENTS').get_points()
-    ]
+    if not db_config.get('stagger'):
+        return 0
+    return tpl.stagger_offset(policy, key, db_config.get('stagger_window'))
+
+
+def iter_measurements(client, page_size, shifts=None):
+    """
+    Reads the measurements of a database page by page.
+    Influx lists measurements sorted by name, names not sorting after the
+    previous one are skipped, in case measurements created while paging
+    shift the pages. Those are picked up on the next run.
+    Pages overlap by one measurement: a page not starting with the last
+    measurement of the previous one shifted, and measurements deleted
+    while paging may have moved others into a page already read, so they
+    were not listed.
+
+    :param client: Influx client (connection)
+    :param page_size: Number of measurements read per request, at least 2
+    :param shifts: List the offsets of the pages that shifted are added
+                   to, if given
+    :return: Generator of measurement names
+    """
+    page_size = max(page_size, 2)
+    offset = 0
+    last = None
+    previous = None
+    while True:
+        page = [
+            m['name'] for m in client.query(
+                'SHOW MEASUREMENTS LIMIT {} OFFSET {}'.format(
+                    page_size, offset
+                )
+            ).get_points()
+        ]
+        if previous is not None and page[:1] != [previous]:
+            logger.warning(
+                "Measurements changed while reading them at {}".format(
+                    offset
+                )
+            )
+            if shifts is not None:
+                shifts.append(offset)
+        for measurement in page:
+            if last is None or measurement > last:
+                last = measurement
+                yield measurement
+        if len(page) < page_size:
+            return
+        previous = page[-1]
+        offset += page_size - 1
 
-    queries = list(client.query('SHOW CONTINUOUS QUERIES').get_points())
 
-    policies = list(client.query('SHOW RETENTION POLICIES').get_points())
+def get_policy_info(db_config):
+    """
+    Renders the desired retention policies.
 
+    :param db_config: configuration dictionary for this database
+    :return: Dictionary of policy info by policy name
+    """
     policy_info = {
         tpl.policy_name(policy): dict(
             create=tpl.policy_query(policy, db_config['database']),
-            update=tpl.policy_update_query(policy, db_config['database']),
             **policy
         )
         for policy in db_config['desired_policies']
@@ -41,26 +124,154 @@ def get_database_state(client, db_config):
             db_config['default_policy'],
             db_config['database']
         ) + " DEFAULT",
-        update=tpl.policy_update_query(
-            db_config['default_policy'],
-            db_config['database']
-        ) + " DEFAULT",
+        default=True,
         **db_config['default_policy']
     )
 
-    query_info = {
-        tpl.continuous_query_name(policy, measurement): dict(
-            query=tpl.continuous_query_create(
-                policy,
-                measurement,
-                db_config['database']
-            ),
-            measurement=measurement,
-            **policy
+    return policy_info
+
+
+def iter_query_info(db_config, measurements, tag_keys=None):
+    """
+    Renders the desired continuous queries lazily, measurements are only
+    iterated once.
+
+    :param db_config: configuration dictionary for this database
+    :param measurements: Iterable of measurement names, not used for
+                         wildcard queries
+    :param tag_keys: Tag keys by measurement, filled by
+                     tags.collect_tag_keys, for policies keeping or
+                     dropping tags
+    :return: Generator of (query name, query info) tuples
+    """
+    if db_config.get('continuous_query_mode') == WILDCARD:
+        for policy in db_config['desired_policies']:
+            group_by = group_by_clause(policy_tags(policy, None))
+            for partition, pattern in enumerate(
+                    db_config['wildcard_partitions']):
+                yield tpl.wildcard_query_name(policy, partition), dict(
+                    query=tpl.wildcard_query_create(
+                        policy,
+                        partition,
+                        pattern,
+                        db_config['database'],
+                        stagger_offset(db_config, policy, pattern),
+                        group_by
+                    ),
+                    pattern=pattern,
+                    **policy
+                )
+        return
+
+    if db_config.get('chained_rollups'):
+        chain = tpl.chain_policies(db_config['desired_policies'])
+    else:
+        chain = [(policy, None) for policy in db_config['desired_policies']]
+
+    for measurement in measurements:
+        available = (tag_keys or {}).get(measurement)
+        kept = {}
+        for policy, source in chain:
+            # A chained rollup only has the tags of the rollup it reads
+            if source and tpl.policy_name(source) in kept:
+                tags = policy_tags(policy, kept[tpl.policy_name(source)])
+            else:
+                tags = policy_tags(policy, available)
+            kept[tpl.policy_name(policy)] = \
+                available if tags is None else tags
+
+            info = dict(
+                query=tpl.continuous_query_create(
+                    policy,
+                    measurement,
+                    db_config['database'],
+                    source,
+                    stagger_offset(db_config, policy, measurement),
+                    group_by_clause(tags)
+                ),
+                measurement=measurement,
+                **policy
+            )
+            if tags is not None:
+                info['tags'] = tags
+            yield tpl.continuous_query_name(policy, measurement), info
+
+
+def query_digest(query):
+    """
+    Reduces a continuous query to a compact digest for comparison. The
+    canonical form is digested, so queries influx rewrote when storing them
+    still match the templates.
+
+    :param query: Continuous query creation query
+    :return: Digest bytes
+    """
+    return hashlib.sha1(canonical_query(query).encode('utf-8')).digest()
+
+
+def state_fingerprint(client, db_config):
+    """
+    Fingerprints the desired configuration of a database together with the
+    existing retention policies, continuous queries and measurements, which
+    measurements are idle when queries are hibernated, and the tag keys of
+    the measurements when policies keep or drop tags, without rendering any
+    queries.
+
+    :param client: Influx client (connection)
+    :param db_config: configuration dictionary for this database
+    :return: Fingerprint string
+    """
+    fingerprint = hashlib.sha1()
+    fingerprint.update(json.dumps(
+        [db_config,
+         {k: v for k, v in config.items() if k.endswith('_template')}],
+        sort_keys=True
+    ).encode('utf-8'))
+
+    for query in ['SHOW RETENTION POLICIES', 'SHOW CONTINUOUS QUERIES']:
+        fingerprint.update(json.dumps(
+            sorted(json.dumps(p, sort_keys=True)
+                   for p in client.query(query).get_points())
+        ).encode('utf-8'))
+
+    idle = set()
+    tag_keys = {}
+    measurements = iter_measurements(client, config['measurement_page_size'])
+    measurements = active_measurements(client, db_config, measurements, idle)
+    for measurement in collect_tag_keys(client, db_config, measurements,
+                                        tag_keys):
+        fingerprint.update(json.dumps(
+            [measurement, tag_keys.pop(measurement, None)]
+        ).encode('utf-8') + b'\n')
+    # A measurement going idle or written to again changes the fingerprint
+    fingerprint.update(json.dumps(sorted(idle)).encode('utf-8'))
+
+    return fingerprint.hexdigest()
+
+
+def get_database_state(client, db_config):
+    """
+    Queries the database to get the current state of affairs,
+    and renders "desired policies"
+
+    :param client: Influx client (connection)
+    :param db_config: configuration dictionary for this database
+    :return: existing_policies, existing_queries, policy_info, query_info
+    """
+    with metrics.span('read_measurements'):
+        measurements = list(
+            iter_measurements(client, config['measurement_page_size'])
         )
-        for policy in db_config['desired_policies']
-        for measurement in measurements
-    }
+
+    with metrics.span('read_state'):
+        queries = list(
+            client.query('SHOW CONTINUOUS QUERIES').get_points()
+        )
+        policies = list(client.query('SHOW RETENTION POLICIES').get_points())
+
+    with metrics.span('render'):
+        policy_info = get_policy_info(db_config)
+        query_info = dict(iter_query_info(db_config, measurements))
 
     existing_policies = {p['name']: p for p in policies}
 
@@ -69,58 +280,984 @@ def get_database_state(client, db_config):
     return existing_policies, existing_queries, policy_info, query_info
 
 
-def process_database(db_config):
+def policy_changes(current, desired):
     """
-    Handles the policy+query management for one database.
+    Works out the clauses of a retention policy that differ from the
+    desired policy. Durations are compared by value, so 2d matches the
+    48h0m0s influx shows. A shard duration of 0 is left for influx to
+    choose, and a policy is never made non-default.
 
-    :param db_config:
-    :return:
+    :param current: Existing policy, as shown by influx
+    :param desired: Desired policy info
+    :return: List of clauses to alter, empty if the policy is up to date
     """
-    client = InfluxDBClient(
-        host=db_config['host'],
-        database=db_config['database'],
-        port=db_config['port']
-    )
+    changes = []
+    retention = parse_duration(desired["retention"])
+    if parse_duration(current["duration"]) != retention:
+        changes.append("DURATION {}".format(format_go_duration(retention)))
+    if int(current["replicaN"]) != int(desired["replication"]):
+        changes.append("REPLICATION {}".format(desired["replication"]))
+    shard_duration = parse_duration(desired["shard_duration"])
+    if shard_duration and (
+            parse_duration(current["shardGroupDuration"]) != shard_duration):
+        changes.append("SHARD DURATION {}".format(
+            format_go_duration(shard_duration)
+        ))
+    if desired.get("default") and not current["default"]:
+        changes.append("DEFAULT")
+    return changes
 
-    state = get_database_state(client, db_config)
-    existing_policies, existing_queries, policy_info, query_info = state
+
+def plan_policies(db_config, existing_policies, policy_info):
+    """
+    Works out the statements needed to get the retention policies into the
+    desired state.
+
+    :param db_config: configuration dictionary for this database
+    :param existing_policies: Existing policies by name
+    :param policy_info: Desired policies by name
+    :return: List of Statement
+    """
+    statements = []
 
     for policy in policy_info:
         if policy not in existing_policies:
-            logger.info("Creating {}".format(policy))
-            client.query(policy_info[policy]["create"])
+            statements.append(Statement(
+                POLICY_CREATE, policy_info[policy]["create"],
+                "Creating {}".format(policy)
+            ))
         else:
-            current = existing_policies[policy]
-            desired = policy_info[policy]
-            if current["duration"] != desired["retention"]:
-                logger.info("Updating policy {}".format(policy))
-                client.query(desired["update"])
+            changes = policy_changes(
+                existing_policies[policy], policy_info[policy]
+            )
+            if changes:
+                statements.append(Statement(
+                    POLICY_CREATE,
+                    tpl.policy_update_query(
+                        policy_info[policy], db_config['database'],
+                        changes, name=policy
+                    ),
+                    "Updating policy {}: {}".format(
+                        policy, ' '.join(changes)
+                    )
+                ))
 
     for policy in existing_policies:
         if policy not in policy_info:
-            logger.info("Deleting policy {}".format(policy))
             query = "DROP RETENTION POLICY \"{}\" ON \"{}\"".format(
                 policy, db_config['database']
             )
-            client.query(query)
+            statements.append(Statement(
+                POLICY_DROP, query, "Deleting policy {}".format(policy)
+            ))
+
+    return statements
+
+
+def plan_queries(db_config, query_info, existing_index, matched,
+                 created=None, recreated=None):
+    """
+    Works out the statements needed to get the desired continuous queries
+    into place, one desired query at a time.
+
+    :param db_config: configuration dictionary for this database
+    :param query_info: Iterable of (query name, query info) tuples
+    :param existing_index: Digests of the existing queries by name
+    :param matched: Set the names of desired queries that exist are added to
+    :param created: List the (query name, query info) tuples of queries that
+                    do not exist yet are added to, if given
+    :param recreated: List the (query name, query info) tuples of queries
+                      re-created with changes are added to, if given
+    :return: Generator of Statement, in the order they must be applied
+    """
+    for query, desired in query_info:
+        if query not in existing_index:
+            if created is not None:
+                created.append((query, desired))
+            yield Statement(
+                QUERY_CREATE, desired["query"],
+                "Creating query {}".format(query)
+            )
+            continue
+
+        matched.add(query)
+        if existing_index[query] != query_digest(desired["query"]):
+            if recreated is not None:
+                recreated.append((query, desired))
+            yield Statement(
+                QUERY_DROP,
+                "DROP CONTINUOUS QUERY {} ON {}".format(
+                    query, db_config['database']
+                ),
+                "Re-Creating query {}".format(query)
+            )
+            yield Statement(
+                QUERY_CREATE, desired["query"],
+                "Creating query {}".format(query)
+            )
+
+
+def plan_retired_queries(db_config, existing_index, matched):
+    """
+    Works out the statements dropping the queries of the continuous query
+    layout not in use.
+
+    :param db_config: configuration dictionary for this database
+    :param existing_index: Digests of the existing queries by name
+    :param matched: Names of existing queries that are desired
+    :return: List of Statement
+    """
+    return [
+        Statement(
+            QUERY_RETIRE,
+            "DROP CONTINUOUS QUERY {} ON {}".format(
+                query, db_config['database']
+            ),
+            "Retiring query {}".format(query)
+        )
+        for query in retired_queries(db_config, existing_index, matched)
+    ]
+
+
+def plan_hibernated_queries(db_config, queries):
+    """
+    Works out the statements dropping the continuous queries of idle
+    measurements.
+
+    :param db_config: configuration dictionary for this database
+    :param queries: Names of the queries to drop, from hibernated_queries
+    :return: List of Statement
+    """
+    return [
+        Statement(
+            QUERY_RETIRE,
+            "DROP CONTINUOUS QUERY {} ON {}".format(
+                query, db_config['database']
+            ),
+            "Hibernating query {}".format(query)
+        )
+        for query in queries
+    ]
+
+
+def plan_orphaned_queries(db_config, existing_index, matched, shifts=()):
+    """
+    Works out the statements dropping the orphaned continuous queries, or
+    only reports them, as configured by orphaned_queries.
+    They are only reported when the measurements changed while they were
+    read, as the queries of measurements that were not listed look
+    orphaned.
+
+    :param db_config: configuration dictionary for this database
+    :param existing_index: Digests of the existing queries by name
+    :param matched: Names of existing queries that are desired
+    :param shifts: Offsets of the measurement pages that shifted, see
+                   iter_measurements
+    :return: List of Statement
+    """
+    mode = db_config.get('orphaned_queries', 'keep')
+    if mode == 'keep':
+        return []
+    if mode == 'drop' and shifts:
+        logger.warning(
+            "Measurements of {} changed while reading them, not dropping "
+            "orphaned queries".format(db_config['database'])
+        )
+        mode = 'report'
+
+    orphans = orphaned_queries(db_config, existing_index, matched)
+    if mode == 'report':
+        for query in orphans:
+            logger.warning("Orphaned query {} on {}".format(
+                query, db_config['database']
+            ))
+        return []
+
+    limit = db_config.get('max_orphan_drops', 100)
+    if len(orphans) > limit:
+        logger.warning(
+            "Found {} orphaned queries on {}, only dropping {}".format(
+                len(orphans), db_config['database'], limit
+            )
+        )
+    return [
+        Statement(
+            QUERY_RETIRE,
+            "DROP CONTINUOUS QUERY {} ON {}".format(
+                query, db_config['database']
+            ),
+            "Dropping orphaned query {}".format(query)
+        )
+        for query in orphans[:limit]
+    ]
+
+
+def plan_database(db_config, state):
+    """
+    Works out the statements needed to get a database into the desired state.
+
+    :param db_config: configuration dictionary for this database
+    :param state: Result of get_database_state
+    :return: List of Statement, in the order they must be applied
+    """
+    existing_policies, existing_queries, policy_info, query_info = state
+    existing_index = {
+        name: query_digest(query) for name, query in existing_queries.items()
+    }
+    matched = set()
+
+    statements = plan_policies(db_config, existing_policies, policy_info)
+    statements.extend(plan_queries(
+        db_config, query_info.items(), existing_index, matched
+    ))
+    statements.extend(
+        plan_retired_queries(db_config, existing_index, matched)
+    )
+    statements.extend(
+        plan_orphaned_queries(db_config, existing_index, matched)
+    )
+
+    return order_statements(statements)
+
+
+def read_measurements(client, db_config, idle, stats, tag_keys, seen=None,
+                      shifts=None):
+    """
+    Reads the measurements of a database lazily, along with what planning
+    needs to know about them.
+
+    :param client: Influx client (connection)
+    :param db_config: configuration dictionary for this database
+    :param idle: Set the hibernated measurements are added to
+    :param stats: Dictionary the stats of the measurements are added to,
+                  see cost.collect_stats
+    :param tag_keys: Dictionary the tag keys of the measurements are added
+                     to, see tags.collect_tag_keys
+    :param seen: Set the measurements read are added to, if given
+    :param shifts: List the offsets of the measurement pages that shifted
+                   are added to, see iter_measurements
+    :return: Generator of the names of the active measurements
+    """
+    measurements = iter_measurements(
+        client, config['measurement_page_size'], shifts
+    )
+    if seen is not None:
+        measurements = _record(measurements, seen)
+    measurements = filter_measurements(
+        client, db_config, measurements, idle, stats, tag_keys
+    )
+    return metrics.timed(measurements, 'read_measurements',
+                         count='measurements_total')
+
+
+def filter_measurements(client, db_config, measurements, idle, stats,
+                        tag_keys):
+    """
+    Leaves the idle measurements out, and reads the stats and tag keys of
+    the others in batches while they are iterated.
+
+    :param client: Influx client (connection)
+    :param db_config: configuration dictionary for this database
+    :param measurements: Iterable of measurement names, iterated lazily
+    :param idle: Set the hibernated measurements are added to
+    :param stats: Dictionary the stats of the measurements are added to
+    :param tag_keys: Dictionary the tag keys of the measurements are added
+                     to
+    :return: Generator of the names of the active measurements
+    """
+    measurements = active_measurements(client, db_config, measurements, idle)
+    measurements = collect_stats(client, db_config, measurements, stats)
+    return collect_tag_keys(client, db_config, measurements, tag_keys)
+
+
+def desired_queries(db_config, measurements, stats=None, tag_keys=None,
+                    refused=None):
+    """
+    Renders the desired continuous queries of measurements, leaving out
+    those over the cost budget of the database when it refuses them.
+
+    :param db_config: configuration dictionary for this database
+    :param measurements: Iterable of measurement names, iterated lazily
+    :param stats: Stats of the measurements, see cost.collect_stats, the
+                  budget is not checked if None
+    :param tag_keys: Tag keys of the measurements, see
+                     tags.collect_tag_keys
+    :param refused: Set the names of the refused queries are added to, if
+                    given
+    :return: Generator of (query name, query info) tuples
+    """
+    query_info = metrics.timed(
+        iter_query_info(db_config, measurements, tag_keys), 'render'
+    )
+    if stats is not None:
+        query_info = within_budget(db_config, query_info, stats, refused)
+    return query_info
 
-    for query in query_info:
-        if query not in existing_queries:
-            logger.info("Creating query {}".format(query))
-            client.query(query_info[query]["query"])
 
-    for query in existing_queries:
-        if query in query_info:
-            current = existing_queries[query]
-            desired = query_info[query]
-            if current != desired["query"]:
-                logger.info("Re-Creating query {}".format(query))
-                client.query(
-                    "DROP CONTINUOUS QUERY {} ON {}"
-                    "".format(query, db_config['database']))
-                client.query(desired["query"])
+def stream_database_plan(client, db_config, seen=None, created=None,
+                         recreated=None):
+    """
+    Works out the statements needed to get a database into the desired
+    state while reading the measurements page by page, only a compact index
+    of the existing queries is kept in memory.
+
+    :param client: Influx client (connection)
+    :param db_config: configuration dictionary for this database
+    :param seen: Set the measurements read are added to, if given
+    :param created: List the new queries are added to, see plan_queries
+    :param recreated: List the re-created queries are added to, see
+                      plan_queries
+    :return: Generator of Statement, in the order they must be applied
+    """
+    with metrics.span('read_state'):
+        existing_policies = {
+            p['name']: p
+            for p in client.query('SHOW RETENTION POLICIES').get_points()
+        }
+        existing_index = {
+            q['name']: query_digest(q['query'])
+            for q in client.query('SHOW CONTINUOUS QUERIES').get_points()
+        }
+
+    idle = set()
+    stats = {}
+    tag_keys = {}
+    shifts = []
+    measurements = read_measurements(
+        client, db_config, idle, stats, tag_keys, seen, shifts
+    )
+
+    return plan_from_state(
+        db_config, existing_policies, existing_index, measurements, idle,
+        created, stats, tag_keys, recreated, shifts
+    )
+
+
+def plan_from_state(db_config, existing_policies, existing_index,
+                    measurements, idle=(), created=None, stats=None,
+                    tag_keys=None, recreated=None, shifts=()):
+    """
+    Works out the statements needed to get a database into the desired
+    state, from the existing state however it was read.
+
+    :param db_config: configuration dictionary for this database
+    :param existing_policies: Existing policies by name
+    :param existing_index: Digests of the existing queries by name
+    :param measurements: Iterable of measurement names, iterated lazily
+    :param idle: Hibernated measurements, complete once measurements is
+                 exhausted
+    :param created: List the new queries are added to, see plan_queries
+    :param stats: Stats of the measurements for the cost budget, complete
+                  for every measurement once it is iterated
+    :param tag_keys: Tag keys of the measurements, complete for every
+                     measurement once it is iterated
+    :param recreated: List the re-created queries are added to, see
+                      plan_queries
+    :param shifts: Offsets of the measurement pages that shifted, see
+                   iter_measurements, complete once measurements is
+                   exhausted
+    :return: Generator of Statement, in the order they must be applied
+    """
+    matched = set()
+
+    policy_statements = order_statements(plan_policies(
+        db_config, existing_policies, get_policy_info(db_config)
+    ))
+    for statement in policy_statements:
+        if statement.phase == POLICY_CREATE:
+            yield statement
+
+    # Queries refused by the cost budget are not orphans, they are kept
+    # while they exist
+    refused = set()
+    query_info = desired_queries(
+        db_config, measurements, stats, tag_keys, refused
+    )
+
+    for statement in plan_queries(
+            db_config, query_info, existing_index, matched, created,
+            recreated):
+        yield statement
+
+    for statement in plan_retired_queries(db_config, existing_index, matched):
+        yield statement
+
+    hibernated = hibernated_queries(db_config, existing_index, matched, idle)
+    for statement in plan_hibernated_queries(db_config, hibernated):
+        yield statement
+
+    for statement in plan_orphaned_queries(
+            db_config, existing_index, matched.union(hibernated, refused),
+            shifts):
+        yield statement
+
+    for statement in policy_statements:
+        if statement.phase == POLICY_DROP:
+            yield statement
+
+
+def _record(items, seen):
+    """
+    Passes items through, adding them to a set.
+    """
+    for item in items:
+        seen.add(item)
+        yield item
+
+
+def retired_queries(db_config, existing_queries, desired_queries):
+    """
+    Finds the existing continuous queries belonging to the layout not in
+    use, they are dropped after the queries replacing them are created.
+
+    :param db_config: configuration dictionary for this database
+    :param existing_queries: Names of the existing queries
+    :param desired_queries: Names of the desired queries, at least those
+                            that exist
+    :return: List of query names
+    """
+    if db_config.get('continuous_query_mode') == WILDCARD:
+        patterns = [
+            tpl.continuous_query_pattern(policy)
+            for policy in db_config['desired_policies']
+        ]
+    else:
+        patterns = [
+            tpl.wildcard_query_pattern(policy)
+            for policy in db_config['desired_policies']
+        ]
+
+    return [
+        query for query in existing_queries
+        if query not in desired_queries
+        and any(pattern.match(query) for pattern in patterns)
+    ]
+
+
+def hibernated_queries(db_config, existing_queries, desired_queries, idle):
+    """
+    Finds the existing continuous queries of idle measurements.
+
+    :param db_config: configuration dictionary for this database
+    :param existing_queries: Names of the existing queries
+    :param desired_queries: Names of the desired queries, at least those
+                            that exist
+    :param idle: Names of the idle measurements
+    :return: List of query names
+    """
+    return [
+        query
+        for measurement in sorted(idle)
+        for query in [
+            tpl.continuous_query_name(policy, measurement)
+            for policy in db_config['desired_policies']
+        ]
+        if query in existing_queries and query not in desired_queries
+    ]
+
+
+def orphaned_queries(db_config, existing_queries, desired_queries):
+    """
+    Finds the existing continuous queries made by the templates that are
+    not desired, and are not retired with the layout not in use.
+
+    :param db_config: configuration dictionary for this database
+    :param existing_queries: Names of the existing queries
+    :param desired_queries: Names of the desired queries, at least those
+                            that exist
+    :return: Sorted list of query names
+    """
+    retired = set(
+        retired_queries(db_config, existing_queries, desired_queries)
+    )
+    return sorted(tpl.owned_queries(
+        db_config['desired_policies'],
+        (query for query in existing_queries
+         if query not in desired_queries and query not in retired)
+    ))
+
+
+def process_database(db_config, cache=None, pool=None, backfill=None):
+    """
+    Handles the policy+query management for one database.
+
+    :param db_config:
+    :param cache: StateCache, databases unchanged since they were last
+                  found in the desired state are skipped
+    :param pool: ClientPool to get the client from, a client of its own is
+                 created for the database if not given
+    :param backfill: BackfillQueue the new queries are queued in, if given
+    :return:
+    """
+    if pool is not None:
+        client = pool.client(db_config)
+    else:
+        client = InfluxDBClient(
+            host=db_config['host'],
+            database=db_config['database'],
+            port=db_config['port']
+        )
+
+    reconcile_database(client, db_config, cache, backfill=backfill)
+
+
+def reconcile_database(client, db_config, cache=None, seen=None,
+                       backfill=None):
+    """
+    Gets one database into the desired state.
+
+    :param client: Influx client (connection)
+    :param db_config: configuration dictionary for this database
+    :param cache: StateCache, see process_database
+    :param seen: Set the measurements of the database are added to, if given
+    :param backfill: BackfillQueue the new queries are queued in, if given
+    :return: Number of requests applying changes
+    """
+    client = metrics.instrument(client)
+    with metrics.span('plan'):
+        return _reconcile_database(client, db_config, cache, seen, backfill)
+
+
+def _reconcile_database(client, db_config, cache, seen, backfill):
+    if cache is not None:
+        key = cache.key(db_config)
+        with metrics.span('fingerprint'):
+            fingerprint = state_fingerprint(client, db_config)
+        if cache.is_fresh(key, fingerprint):
+            logger.info("{} is unchanged, skipping".format(key))
+            metrics.inc('databases_skipped_total',
+                        help='Databases unchanged since they were last '
+                             'found in the desired state')
+            return 0
+
+    created = []
+    recreated = []
+    requests = apply_statements(
+        client,
+        stream_database_plan(client, db_config, seen, created, recreated),
+        in_order=True,
+        **apply_options(db_config)
+    )
+    metrics.inc('queries_created_total', len(created),
+                help='Continuous queries created')
+    metrics.inc('queries_recreated_total', len(recreated),
+                help='Continuous queries re-created with changes')
+    with metrics.span('report'):
+        report_cardinality(client, db_config, created + recreated)
+    if backfill is not None:
+        backfill.add(db_config, created)
+
+    # Only a database that needed no changes is in the state fingerprinted,
+    # after changes the next run fingerprints the new state.
+    if cache is not None and not requests:
+        cache.update(key, fingerprint)
+
+    return requests
+
+
+def run_isolated(db_configs, handler, workers=1, workers_per_host=1):
+    """
+    Runs a handler for several databases concurrently. Every database is
+    isolated, an error in one database is logged and reported in the
+    result, but does not stop the others.
+
+    :param db_configs: List of dictionaries with the host, port and
+                       database
+    :param handler: Called with each dictionary
+    :param workers: Number of databases handled at the same time
+    :param workers_per_host: Number of databases handled at the same time
+                             on the same host:port
+    :return: List of DatabaseResult, in the same order as db_configs
+    """
+    # Databases wait in a queue per host, so a worker only takes a database
+    # whose host has a free place, and never waits for one while databases
+    # of other hosts could run
+    pending = OrderedDict()
+    for index, db_config in enumerate(db_configs):
+        pending.setdefault(
+            (db_config['host'], db_config['port']), deque()
+        ).append((index, db_config))
+    running = dict.fromkeys(pending, 0)
+    changed = threading.Condition()
+    results = [None] * len(db_configs)
+
+    def take():
+        with changed:
+            while pending:
+                for host, queue in pending.items():
+                    if running[host] < max(workers_per_host, 1):
+                        running[host] += 1
+                        index, db_config = queue.popleft()
+                        if not queue:
+                            del pending[host]
+                        return host, index, db_config
+                changed.wait()
+            return None
+
+    def run(db_config):
+        start = time.time()
+        error = None
+        try:
+            handler(db_config)
+        except Exception as e:
+            logger.exception("Failed processing {} on {}:{}".format(
+                db_config['database'], db_config['host'], db_config['port']
+            ))
+            error = e
+        metrics.inc('databases_total', help='Databases processed',
+                    result='failed' if error else 'ok')
+        metrics.observe('database_seconds', time.time() - start,
+                        help='Time processing a database')
+        return DatabaseResult(
+            host=db_config['host'],
+            port=db_config['port'],
+            database=db_config['database'],
+            error=error,
+            duration=time.time() - start
+        )
+
+    def work():
+        while True:
+            taken = take()
+            if taken is None:
+                return
+            host, index, db_config = taken
+            try:
+                results[index] = run(db_config)
+            finally:
+                with changed:
+                    running[host] -= 1
+                    changed.notify_all()
+
+    workers = min(max(workers, 1), max(len(db_configs), 1))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(work) for _ in range(workers)]:
+            future.result()
+    return results
+
+
+def process_databases(db_configs, workers=1, workers_per_host=1,
+                      cache=None, pool_size=10, backfill=None):
+    """
+    Handles the policy+query management for several databases concurrently.
+    Every database is isolated, an error in one database is logged and
+    reported in the result, but does not stop the processing of the others.
+
+    :param db_configs: List of database configuration dictionaries
+    :param workers: Number of databases processed at the same time
+    :param workers_per_host: Number of databases processed at the same time
+                             on the same host:port
+    :param cache: StateCache, see process_database
+    :param pool_size: Connections kept open per host:port, shared by the
+                      databases on it
+    :param backfill: BackfillQueue the new queries are queued in, and run
+                     from once all databases are processed, if given
+    :return: List of DatabaseResult, in the same order as db_configs
+    """
+    with ClientPool(InfluxDBClient, pool_size) as pool:
+        results = run_isolated(
+            db_configs,
+            lambda db_config: process_database(
+                db_config, cache, pool, backfill
+            ),
+            workers, workers_per_host
+        )
+
+        if backfill is not None and backfill.entries:
+            settings = config['backfill']
+            with metrics.span('backfill'):
+                failed = run_backfill(
+                    backfill, pool,
+                    workers=settings['workers'],
+                    workers_per_host=settings['workers_per_host'],
+                    pause=parse_duration(settings['pause']) / SECOND
+                )
+            if failed:
+                logger.error("{} backfills failed, they resume from the "
+                             "checkpoint on the next run".format(failed))
+
+    return results
+
+
+def log_summary(results):
+    """
+    Logs a summary of a run over several databases.
+
+    :param results: List of DatabaseResult
+    """
+    for result in results:
+        logger.info("{}:{}/{}: {} in {:.2f}s".format(
+            result.host, result.port, result.database,
+            "failed ({})".format(result.error) if result.error else "ok",
+            result.duration
+        ))
+    failed = sum(1 for result in results if result.error)
+    logger.info("Processed {} databases, {} failed".format(
+        len(results), failed
+    ))
+
+
+def main(argv=None):
+    """
+    Command line entry point, processes all configured databases.
+
+    :param argv: Command line arguments, defaults to sys.argv
+    :return: Exit code
+    """
+    # The configuration is loaded first, the defaults of the other arguments
+    # come from it
+    config_parser = argparse.ArgumentParser(add_help=False)
+    config_parser.add_argument(
+        '-c', '--config', metavar='PATH', action='append',
+        help='Configuration file, or directory of .yaml files, overriding '
+             'the defaults; may be given several times, later ones override '
+             'earlier ones'
+    )
+    config_parser.add_argument(
+        '--config-cache', metavar='PATH',
+        default=os.environ.get(conf.CACHE_ENV, conf.default_cache_path()),
+        help='File the compiled configuration is cached in while the '
+             'configuration files are unchanged, empty to disable'
+    )
+    config_args, _ = config_parser.parse_known_args(argv)
+    if config_args.config:
+        try:
+            conf.load(config_args.config, config_args.config_cache)
+        except conf.ConfigError as e:
+            config_parser.error(str(e))
+
+    parser = argparse.ArgumentParser(
+        description='Manages InfluxDB retention policies and continuous '
+                    'queries for graduated series',
+        parents=[config_parser]
+    )
+    parser.add_argument(
+        '-j', '--workers', type=int,
+        default=config['concurrency']['workers'],
+        help='Number of databases processed at the same time'
+    )
+    parser.add_argument(
+        '--workers-per-host', type=int,
+        default=config['concurrency']['workers_per_host'],
+        help='Number of databases processed at the same time on one host'
+    )
+    parser.add_argument(
+        '--state-cache', default=config['state_cache']['path'],
+        help='File remembering databases found in the desired state, '
+             'unchanged databases are skipped'
+    )
+    parser.add_argument(
+        '--invalidate-cache', action='store_true',
+        help='Forget all databases in the state cache before running'
+    )
+    parser.add_argument(
+        '--backfill', action='store_true',
+        help='Fill new continuous queries with the existing data, resuming '
+             'interrupted backfills from the checkpoint file'
+    )
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help='Keep running, polling the databases for new measurements'
+    )
+    parser.add_argument(
+        '--async', dest='use_async', action='store_true',
+        help='Use the asyncio engine, for many servers (requires aiohttp)'
+    )
+    parser.add_argument(
+        '--snapshot', metavar='PATH',
+        help='Save what the databases plans are compiled from to PATH, '
+             'instead of applying changes'
+    )
+    parser.add_argument(
+        '--from-snapshot', metavar='PATH',
+        help='Compile the plans from a snapshot instead of the servers, '
+             'without applying them'
+    )
+    parser.add_argument(
+        '--export', metavar='PATH',
+        help='Export the plans to PATH instead of applying them, as JSON if '
+             'PATH ends with .json, as influx -import scripts otherwise'
+    )
+    parser.add_argument(
+        '--apply-plan', metavar='PATH',
+        help='Apply a plan exported as JSON'
+    )
+    parser.add_argument(
+        '--verify', action='store_true',
+        help='Check that the continuous queries write what they should over '
+             'sampled windows of time, reporting gaps and mismatches'
+    )
+    parser.add_argument(
+        '--repair', action='store_true',
+        help='Verify, and backfill the windows with gaps or mismatches'
+    )
+    parser.add_argument(
+        '--seed', type=int,
+        help='Seed of the sampling of --verify, for repeatable checks'
+    )
+    parser.add_argument(
+        '--rollup', metavar='PATH',
+        help='Build the rollups of the desired policies from a line protocol '
+             'file, like influx_inspect export writes (requires numpy)'
+    )
+    parser.add_argument(
+        '--rollup-output', metavar='PATH',
+        help='File the rollups are written to, for influx -import, next to '
+             'the input file by default'
+    )
+    parser.add_argument(
+        '--rollup-database', metavar='NAME',
+        help='Configured database the points of the file belong to, when '
+             'several are configured'
+    )
+    parser.add_argument(
+        '--precision', default='ns', choices=['ns', 'u', 'ms', 's', 'm', 'h'],
+        help='Precision of the timestamps of the line protocol file'
+    )
+    parser.add_argument(
+        '--metrics-file', metavar='PATH',
+        default=config['metrics']['textfile'],
+        help='Write the metrics of the run to PATH in the Prometheus text '
+             'format, for the node_exporter textfile collector'
+    )
+    parser.add_argument(
+        '--profile', metavar='PATH',
+        help='Profile the run with cProfile, dumping the stats to PATH'
+    )
+    parser.add_argument(
+        '--trace-memory', metavar='PATH',
+        help='Trace the memory allocations of the run, writing the peak '
+             'and the largest allocation sites to PATH'
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    start = time.time()
+    with ExitStack() as stack:
+        if args.profile:
+            stack.enter_context(metrics.profile(args.profile))
+        if args.trace_memory:
+            stack.enter_context(metrics.trace_memory(args.trace_memory))
+        code = run_command(args)
+
+    metrics.set_gauge('last_run_timestamp_seconds', time.time(),
+                      help='End of the last run')
+    metrics.set_gauge('last_run_duration_seconds', time.time() - start,
+                      help='Time the last run took')
+    metrics.set_gauge('last_run_success', int(code == 0),
+                      help='1 if the last run succeeded')
+    if args.metrics_file:
+        metrics.write_textfile(args.metrics_file)
+    return code
+
+
+def run_command(args):
+    """
+    Runs what the command line arguments ask for.
+
+    :param args: Parsed command line arguments
+    :return: Exit code
+    """
+    # The configuration is read-only, the databases get copies of their own
+    db_configs = conf.thaw(config['configs'])
+
+    if args.apply_plan:
+        from influxdb_aggregation import plan
+        journal = None
+        if config['apply']['journal']:
+            journal = ApplyJournal(config['apply']['journal'])
+        with ClientPool(InfluxDBClient, config['connection_pool_size']) \
+                as pool:
+            results = plan.apply_plan(
+                plan.load_plan(args.apply_plan), pool,
+                workers=args.workers,
+                workers_per_host=args.workers_per_host,
+                journal=journal
+            )
+        log_summary(results)
+        return 1 if any(result.error for result in results) else 0
+
+    if args.verify or args.repair:
+        from influxdb_aggregation import verify
+        settings = config['verify']
+        with ClientPool(InfluxDBClient, config['connection_pool_size']) \
+                as pool:
+            return verify.run(
+                db_configs, pool,
+                fix=args.repair,
+                seed=args.seed,
+                workers=settings['workers'],
+                workers_per_host=settings['workers_per_host']
+            )
+
+    if args.rollup:
+        from influxdb_aggregation import rollup
+        return rollup.run(
+            db_configs, args.rollup,
+            output=args.rollup_output,
+            database=args.rollup_database,
+            precision=args.precision
+        )
+
+    if args.snapshot or args.from_snapshot or args.export:
+        from influxdb_aggregation import plan
+        return plan.run_offline(
+            db_configs,
+            snapshot=args.snapshot,
+            from_snapshot=args.from_snapshot,
+            export=args.export,
+            workers=args.workers
+        )
+
+    if args.use_async:
+        from influxdb_aggregation import aio
+        settings = config['async_engine']
+        results = aio.run(
+            db_configs,
+            concurrency=settings['concurrency'],
+            per_host=settings['per_host'],
+            timeout=parse_duration(settings['timeout']) / SECOND,
+            request_timeout=(
+                parse_duration(settings['request_timeout']) / SECOND
+            )
+        )
+        log_summary(results)
+        return 1 if any(result.error for result in results) else 0
+
+    if args.daemon:
+        from influxdb_aggregation.daemon import run_daemon
+        if config['metrics']['port'] is not None:
+            metrics.serve_metrics(config['metrics']['port'],
+                                  config['metrics']['address'])
+        run_daemon(db_configs, workers=args.workers)
+        return 0
+
+    cache = None
+    if args.state_cache:
+        cache = StateCache(
+            args.state_cache,
+            parse_duration(config['state_cache']['ttl']) / SECOND
+        )
+        if args.invalidate_cache:
+            cache.invalidate()
+
+    backfill = None
+    if args.backfill:
+        backfill = BackfillQueue(config['backfill']['checkpoint'])
+
+    results = process_databases(
+        db_configs,
+        workers=args.workers,
+        workers_per_host=args.workers_per_host,
+        cache=cache,
+        pool_size=config['connection_pool_size'],
+        backfill=backfill
+    )
+    log_summary(results)
+
+    return 1 if any(result.error for result in results) else 0
 
 
 if __name__ == '__main__':
-    for db_config in config['configs']:
-        process_database(db_config)
+    sys.exit(main())
@@ -0,0 +1,449 @@
+import cProfile
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+__all__ = ['PREFIX', 'BUCKETS', 'Registry', 'registry', 'inc', 'observe',
+           'set_gauge', 'span', 'timed', 'statement_type',
+           'InstrumentedClient', 'instrument', 'write_textfile',
+           'serve_metrics', 'profile', 'trace_memory']
+
+# Metrics of the runs, kept in a registry for the whole process and
+# exported in the Prometheus text format, to a file for the node_exporter
+# textfile collector or on /metrics with --daemon.
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'influx_aggregation_'
+
+# Upper bounds in seconds of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           300)
+
+# Statement types by the start of the statement, most specific first
+STATEMENT_TYPES = [
+    (re.compile(r'^SHOW\s+RETENTION\s+POLICIES', re.I), 'show_policies'),
+    (re.compile(r'^SHOW\s+CONTINUOUS\s+QUERIES', re.I), 'show_queries'),
+    (re.compile(r'^SHOW\s+MEASUREMENTS', re.I), 'show_measurements'),
+    (re.compile(r'^SHOW\s+TAG\s+KEYS', re.I), 'show_tag_keys'),
+    (re.compile(r'^SHOW\s+SERIES', re.I), 'show_series'),
+    (re.compile(r'^SELECT\b.*\bINTO\b', re.I | re.S), 'select_into'),
+    (re.compile(r'^SELECT\b', re.I), 'select'),
+    (re.compile(r'^(CREATE|ALTER|DROP)\s+RETENTION\s+POLICY', re.I),
+     '{}_policy'),
+    (re.compile(r'^(CREATE|DROP)\s+CONTINUOUS\s+QUERY', re.I), '{}_query'),
+]
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    ))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry(object):
+    """
+    Counters, gauges and histograms by name and labels, shared by the
+    threads of the process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """
+        Forgets all metrics.
+        """
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+            self.help = {}
+
+    def inc(self, name, value=1, help=None, **labels):
+        """
+        Increments a counter.
+
+        :param name: Name of the metric, without the prefix
+        :param value: Amount added
+        :param help: Description of the metric
+        :param labels: Labels of the series
+        """
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            key = _labels(labels)
+            series[key] = series.get(key, 0) + value
+            if help:
+                self.help[name] = help
+
+    def set_gauge(self, name, value, help=None, **labels):
+        """
+        Sets a gauge, see inc.
+        """
+        with self.lock:
+            self.gauges.setdefault(name, {})[_labels(labels)] = value
+            if help:
+                self.help[name] = help
+
+    def observe(self, name, value, help=None, **labels):
+        """
+        Adds an observation to a histogram, see inc.
+        """
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            key = _labels(labels)
+            if key not in series:
+                series[key] = dict(buckets=[0] * len(BUCKETS), sum=0.0,
+                                   count=0)
+            histogram = series[key]
+            for index, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+            if help:
+                self.help[name] = help
+
+    def value(self, name, **labels):
+        """
+        :return: Value of a counter or gauge, the count of a histogram,
+                 None if it has no such series
+        """
+        key = _labels(labels)
+        with self.lock:
+            for metrics in [self.counters, self.gauges]:
+                if key in metrics.get(name, {}):
+                    return metrics[name][key]
+            histogram = self.histograms.get(name, {}).get(key)
+        return histogram['count'] if histogram is not None else None
+
+    def render(self):
+        """
+        :return: The metrics in the Prometheus text format
+        """
+        lines = []
+        with self.lock:
+            for kind, metrics in [('counter', self.counters),
+                                  ('gauge', self.gauges),
+                                  ('histogram', self.histograms)]:
+                for name, series in sorted(metrics.items()):
+                    full_name = PREFIX + name
+                    if name in self.help:
+                        lines.append('# HELP {} {}'.format(
+                            full_name, self.help[name]
+                        ))
+                    lines.append('# TYPE {} {}'.format(full_name, kind))
+                    for labels, value in sorted(series.items()):
+                        if kind != 'histogram':
+                            lines.append('{}{} {}'.format(
+                                full_name, _format_labels(labels),
+                                _format_value(value)
+                            ))
+                            continue
+                        for bound, count in zip(BUCKETS + (float('inf'),),
+                                                value['buckets'] +
+                                                [value['count']]):
+                            lines.append('{}_bucket{} {}'.format(
+                                full_name,
+                                _format_labels(
+                                    labels, [('le', _format_value(bound))]
+                                ),
+                                count
+                            ))
+                        lines.append('{}_sum{} {}'.format(
+                            full_name, _format_labels(labels),
+                            _format_value(value['sum'])
+                        ))
+                        lines.append('{}_count{} {}'.format(
+                            full_name, _format_labels(labels),
+                            value['count']
+                        ))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def inc(name, value=1, help=None, **labels):
+    """
+    Increments a counter of the process registry, see Registry.inc.
+    """
+    registry.inc(name, value, help, **labels)
+
+
+def set_gauge(name, value, help=None, **labels):
+    """
+    Sets a gauge of the process registry, see Registry.set_gauge.
+    """
+    registry.set_gauge(name, value, help, **labels)
+
+
+def observe(name, value, help=None, **labels):
+    """
+    Observes a histogram of the process registry, see Registry.observe.
+    """
+    registry.observe(name, value, help, **labels)
+
+
+_local = threading.local()
+
+
+def _enter():
+    """
+    Starts timing a phase on the stack of phases of the thread.
+
+    :return: Start time
+    """
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    _local.stack.append(0.0)
+    return time.time()
+
+
+def _leave(start):
+    """
+    Stops timing the innermost phase of the thread.
+
+    :param start: Start time, from _enter
+    :return: Seconds spent in the phase, without its nested phases
+    """
+    elapsed = time.time() - start
+    nested = _local.stack.pop()
+    if _local.stack:
+        _local.stack[-1] += elapsed
+    return elapsed - nested
+
+
+def _observe_phase(phase, seconds):
+    observe('phase_seconds', seconds,
+            help='Time spent in each phase of a run, without the phases '
+                 'nested in it',
+            phase=phase)
+
+
+@contextmanager
+def span(phase):
+    """
+    Times a phase of a run into the phase_seconds histogram, without the
+    time of the phases nested in it, so the phases of a run add up to its
+    time. An exception leaving it is counted in phase_errors_total.
+    Not to be used across the yields of a generator, see timed.
+
+    :param phase: Name of the phase
+    """
+    start = _enter()
+    try:
+        yield
+    except Exception:
+        inc('phase_errors_total', help='Phases that failed', phase=phase)
+        raise
+    finally:
+        _observe_phase(phase, _leave(start))
+
+
+def timed(items, phase, count=None):
+    """
+    Passes items through, timing the work done producing them as a phase,
+    see span, without the time the consumer spends between them.
+
+    :param items: Iterable
+    :param phase: Name of the phase
+    :param count: Name of a counter incremented by the number of items,
+                  if given
+    :return: Generator of the items
+    """
+    iterator = iter(items)
+    elapsed = 0.0
+    produced = 0
+    try:
+        while True:
+            start = _enter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += _leave(start)
+            produced += 1
+            yield item
+    finally:
+        _observe_phase(phase, elapsed)
+        if count is not None:
+            inc(count, produced)
+
+
+def statement_type(query):
+    """
+    :param query: InfluxQL statement, or statements
+    :return: Type of the first statement, like show_measurements or
+             create_query
+    """
+    query = query.lstrip()
+    for pattern, name in STATEMENT_TYPES:
+        match = pattern.match(query)
+        if match:
+            return name.format(*(g.lower() for g in match.groups()))
+    return 'other'
+
+
+class InstrumentedClient(object):
+    """
+    Wraps an Influx client, timing every request by the type of its first
+    statement.
+    """
+
+    def __init__(self, client):
+        """
+        :param client: Influx client (connection)
+        """
+        self.client = client
+
+    def query(self, query, *args, **kwargs):
+        """
+        Runs a query, see InfluxDBClient.query.
+        """
+        kind = statement_type(query)
+        start = time.time()
+        try:
+            return self.client.query(query, *args, **kwargs)
+        except Exception:
+            inc('request_errors_total', help='Requests that failed',
+                type=kind)
+            raise
+        finally:
+            observe('request_seconds', time.time() - start,
+                    help='Latency of the requests to InfluxDB, by the type '
+                         'of their first statement',
+                    type=kind)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def instrument(client):
+    """
+    :param client: Influx client (connection)
+    :return: The client wrapped in an InstrumentedClient, once
+    """
+    if isinstance(client, InstrumentedClient):
+        return client
+    return InstrumentedClient(client)
+
+
+def write_textfile(path):
+    """
+    Writes the metrics for the node_exporter textfile collector, replacing
+    the file atomically so it is never read half written.
+
+    :param path: Path of the file, ending with .prom
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'w') as textfile:
+            textfile.write(registry.render())
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve_metrics(port, address=''):
+    """
+    Serves the metrics on /metrics from a thread of its own.
+
+    :param port: Port to listen on, 0 for any free port
+    :param address: Address to listen on, all addresses if empty
+    :return: The HTTP server, shutdown() stops it
+    """
+    server = _Server((address, port), _Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving metrics on port {}".format(server.server_port))
+    return server
+
+
+@contextmanager
+def profile(path):
+    """
+    Profiles the block with cProfile, the stats are dumped to a file to
+    be read with pstats or snakeviz.
+
+    :param path: Path of the stats file
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        logger.info("Wrote the profile to {}".format(path))
+
+
+@contextmanager
+def trace_memory(path, top=50):
+    """
+    Traces the allocations of the block, the peak and the sites allocating
+    the most memory still in use at its end are written to a file.
+
+    :param path: Path of the report
+    :param top: Number of allocation sites reported
+    """
+    tracemalloc.start(25)
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        with open(path, 'w') as report:
+            report.write('Peak: {:.1f} MiB\n\n'.format(peak / 2.0 ** 20))
+            for stat in snapshot.statistics('lineno')[:top]:
+                report.write('{}\n'.format(stat))
+        logger.info("Wrote the memory trace to {}".format(path))
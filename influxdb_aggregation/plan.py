@@ -0,0 +1,364 @@
+import json
+import logging
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from influxdb import InfluxDBClient
+
+from influxdb_aggregation import conf, main
+from influxdb_aggregation.apply import (
+    Statement, apply_options, apply_statements
+)
+from influxdb_aggregation.cache import save_json
+from influxdb_aggregation.conf import config
+from influxdb_aggregation.pool import ClientPool
+
+__all__ = ['FORMAT_VERSION', 'database_key', 'snapshot_database',
+           'snapshot_databases', 'save_snapshot', 'load_snapshot',
+           'compile_plan', 'compile_plans', 'statement_line', 'render_iql',
+           'export_iql', 'export_json', 'export_plans', 'load_plan',
+           'apply_plan', 'run_offline']
+
+# Plans are compiled without a server from a snapshot of what the SHOW
+# statements return, and exported for review or to be applied later, by
+# this tool or with influx -import.
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+
+def database_key(db_config):
+    """
+    :param db_config: configuration dictionary for a database, or a
+                      snapshot or plan of one
+    :return: host:port/database
+    """
+    return '{}:{}/{}'.format(
+        db_config['host'], db_config['port'], db_config['database']
+    )
+
+
+def snapshot_database(client, db_config):
+    """
+    Reads everything a plan of the database is compiled from.
+
+    :param client: Influx client (connection)
+    :param db_config: configuration dictionary for this database
+    :return: Snapshot dictionary, JSON serializable
+    """
+    policies = list(client.query('SHOW RETENTION POLICIES').get_points())
+    queries = {
+        q['name']: q['query']
+        for q in client.query('SHOW CONTINUOUS QUERIES').get_points()
+    }
+    idle = set()
+    stats = {}
+    tag_keys = {}
+    shifts = []
+    measurements = list(main.read_measurements(
+        client, db_config, idle, stats, tag_keys, shifts=shifts
+    ))
+    return dict(
+        host=db_config['host'],
+        port=db_config['port'],
+        database=db_config['database'],
+        time=time.time(),
+        policies=policies,
+        queries=queries,
+        measurements=measurements,
+        idle=sorted(idle),
+        stats=stats,
+        tag_keys=tag_keys,
+        shifts=shifts
+    )
+
+
+def snapshot_databases(db_configs, pool, workers=1):
+    """
+    Snapshots several databases concurrently, a database that fails is
+    logged and left out.
+
+    :param db_configs: List of database configuration dictionaries
+    :param pool: ClientPool the clients are taken from
+    :param workers: Number of databases read at the same time
+    :return: Dictionary of snapshots by database_key
+    """
+    def run(db_config):
+        try:
+            return snapshot_database(pool.client(db_config), db_config)
+        except Exception:
+            logger.exception("Failed reading {}".format(
+                database_key(db_config)
+            ))
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        snapshots = list(executor.map(run, db_configs))
+    return {
+        database_key(snapshot): snapshot
+        for snapshot in snapshots if snapshot is not None
+    }
+
+
+def save_snapshot(path, snapshots):
+    """
+    :param path: Path of the snapshot file
+    :param snapshots: Dictionary of snapshots by database_key
+    """
+    save_json(path, dict(version=FORMAT_VERSION, databases=snapshots))
+
+
+def _load(path, kind):
+    with open(path) as data_file:
+        data = json.load(data_file)
+    if not isinstance(data, dict) or data.get('version') != FORMAT_VERSION:
+        raise ValueError("{} is not a {} of version {}".format(
+            path, kind, FORMAT_VERSION
+        ))
+    return data['databases']
+
+
+def load_snapshot(path):
+    """
+    :param path: Path of the snapshot file
+    :return: Dictionary of snapshots by database_key
+    :raises ValueError: If the file is not a snapshot
+    """
+    return _load(path, 'snapshot')
+
+
+def compile_plan(db_config, snapshot):
+    """
+    Works out the statements needed to get a database into the desired
+    state from a snapshot, without a server.
+
+    :param db_config: configuration dictionary for this database, the
+                      snapshot should be taken with the same configuration
+    :param snapshot: Snapshot of the database, see snapshot_database
+    :return: List of Statement, in the order they must be applied
+    """
+    return list(main.plan_from_state(
+        db_config,
+        {policy['name']: policy for policy in snapshot['policies']},
+        {
+            name: main.query_digest(query)
+            for name, query in snapshot['queries'].items()
+        },
+        snapshot['measurements'],
+        set(snapshot['idle']),
+        stats=snapshot['stats'],
+        tag_keys=snapshot['tag_keys'],
+        shifts=snapshot.get('shifts', ())
+    ))
+
+
+def _load_config(data):
+    # Worker processes are not always forked from this one, and then do
+    # not inherit its configuration
+    conf.config.replace(data)
+
+
+def _compile(item):
+    db_config, snapshot = item
+    return dict(
+        host=db_config['host'],
+        port=db_config['port'],
+        database=db_config['database'],
+        statements=[
+            statement._asdict()
+            for statement in compile_plan(db_config, snapshot)
+        ]
+    )
+
+
+def compile_plans(db_configs, snapshots, workers=1):
+    """
+    Compiles the plans of several databases, in processes of their own when
+    there are several workers, as compiling is bound by the CPU.
+
+    :param db_configs: List of database configuration dictionaries
+    :param snapshots: Dictionary of snapshots by database_key, databases
+                      without a snapshot are logged and left out
+    :param workers: Number of plans compiled at the same time
+    :return: Plan dictionary, JSON serializable
+    """
+    items = []
+    for db_config in db_configs:
+        snapshot = snapshots.get(database_key(db_config))
+        if snapshot is None:
+            logger.error("No snapshot of {}, not planned".format(
+                database_key(db_config)
+            ))
+            continue
+        items.append((db_config, snapshot))
+
+    if workers > 1 and len(items) > 1:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_load_config,
+                                 initargs=(config.copy(),)) as executor:
+            databases = list(executor.map(_compile, items))
+    else:
+        databases = [_compile(item) for item in items]
+    return dict(version=FORMAT_VERSION, databases=databases)
+
+
+def statement_line(query):
+    """
+    Joins the lines of a statement, influx -import runs one per line.
+
+    :param query: Statement
+    :return: Statement on one line
+    """
+    return re.sub(r'\s*\n\s*', ' ', query.strip())
+
+
+def render_iql(databases):
+    """
+    Renders the plans of databases as a script for influx -import.
+
+    :param databases: List of database plans, see compile_plans
+    :return: Script
+    """
+    lines = ['# DDL']
+    for database in databases:
+        lines.append('# {}'.format(database_key(database)))
+        for statement in database['statements']:
+            lines.append('# {}'.format(statement['description']))
+            lines.append(statement_line(statement['query']))
+    return '\n'.join(lines) + '\n'
+
+
+def export_iql(path, plan):
+    """
+    Writes a plan as influx -import scripts, one per server as a script
+    runs against a single server. With several servers, their host and
+    port are added to the file name, before the extension.
+
+    :param path: Path of the script
+    :param plan: Plan dictionary, see compile_plans
+    :return: List of the paths written
+    """
+    servers = {}
+    for database in plan['databases']:
+        servers.setdefault(
+            (database['host'], database['port']), []
+        ).append(database)
+
+    paths = []
+    for (host, port), databases in sorted(servers.items()):
+        server_path = path
+        if len(servers) > 1:
+            root, extension = os.path.splitext(path)
+            server_path = '{}.{}_{}{}'.format(root, host, port, extension)
+        with open(server_path, 'w') as script:
+            script.write(render_iql(databases))
+        paths.append(server_path)
+    return paths
+
+
+def export_json(path, plan):
+    """
+    :param path: Path of the plan file
+    :param plan: Plan dictionary, see compile_plans
+    :return: List of the paths written
+    """
+    save_json(path, plan)
+    return [path]
+
+
+def export_plans(path, plan):
+    """
+    Writes a plan, as JSON if the path ends with .json, as influx -import
+    scripts otherwise.
+
+    :param path: Path of the plan
+    :param plan: Plan dictionary, see compile_plans
+    :return: List of the paths written
+    """
+    if path.endswith('.json'):
+        return export_json(path, plan)
+    return export_iql(path, plan)
+
+
+def load_plan(path):
+    """
+    :param path: Path of a JSON plan
+    :return: List of database plans
+    :raises ValueError: If the file is not a plan
+    """
+    return _load(path, 'plan')
+
+
+def apply_plan(databases, pool, workers=1, workers_per_host=1,
+               journal=None):
+    """
+    Applies compiled plans, statements as they were planned. A database
+    that fails is logged and reported in the result, the others are still
+    applied.
+
+    :param databases: List of database plans, see compile_plans
+    :param pool: ClientPool the clients are taken from
+    :param workers: Number of databases applied at the same time
+    :param workers_per_host: Number of databases applied at the same time
+                             on the same host:port
+    :param journal: ApplyJournal, the same plan applied again after a
+                    failure skips the statements already applied, if given
+    :return: List of DatabaseResult, in the same order as databases
+    """
+    def apply(database):
+        statements = [
+            Statement(**statement) for statement in database['statements']
+        ]
+        options = apply_options(database, journal)
+        if journal is not None:
+            options['key'] = journal.plan_key(options['key'], statements)
+            journal.start(options['key'])
+        apply_statements(
+            pool.client(database), statements, in_order=True, **options
+        )
+
+    return main.run_isolated(databases, apply, workers, workers_per_host)
+
+
+def run_offline(db_configs, snapshot=None, from_snapshot=None, export=None,
+                workers=1):
+    """
+    Snapshots databases and compiles their plans instead of applying them.
+
+    :param db_configs: List of database configuration dictionaries
+    :param snapshot: Path the snapshot is saved to, if given
+    :param from_snapshot: Path of a snapshot to compile from, the servers
+                          are read if not given
+    :param export: Path the plan is exported to, see export_plans. Plans
+                   compiled from a snapshot are written to the standard
+                   output as a script if not given
+    :param workers: Number of databases read or compiled at the same time
+    :return: Exit code
+    """
+    if from_snapshot:
+        snapshots = load_snapshot(from_snapshot)
+    else:
+        with ClientPool(InfluxDBClient, config['connection_pool_size']) \
+                as pool:
+            snapshots = snapshot_databases(db_configs, pool, workers)
+
+    if snapshot:
+        save_snapshot(snapshot, snapshots)
+        logger.info("Saved the snapshot of {} databases to {}".format(
+            len(snapshots), snapshot
+        ))
+
+    compiled = None
+    if export or from_snapshot:
+        compiled = compile_plans(db_configs, snapshots, workers)
+    if export:
+        for path in export_plans(export, compiled):
+            logger.info("Exported the plan to {}".format(path))
+    elif compiled is not None:
+        sys.stdout.write(render_iql(compiled['databases']))
+
+    planned = compiled['databases'] if compiled is not None else snapshots
+    return 0 if len(planned) == len(db_configs) else 1
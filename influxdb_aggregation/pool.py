@@ -0,0 +1,80 @@
+import threading
+
+__all__ = ['ClientPool', 'DatabaseClient']
+
+
+class DatabaseClient(object):
+    """
+    A client for one database sharing the connections of a pooled client,
+    the database is passed with every query.
+    """
+
+    def __init__(self, client, database):
+        """
+        :param client: Shared Influx client (connection)
+        :param database: Name of the database
+        """
+        self.client = client
+        self.database = database
+
+    def query(self, query, **kwargs):
+        """
+        Runs a query against the database, see InfluxDBClient.query.
+        """
+        kwargs.setdefault('database', self.database)
+        return self.client.query(query, **kwargs)
+
+    def close(self):
+        """
+        Does nothing, the connections belong to the pool.
+        """
+
+
+class ClientPool(object):
+    """
+    One client per host:port, shared by all databases on it so keep-alive
+    connections are reused. Closing the pool closes the clients.
+    """
+
+    def __init__(self, client_factory, pool_size=10):
+        """
+        :param client_factory: Creates a client from host, port and
+                               pool_size keyword arguments
+        :param pool_size: Connections kept open per host:port
+        """
+        self.client_factory = client_factory
+        self.pool_size = pool_size
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def client(self, db_config):
+        """
+        :param db_config: configuration dictionary for a database
+        :return: DatabaseClient for the database
+        """
+        key = (db_config['host'], db_config['port'])
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = self.client_factory(
+                    host=db_config['host'],
+                    port=db_config['port'],
+                    pool_size=self.pool_size
+                )
+            client = self.clients[key]
+        return DatabaseClient(client, db_config['database'])
+
+    def close(self):
+        """
+        Closes all clients of the pool.
+        """
+        with self.lock:
+            clients = list(self.clients.values())
+            self.clients.clear()
+        for client in clients:
+            client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
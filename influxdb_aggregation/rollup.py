@@ -0,0 +1,529 @@
+import gzip
+import logging
+import os
+import re
+import tempfile
+from array import array
+
+from influxdb_aggregation import main
+from influxdb_aggregation import templating as tpl
+from influxdb_aggregation.conf import config
+from influxdb_aggregation.durations import (
+    HOUR, MICROSECOND, MILLISECOND, MINUTE, SECOND, parse_duration
+)
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+__all__ = ['PRECISIONS', 'parse_line', 'parse_series', 'format_fields',
+           'RollupPolicy', 'Rollup', 'rollup_file', 'run']
+
+# Builds the rollups of the desired policies from a line protocol file,
+# like influx_inspect export writes, without a server. Points are parsed
+# into chunks, aggregated per series and rollup interval with NumPy, and
+# the partial aggregates are spilled to partition files by series. Each
+# partition is then combined and written on its own, so memory is bounded
+# by the chunk size, the size of one partition and the number of series,
+# not by the size of the input.
+#
+# The aggregates are those of the continuous query templates: the mean,
+# max and min of the value field, with the sum and count when rollups are
+# chained. Points are written at the start of their interval, like the
+# continuous queries write them.
+
+logger = logging.getLogger(__name__)
+
+# Policy the continuous queries read from
+INPUT_POLICY = 'input'
+
+# Nanoseconds per unit of the timestamps, like the precision of influx
+PRECISIONS = {
+    'ns': 1,
+    'u': MICROSECOND,
+    'ms': MILLISECOND,
+    's': SECOND,
+    'm': MINUTE,
+    'h': HOUR,
+}
+
+_context = re.compile(r'^#\s*CONTEXT-(DATABASE|RETENTION-POLICY):\s*(.*)$')
+_unescape = re.compile(r'\\(.)')
+
+# Partial aggregate of the points of a series in one rollup interval, for
+# one policy, as spilled to the partition files
+if np is not None:
+    PARTIAL = np.dtype([('policy', '<i8'), ('series', '<i8'),
+                        ('time', '<i8'), ('sum', '<f8'), ('count', '<i8'),
+                        ('max', '<f8'), ('min', '<f8')])
+
+
+def _split(text, separator):
+    """
+    Splits line protocol on a separator, except where it is escaped with a
+    backslash or inside a double quoted string.
+
+    :param text: Line or part of a line
+    :param separator: Character to split on
+    :return: List of the parts, still escaped
+    """
+    if '\\' not in text and '"' not in text:
+        return text.split(separator)
+    parts = []
+    start = 0
+    quoted = False
+    index = 0
+    while index < len(text):
+        character = text[index]
+        if character == '\\':
+            index += 1
+        elif character == '"':
+            quoted = not quoted
+        elif character == separator and not quoted:
+            parts.append(text[start:index])
+            start = index + 1
+        index += 1
+    parts.append(text[start:])
+    return parts
+
+
+def parse_line(line):
+    """
+    Parses the series key, value field and timestamp of a line protocol
+    point.
+
+    :param line: Line without the line end
+    :return: (series key, value, timestamp) tuple, None if the line has
+             no numeric value field or no timestamp
+    :raises ValueError: If the line is not line protocol
+    """
+    parts = _split(line, ' ')
+    if len(parts) != 3:
+        if len(parts) == 2:
+            return None
+        raise ValueError('Invalid line protocol: {!r}'.format(line))
+    key, fields, timestamp = parts
+    for field in _split(fields, ','):
+        name, _, value = field.partition('=')
+        if name != 'value':
+            continue
+        if value[-1:] in ('i', 'u'):
+            value = value[:-1]
+        try:
+            return key, float(value), int(timestamp)
+        except ValueError:
+            # Strings and booleans are not aggregated
+            return None
+    return None
+
+
+def parse_series(key):
+    """
+    Splits a series key into its measurement and tags.
+
+    :param key: Series key, like cpu,host=a,region=b
+    :return: Measurement name and sorted list of (tag key, escaped key=value)
+    """
+    parts = _split(key, ',')
+    tags = []
+    for tag in parts[1:]:
+        name = _split(tag, '=')[0]
+        tags.append((_unescape.sub(r'\1', name), tag))
+    return _unescape.sub(r'\1', parts[0]), parts[0], sorted(tags)
+
+
+def format_fields(mean, maximum, minimum, total=None, count=None):
+    """
+    Renders the fields the continuous query templates write.
+
+    :return: Fields of a line protocol point
+    """
+    fields = 'value={!r},max_value={!r},min_value={!r}'.format(
+        mean, maximum, minimum
+    )
+    if total is not None:
+        fields += ',sum_value={!r},count_value={}i'.format(total, count)
+    return fields
+
+
+def combine(partials):
+    """
+    Combines partial aggregates of the same policy, series and interval.
+
+    :param partials: PARTIAL array
+    :return: PARTIAL array sorted by policy, series and time, with one
+             record per policy, series and interval
+    """
+    if not len(partials):
+        return partials
+    order = np.lexsort(
+        (partials['time'], partials['series'], partials['policy'])
+    )
+    partials = partials[order]
+    keys = ('policy', 'series', 'time')
+    boundary = np.zeros(len(partials), dtype=bool)
+    boundary[0] = True
+    for key in keys:
+        boundary[1:] |= partials[key][1:] != partials[key][:-1]
+    starts = np.flatnonzero(boundary)
+
+    combined = np.empty(len(starts), dtype=PARTIAL)
+    for key in keys:
+        combined[key] = partials[key][starts]
+    combined['sum'] = np.add.reduceat(partials['sum'], starts)
+    combined['count'] = np.add.reduceat(partials['count'], starts)
+    combined['max'] = np.maximum.reduceat(partials['max'], starts)
+    combined['min'] = np.minimum.reduceat(partials['min'], starts)
+    return combined
+
+
+class RollupPolicy(object):
+    """
+    A desired policy, with the series it writes and the interval each
+    series of the input is aggregated into.
+    """
+
+    def __init__(self, db_config, policy, lineage):
+        """
+        :param db_config: configuration dictionary for this database
+        :param policy: Policy config dictionary
+        :param lineage: The policy and the policies it is chained from,
+                        whose tags it can keep
+        """
+        self.db_config = db_config
+        self.policy = policy
+        self.name = tpl.policy_name(policy)
+        self.rollup = parse_duration(policy['rollup'])
+        self.lineage = lineage
+        self.wildcard = db_config.get('continuous_query_mode') == main.WILDCARD
+        # Series written, and for every input series the series it is
+        # aggregated into and the offset of its intervals
+        self.series = {}
+        self.keys = []
+        self.mapping = array('q')
+        self.offsets = array('q')
+
+    def keeps(self, tag):
+        """
+        :param tag: Tag key
+        :return: True if the continuous query groups by the tag
+        """
+        for policy in self.lineage:
+            keep = policy.get('keep_tags')
+            if self.wildcard:
+                # Wildcard queries can only keep the tags of keep_tags
+                if keep is not None and (tag not in keep or tag in (
+                        policy.get('drop_tags') or ())):
+                    return False
+                continue
+            if keep is not None and tag not in keep:
+                return False
+            if tag in (policy.get('drop_tags') or ()):
+                return False
+        return True
+
+    def offset(self, measurement):
+        """
+        :param measurement: Measurement name
+        :return: GROUP BY time() offset of the query of the measurement,
+                 None if no query reads it
+        """
+        if not self.wildcard:
+            return main.stagger_offset(self.db_config, self.policy,
+                                       measurement)
+        for pattern in self.db_config['wildcard_partitions']:
+            if re.search(pattern, measurement):
+                return main.stagger_offset(self.db_config, self.policy,
+                                           pattern)
+        return None
+
+    def add_series(self, measurement, escaped, tags):
+        """
+        Maps a new input series to the series the policy writes.
+
+        :param measurement: Measurement name
+        :param escaped: Measurement name as escaped in the series key
+        :param tags: Sorted list of (tag key, escaped key=value)
+        """
+        offset = self.offset(measurement)
+        if offset is None:
+            self.mapping.append(-1)
+            self.offsets.append(0)
+            return
+        key = ','.join(
+            [escaped] + [tag for name, tag in tags if self.keeps(name)]
+        )
+        if key not in self.series:
+            self.series[key] = len(self.keys)
+            self.keys.append(key)
+        self.mapping.append(self.series[key])
+        self.offsets.append(offset)
+
+
+class Rollup(object):
+    """
+    Aggregates line protocol points into the rollups of the desired
+    policies of a database.
+    """
+
+    def __init__(self, db_config, directory, chunk_size, partitions,
+                 precision='ns'):
+        """
+        :param db_config: configuration dictionary for this database
+        :param directory: Directory the partition files are written to
+        :param chunk_size: Number of points aggregated at a time
+        :param partitions: Number of partition files
+        :param precision: Unit of the timestamps, see PRECISIONS
+        """
+        if np is None:
+            raise RuntimeError("The offline rollup requires numpy")
+        self.db_config = db_config
+        self.chunk_size = chunk_size
+        self.partitions = partitions
+        self.scale = PRECISIONS[precision]
+        self.chained = bool(db_config.get('chained_rollups')) and \
+            db_config.get('continuous_query_mode') != main.WILDCARD
+
+        if self.chained:
+            lineages = {}
+            chain = tpl.chain_policies(db_config['desired_policies'])
+            for policy, source in chain:
+                lineages[tpl.policy_name(policy)] = [policy] + (
+                    lineages[tpl.policy_name(source)] if source else []
+                )
+            self.policies = [
+                RollupPolicy(db_config, policy,
+                             lineages[tpl.policy_name(policy)])
+                for policy, _ in chain
+            ]
+        else:
+            self.policies = [
+                RollupPolicy(db_config, policy, [policy])
+                for policy in db_config['desired_policies']
+            ]
+
+        self.series = {}
+        self.ids = array('q')
+        self.times = array('q')
+        self.values = array('d')
+        self.files = [
+            open(os.path.join(directory, 'partition_{}'.format(index)),
+                 'w+b')
+            for index in range(partitions)
+        ]
+        self.points = 0
+
+    def add(self, key, value, timestamp):
+        """
+        Adds a point, aggregating the chunk when it is full.
+
+        :param key: Series key
+        :param value: Value field
+        :param timestamp: Timestamp in the precision of the input
+        """
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = len(self.series)
+            measurement, escaped, tags = parse_series(key)
+            for policy in self.policies:
+                policy.add_series(measurement, escaped, tags)
+        self.ids.append(series)
+        self.times.append(timestamp)
+        self.values.append(value)
+        self.points += 1
+        if len(self.ids) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Aggregates the points of the chunk and spills the partial
+        aggregates to the partition files.
+        """
+        if not len(self.ids):
+            return
+        ids = np.frombuffer(self.ids, dtype=np.int64)
+        times = np.frombuffer(self.times, dtype=np.int64) * self.scale
+        values = np.frombuffer(self.values, dtype=np.float64)
+
+        chunks = []
+        for index, policy in enumerate(self.policies):
+            series = np.frombuffer(policy.mapping, dtype=np.int64)[ids]
+            read = series >= 0
+            offsets = np.frombuffer(policy.offsets, dtype=np.int64)[ids]
+            partials = np.empty(int(read.sum()), dtype=PARTIAL)
+            partials['policy'] = index
+            partials['series'] = series[read]
+            start = times[read] - offsets[read]
+            partials['time'] = \
+                start - start % policy.rollup + offsets[read]
+            partials['sum'] = partials['max'] = partials['min'] = \
+                values[read]
+            partials['count'] = 1
+            chunks.append(combine(partials))
+        partials = np.concatenate(chunks)
+
+        partition = partials['series'] % self.partitions
+        order = np.argsort(partition, kind='stable')
+        counts = np.bincount(partition, minlength=self.partitions)
+        for spill, records in zip(
+                self.files, np.split(partials[order], np.cumsum(counts)[:-1])):
+            if len(records):
+                records.tofile(spill)
+
+        # New buffers, the arrays still viewed by numpy cannot be resized
+        self.ids = array('q')
+        self.times = array('q')
+        self.values = array('d')
+
+    def write(self, output):
+        """
+        Combines every partition and writes the rollups, for influx -import.
+
+        :param output: Open text file
+        :return: Number of points written per policy name
+        """
+        self.flush()
+        database = self.db_config['database']
+        written = {policy.name: 0 for policy in self.policies}
+        output.write('# DDL\n')
+        for policy in self.policies:
+            output.write('{}\n'.format(tpl.policy_query(policy.policy,
+                                                        database)))
+        output.write('# DML\n# CONTEXT-DATABASE: {}\n'.format(database))
+
+        for spill in self.files:
+            spill.seek(0)
+            partials = combine(np.fromfile(spill, dtype=PARTIAL))
+            spill.close()
+            policies = partials['policy']
+            for index, policy in enumerate(self.policies):
+                records = partials[policies == index]
+                if not len(records):
+                    continue
+                output.write('# CONTEXT-RETENTION-POLICY: {}\n'.format(
+                    policy.name
+                ))
+                output.write(self.render(policy, records))
+                written[policy.name] += len(records)
+        return written
+
+    def render(self, policy, records):
+        """
+        :param policy: RollupPolicy
+        :param records: Combined PARTIAL records of the policy
+        :return: Line protocol of the points
+        """
+        keys = policy.keys
+        totals = records['sum'].tolist()
+        counts = records['count'].tolist()
+        means = (records['sum'] / records['count']).tolist()
+        lines = []
+        for series, time, mean, maximum, minimum, total, count in zip(
+                records['series'].tolist(), records['time'].tolist(), means,
+                records['max'].tolist(), records['min'].tolist(), totals,
+                counts):
+            if self.chained:
+                fields = format_fields(mean, maximum, minimum, total, count)
+            else:
+                fields = format_fields(mean, maximum, minimum)
+            lines.append('{} {} {}\n'.format(keys[series], fields, time))
+        return ''.join(lines)
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def rollup_file(db_config, path, output, precision='ns'):
+    """
+    Builds the rollups of the desired policies of a database from a line
+    protocol file. Only points of the input policy of the database are
+    read when the file has CONTEXT lines, like influx_inspect export
+    writes, all points otherwise.
+
+    :param db_config: configuration dictionary for this database
+    :param path: Line protocol file, gzipped if it ends with .gz
+    :param output: Path the rollups are written to, for influx -import
+    :param precision: Unit of the timestamps, see PRECISIONS
+    :return: Dictionary of the points read, skipped and written per policy
+    """
+    settings = config['rollup']
+    database = db_config['database']
+    context = {'DATABASE': None, 'RETENTION-POLICY': None}
+    skipped = 0
+    with tempfile.TemporaryDirectory(
+            dir=settings['temporary_directory']) as directory:
+        rollup = Rollup(db_config, directory, settings['chunk_size'],
+                        settings['partitions'], precision)
+        with _open(path, 'r') as lines:
+            ddl = False
+            for number, line in enumerate(lines, 1):
+                line = line.rstrip('\r\n')
+                if not line:
+                    continue
+                if line.startswith('#'):
+                    match = _context.match(line)
+                    if match:
+                        context[match.group(1)] = match.group(2).strip()
+                    elif line.strip() in ('# DDL', '# DML'):
+                        ddl = line.strip() == '# DDL'
+                    continue
+                if ddl or context['DATABASE'] not in (None, database) or \
+                        context['RETENTION-POLICY'] not in (None,
+                                                            INPUT_POLICY):
+                    skipped += 1
+                    continue
+                try:
+                    point = parse_line(line)
+                except ValueError:
+                    raise ValueError('{}:{}: invalid line protocol'.format(
+                        path, number
+                    ))
+                if point is None:
+                    skipped += 1
+                    continue
+                rollup.add(*point)
+
+        with _open(output, 'w') as rollups:
+            written = rollup.write(rollups)
+    return dict(points=rollup.points, skipped=skipped, series=len(
+        rollup.series
+    ), written=written)
+
+
+def run(db_configs, path, output=None, database=None, precision='ns'):
+    """
+    Builds the rollups of a line protocol file, for the command line.
+
+    :param db_configs: List of database configuration dictionaries
+    :param path: Line protocol file
+    :param output: Path the rollups are written to, next to the input if
+                   not given
+    :param database: Name of the configured database the points belong to,
+                     may be left out when only one is configured
+    :param precision: Unit of the timestamps, see PRECISIONS
+    :return: Exit code
+    """
+    if database is not None:
+        db_configs = [db_config for db_config in db_configs
+                      if db_config['database'] == database]
+    if len(db_configs) != 1:
+        logger.error("{} databases match, pick one with --rollup-database"
+                     .format(len(db_configs)))
+        return 1
+    if output is None:
+        root = path[:-3] if path.endswith('.gz') else path
+        output = '{}.rollup.lp'.format(os.path.splitext(root)[0])
+
+    result = rollup_file(db_configs[0], path, output, precision)
+    logger.info("Read {} points of {} series, skipped {} lines".format(
+        result['points'], result['series'], result['skipped']
+    ))
+    for name, points in sorted(result['written'].items()):
+        logger.info("Wrote {} points to {}".format(points, name))
+    logger.info("Rollups written to {}, import them with influx -import "
+                "-path {}".format(output, output))
+    return 0
@@ -0,0 +1,208 @@
+import logging
+import re
+from collections import OrderedDict
+
+from influxdb_aggregation import templating as tpl
+from influxdb_aggregation.conf import config
+from influxdb_aggregation.hibernation import iter_batches
+from influxdb_aggregation.influxql import quote_identifier
+
+__all__ = ['has_tag_lists', 'resolve_tags', 'policy_tags', 'group_by_clause',
+           'tag_keys_query', 'collect_tag_keys', 'parse_series_key',
+           'iter_series', 'report_cardinality']
+
+# Policies with keep_tags or drop_tags group by an explicit list of tags
+# instead of GROUP BY *, resolved per measurement against its tag keys.
+
+logger = logging.getLogger(__name__)
+
+# Groups by no tag at all, as InfluxQL has no empty GROUP BY list
+NO_TAGS = '/^$/'
+
+_key_separator = re.compile(r'(?<!\\),')
+
+
+def has_tag_lists(policy):
+    """
+    :param policy: Policy config dictionary
+    :return: True if the policy keeps or drops tags
+    """
+    return (policy.get('keep_tags') is not None or
+            policy.get('drop_tags') is not None)
+
+
+def resolve_tags(tags, policy):
+    """
+    Works out the tags a policy keeps.
+
+    :param tags: Tag keys available, of the input measurement or of the
+                 policy a chained rollup reads from
+    :param policy: Policy config dictionary
+    :return: Sorted list of tag keys, None for all tags
+    """
+    if not has_tag_lists(policy):
+        return None
+    kept = set(tags)
+    if policy.get('keep_tags') is not None:
+        kept &= set(policy['keep_tags'])
+    kept -= set(policy.get('drop_tags') or ())
+    return sorted(kept)
+
+
+def policy_tags(policy, tags):
+    """
+    Works out the tags a policy keeps, when the available tags may not be
+    known. Without them, only a keep list can be used as it is.
+
+    :param policy: Policy config dictionary
+    :param tags: Tag keys available, None if not known
+    :return: Sorted list of tag keys, None for all tags
+    """
+    if tags is not None:
+        return resolve_tags(tags, policy)
+    if policy.get('keep_tags') is None:
+        return None
+    return resolve_tags(policy['keep_tags'], policy)
+
+
+def group_by_clause(tags):
+    """
+    Renders the GROUP BY dimensions of a list of tags.
+
+    :param tags: List of tag keys, None for all tags
+    :return: GROUP BY dimensions besides time()
+    """
+    if tags is None:
+        return '*'
+    if not tags:
+        return NO_TAGS
+    return ', '.join(quote_identifier(tag) for tag in tags)
+
+
+def tag_keys_query(database, measurements):
+    """
+    Renders a query reading the tag keys of measurements in the input
+    policy.
+
+    :param database: Name of the database
+    :param measurements: List of measurement names
+    :return: Query
+    """
+    return 'SHOW TAG KEYS FROM {}'.format(', '.join(
+        '{}.{}.{}'.format(
+            quote_identifier(database), tpl.policy_name({}),
+            quote_identifier(measurement)
+        )
+        for measurement in measurements
+    ))
+
+
+def collect_tag_keys(client, db_config, measurements, tag_keys):
+    """
+    Reads the tag keys of measurements in batches while they are iterated,
+    when a desired policy keeps or drops tags.
+
+    :param client: Influx client (connection)
+    :param db_config: configuration dictionary for this database
+    :param measurements: Iterable of measurement names, iterated lazily
+    :param tag_keys: Dictionary the tag keys are added to by measurement
+    :return: Generator of the measurement names, their tag keys are in
+             tag_keys once they are yielded
+    """
+    if (db_config.get('continuous_query_mode') == 'wildcard' or
+            not any(has_tag_lists(policy)
+                    for policy in db_config['desired_policies'])):
+        for measurement in measurements:
+            yield measurement
+        return
+
+    for batch in iter_batches(measurements, config['tags']['batch_size']):
+        result = client.query(tag_keys_query(db_config['database'], batch))
+        for measurement in batch:
+            tag_keys[measurement] = []
+        for (measurement, _), points in result.items():
+            tag_keys[measurement] = [point['tagKey'] for point in points]
+        for measurement in batch:
+            yield measurement
+
+
+def parse_series_key(key):
+    """
+    Splits a series key, like cpu,host=a,region=b, into its tags.
+
+    :param key: Series key, escaped like line protocol
+    :return: Dictionary of tag values by key
+    """
+    tags = {}
+    for pair in _key_separator.split(key)[1:]:
+        name, _, value = re.split(r'(?<!\\)(=)', pair, maxsplit=1)
+        tags[name.replace('\\', '')] = value.replace('\\', '')
+    return tags
+
+
+def iter_series(client, source, page_size):
+    """
+    Reads the series keys of a measurement page by page, so the series of
+    a high cardinality measurement are not all held at once.
+
+    :param client: Influx client (connection)
+    :param source: Quoted database.policy.measurement
+    :param page_size: Number of series read per request
+    :return: Generator of series keys
+    """
+    offset = 0
+    while True:
+        page = [
+            point['key'] for point in client.query(
+                'SHOW SERIES FROM {} LIMIT {} OFFSET {}'.format(
+                    source, page_size, offset
+                )
+            ).get_points()
+        ]
+        for key in page:
+            yield key
+        if len(page) < page_size:
+            return
+        offset += page_size
+
+
+def report_cardinality(client, db_config, created):
+    """
+    Logs the number of series the new queries keeping or dropping tags
+    write, compared to the series of the input measurement. The series of
+    a measurement are streamed once for all its queries, only the series
+    the queries write are kept to count them.
+
+    :param client: Influx client (connection)
+    :param db_config: configuration dictionary for this database
+    :param created: List of (query name, query info) tuples of the new
+                    queries
+    """
+    queries = OrderedDict()
+    for name, info in created:
+        if info.get('tags') is None or 'measurement' not in info:
+            continue
+        queries.setdefault(info['measurement'], []).append(
+            (name, info['tags'])
+        )
+
+    for measurement, measurement_queries in queries.items():
+        source = '{}.{}.{}'.format(
+            quote_identifier(db_config['database']), tpl.policy_name({}),
+            quote_identifier(measurement)
+        )
+        total = 0
+        written = [set() for _ in measurement_queries]
+        for key in iter_series(client, source,
+                               config['measurement_page_size']):
+            total += 1
+            tags = parse_series_key(key)
+            for series, (_, kept) in zip(written, measurement_queries):
+                series.add(tuple(tags.get(tag) for tag in kept))
+
+        for series, (name, _) in zip(written, measurement_queries):
+            logger.info(
+                "{} writes {} series for {} input series ({:.0f}% less)"
+                .format(name, len(series), total,
+                        100 - 100.0 * len(series) / total if total else 0)
+            )
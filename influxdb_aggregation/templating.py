@@ -1,33 +1,206 @@
 import re
+import zlib
+from string import Formatter
 
 from influxdb_aggregation.conf import config
+from influxdb_aggregation.durations import (
+    SECOND, UNITS, format_duration, parse_duration
+)
 
 __all__ = ['policy_name', 'policy_query', 'policy_update_query',
-           'continuous_query_name', 'continuous_query_create']
+           'continuous_query_name', 'continuous_query_create',
+           'stagger_offset', 'sort_policies', 'chain_policies',
+           'wildcard_query_name', 'wildcard_query_create',
+           'template_pattern', 'continuous_query_pattern',
+           'wildcard_query_pattern', 'owned_queries', 'Template',
+           'template', 'bound_template']
 
+# Values that change the rendered query when it is stripped afterwards
+_needs_strip = re.compile(r'\s\s|[^\S ]|^\s|\s$')
 
-def policy_name(policy):
+
+def strip_query(query):
     """
-    Renders the name of a policy
+    Strips a query of whitespaces, this form is more useful for comparision.
+
+    :param query: Initial query
+    :return: Stripped query
+    """
+    return re.sub(r'[\s]+', ' ', query).strip()
+
+
+def _strip_if_needed(query, *values):
+    """
+    Strips a query rendered from a stripped template, only if one of the
+    values substituted into it could have changed its whitespace.
+
+    :param query: Rendered query
+    :param values: Values substituted into the query
+    :return: Stripped query
+    """
+    for value in values:
+        if isinstance(value, str) and (
+                not value or _needs_strip.search(value)):
+            return strip_query(query)
+    return query
+
+
+class Template(object):
+    """
+    A query template, stripped once when it is created.
+    Rendering it gives the same result as formatting the original template
+    and stripping the result, but only strips again when a value could
+    change the whitespace.
+    """
+
+    def __init__(self, text):
+        self.text = strip_query(text)
 
+    def __repr__(self):
+        return 'Template({!r})'.format(self.text)
+
+    def __eq__(self, other):
+        return isinstance(other, Template) and self.text == other.text
+
+    def __hash__(self):
+        return hash(self.text)
+
+    def bind(self, **values):
+        """
+        Substitutes some of the fields of the template, for rendering the
+        rest of them many times.
+        A Template value is inserted with its fields, so nested templates
+        are rendered in one go.
+
+        :param values: Values of the fields to substitute
+        :return: Template with the remaining fields
+        """
+        formatter = Formatter()
+        parts = []
+        for literal, field, spec, conversion in formatter.parse(self.text):
+            parts.append(literal.replace('{', '{{').replace('}', '}}'))
+            if field is None:
+                continue
+            if field in values and isinstance(values[field], Template):
+                parts.append(values[field].text)
+            elif field in values:
+                value = formatter.format_field(
+                    formatter.convert_field(values[field], conversion),
+                    spec
+                )
+                parts.append(value.replace('{', '{{').replace('}', '}}'))
+            else:
+                parts.append('{' + field)
+                if conversion:
+                    parts.append('!' + conversion)
+                if spec:
+                    parts.append(':' + spec)
+                parts.append('}')
+        return Template(''.join(parts))
+
+    def render(self, **values):
+        """
+        Renders the template.
+
+        :param values: Values of the fields of the template
+        :return: Stripped query
+        """
+        return _strip_if_needed(
+            self.text.format(**values), *values.values()
+        )
+
+
+_templates = {}
+_bound_templates = {}
+_policy_names = {}
+
+
+def template(key):
+    """
+    Gets a configured template, compiled once per template text.
+
+    :param key: Configuration key of the template
+    :return: Template
+    """
+    text = config[key]
+    try:
+        return _templates[text]
+    except KeyError:
+        compiled = _templates[text] = Template(text)
+        return compiled
+
+
+def _freeze(value):
+    """
+    Makes configuration values usable as cache keys.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _cached(cache, key, build):
+    """
+    Gets a value from a cache, building it if missing.
+
+    :param cache: Cache dictionary
+    :param key: Tuple identifying the value, may contain dictionaries
+    :param build: Function building the value
+    :return: Cached value
+    """
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+    except TypeError:
+        key = _freeze(key)
+        if key in cache:
+            return cache[key]
+    value = cache[key] = build()
+    return value
+
+
+def bound_template(key, policy, **values):
+    """
+    Gets a configured template with the policy fields, and the given values,
+    substituted. The result is cached, as it only depends on the policy and
+    not the measurement.
+
+    :param key: Configuration key of the template
     :param policy: Policy config dictionary
-    :return: Policy name
+    :param values: Other values to substitute
+    :return: Template
     """
-    return (
-        config['policy_name_template'].format(rollup=policy["rollup"])
-        if "rollup" in policy
-        else "input"
+    def build():
+        values.update(policy)
+        return template(key).bind(policy=policy_name(policy), **values)
+
+    return _cached(
+        _bound_templates,
+        (key, config[key], config['policy_name_template'],
+         tuple(policy.items()), tuple(values.items())),
+        build
     )
 
 
-def strip_query(query):
+def policy_name(policy):
     """
-    Strips a query of whitespaces, this form is more useful for comparision.
+    Renders the name of a policy
 
-    :param query: Initial query
-    :return: Stripped query
+    :param policy: Policy config dictionary
+    :return: Policy name
     """
-    return re.sub(r'[\s]+', ' ', query).strip()
+    if "rollup" not in policy:
+        return "input"
+    cache_key = (config['policy_name_template'], policy["rollup"])
+    try:
+        return _policy_names[cache_key]
+    except KeyError:
+        name = _policy_names[cache_key] = \
+            config['policy_name_template'].format(rollup=policy["rollup"])
+        return name
 
 
 def policy_query(policy, database):
@@ -38,30 +211,29 @@ def policy_query(policy, database):
     :param database: Name of the database
     :return: Stripped policy query
     """
-    return strip_query(
-        config['policy_template'].format(
-            policy=policy_name(policy),
-            database=database,
-            **policy
-        )
+    return template('policy_template').render(
+        policy=policy_name(policy),
+        database=database,
+        **policy
     )
 
 
-def policy_update_query(policy, database):
+def policy_update_query(policy, database, changes, name=None):
     """
     Renders a policy update query, issued to get the retention policy into
     the desired state.
 
     :param policy: Policy config dictionary
     :param database: Name of the database
+    :param changes: List of the clauses that differ, like DURATION 2d
+    :param name: Name of the policy, rendered from the policy if not given
     :return: Stripped policy update query
     """
-    return strip_query(
-        config['policy_update_template'].format(
-            policy=policy_name(policy),
-            database=database,
-            **policy
-        )
+    return template('policy_update_template').render(
+        policy=name or policy_name(policy),
+        database=database,
+        changes=' '.join(changes),
+        **policy
     )
 
 
@@ -73,46 +245,370 @@ def continuous_query_name(policy, measurement):
     :param measurement: Name of measurement to query
     :return:
     """
-    return config['query_name_template'].format(
-        policy=policy_name(policy),
+    return bound_template('query_name_template', policy).render(
         measurement=measurement
     )
 
 
-def continuous_query_query(policy, measurement, database):
+def continuous_query_query(policy, measurement, database, source=None,
+                           offset=0, group_by='*'):
     """
     Renders a continuous query.
 
     :param policy: Policy config dictionary
     :param measurement: Name of measurement to query
     :param database: Name of the database
+    :param source: Policy config dictionary of the policy to read from when
+                   rollups are chained, empty for the input policy,
+                   None when not chained
+    :param offset: Offset of the GROUP BY time() interval in nanoseconds
+    :param group_by: GROUP BY dimensions besides time(), see
+                     tags.group_by_clause
     :return: Stripped continuous query
     """
-    return strip_query(
-        config['continuous_query_template'].format(
+    return _strip_if_needed(
+        _query_template(policy, database, source).text.format(
             measurement=measurement,
-            policy=policy_name(policy),
-            database=database,
-            **policy
-        )
+            offset=offset_clause(offset),
+            group_by=group_by
+        ),
+        measurement, group_by
+    )
+
+
+def _query_template(policy, database, source):
+    """
+    Gets the continuous query template with everything but the measurement
+    and offset substituted.
+    """
+    if source is None:
+        key = 'continuous_query_template'
+    elif 'rollup' not in source:
+        key = 'chained_input_continuous_query_template'
+    else:
+        key = 'chained_continuous_query_template'
+
+    return bound_template(
+        key, policy, database=database, source=policy_name(source or {})
     )
 
 
-def continuous_query_create(policy, measurement, database):
+def offset_clause(offset):
+    """
+    Renders the offset argument of GROUP BY time().
+
+    :param offset: Offset in nanoseconds
+    :return: Offset argument, empty if there is no offset
+    """
+    if not offset:
+        return ''
+    return ', {}'.format(format_duration(offset))
+
+
+def stagger_offset(policy, key, window=None):
+    """
+    Works out a deterministic offset spreading continuous queries over the
+    rollup interval, influx runs a continuous query when the offset
+    interval ends.
+    The offset of a key for a coarser policy is congruent to the one of a
+    finer policy as long as the window is a multiple of the finer rollup,
+    so chained rollups stay aligned.
+
+    :param policy: Policy config dictionary
+    :param key: Measurement name or pattern identifying the query
+    :param window: Maximum offset as a duration, defaults to the rollup
+    :return: Offset in whole seconds, as nanoseconds
+    """
+    rollup = parse_duration(policy['rollup'])
+    if window is not None:
+        rollup = min(rollup, parse_duration(window))
+    seconds = rollup // SECOND
+    if seconds <= 1:
+        return 0
+    return zlib.crc32(key.encode('utf-8')) % seconds * SECOND
+
+
+def resample_clause(policy, source=None):
+    """
+    Renders the RESAMPLE clause of a continuous query.
+    A query reading from a chained rollup is re-run every source interval
+    for one source interval more than its own, so points written by the
+    source query after this query ran are still aggregated.
+
+    :param policy: Policy config dictionary
+    :param source: Policy config dictionary of the policy to read from
+    :return: RESAMPLE clause, empty if not needed
+    """
+    if not source or 'rollup' not in source:
+        return ''
+    every = parse_duration(source['rollup'])
+    return 'RESAMPLE EVERY {} FOR {}'.format(
+        format_duration(every),
+        format_duration(parse_duration(policy['rollup']) + every)
+    )
+
+
+def continuous_query_create(policy, measurement, database, source=None,
+                            offset=0, group_by='*'):
     """
     Renders a create query for a continous query
 
     :param policy: Policy config dictionary
     :param measurement: Name of measurement to query
     :param database: Name of the database
+    :param source: Policy config dictionary of the policy to read from when
+                   rollups are chained, see continuous_query_query
+    :param offset: Offset of the GROUP BY time() interval in nanoseconds,
+                   see stagger_offset
+    :param group_by: GROUP BY dimensions besides time(), see
+                     tags.group_by_clause
     :return: Stripped continuous query creation query
     """
-    return strip_query(
-        config['create_continuous_query_template'].format(
+    return _strip_if_needed(
+        _create_template(policy, database, source).text.format(
             measurement=measurement,
-            policy=policy_name(policy),
+            offset=offset_clause(offset),
+            group_by=group_by
+        ),
+        measurement, group_by
+    )
+
+
+_create_templates = {}
+
+
+def _create_template(policy, database, source):
+    """
+    Gets the continuous query creation template with the name and query
+    templates nested into it, leaving only the measurement, offset and
+    GROUP BY dimensions to substitute for every measurement.
+    """
+    def build():
+        return bound_template(
+            'create_continuous_query_template', policy,
             database=database,
-            query=continuous_query_query(policy, measurement, database),
-            **policy
+            resample=resample_clause(policy, source),
+            name=bound_template('query_name_template', policy),
+            query=_query_template(policy, database, source)
+        )
+
+    return _cached(
+        _create_templates,
+        (config['create_continuous_query_template'],
+         config['query_name_template'],
+         config['continuous_query_template'],
+         config['chained_input_continuous_query_template'],
+         config['chained_continuous_query_template'],
+         config['policy_name_template'],
+         tuple(policy.items()), database,
+         None if source is None else tuple(source.items())),
+        build
+    )
+
+
+def sort_policies(policies):
+    """
+    Sorts policies by rollup interval, finest first.
+
+    :param policies: List of policy config dictionaries
+    :return: Sorted list of policy config dictionaries
+    """
+    return sorted(
+        policies, key=lambda policy: parse_duration(policy['rollup'])
+    )
+
+
+def chain_policies(policies):
+    """
+    Pairs every policy with the next finer policy it reads from when rollups
+    are chained, the finest policy reads from the input policy.
+
+    :param policies: List of policy config dictionaries
+    :return: List of (policy, source) tuples, finest first
+    :raises ValueError: If a rollup is not a multiple of the one it reads
+    """
+    chain = []
+    source = {}
+    for policy in sort_policies(policies):
+        if 'rollup' in source and (
+                parse_duration(policy['rollup']) %
+                parse_duration(source['rollup'])):
+            raise ValueError(
+                "Rollup {} is not a multiple of {}, can not be chained".format(
+                    policy['rollup'], source['rollup']
+                )
+            )
+        chain.append((policy, source))
+        source = policy
+    return chain
+
+
+def wildcard_query_name(policy, partition):
+    """
+    Renders the name of a wildcard continuous query
+
+    :param policy: Policy config dictionary
+    :param partition: Index of the measurement partition
+    :return: Wildcard query name
+    """
+    return bound_template('wildcard_query_name_template', policy).render(
+        partition=partition
+    )
+
+
+def wildcard_query_query(policy, pattern, database, offset=0, group_by='*'):
+    """
+    Renders a wildcard continuous query, covering all measurements matching
+    a regular expression.
+
+    :param policy: Policy config dictionary
+    :param pattern: Regular expression matching measurements to query
+    :param database: Name of the database
+    :param offset: Offset of the GROUP BY time() interval in nanoseconds
+    :param group_by: GROUP BY dimensions besides time()
+    :return: Stripped wildcard query
+    """
+    return bound_template(
+        'wildcard_continuous_query_template', policy, database=database
+    ).render(
+        pattern=pattern.replace('/', r'\/'),
+        offset=offset_clause(offset),
+        group_by=group_by
+    )
+
+
+def wildcard_query_create(policy, partition, pattern, database, offset=0,
+                          group_by='*'):
+    """
+    Renders a create query for a wildcard continuous query
+
+    :param policy: Policy config dictionary
+    :param partition: Index of the measurement partition
+    :param pattern: Regular expression matching measurements to query
+    :param database: Name of the database
+    :param offset: Offset of the GROUP BY time() interval in nanoseconds
+    :param group_by: GROUP BY dimensions besides time()
+    :return: Stripped wildcard query creation query
+    """
+    return bound_template(
+        'create_continuous_query_template', policy,
+        database=database, resample=''
+    ).render(
+        name=wildcard_query_name(policy, partition),
+        query=wildcard_query_query(
+            policy, pattern, database, offset, group_by
         )
     )
+
+
+def _pattern_source(template, values, patterns):
+    """
+    Builds the regular expression source of template_pattern.
+
+    :param template: Name template
+    :param values: Known field values
+    :param patterns: Regular expression sources of other fields
+    :return: Regular expression source
+    """
+    pattern = []
+    seen = set()
+    for literal, field, _, _ in Formatter().parse(template):
+        pattern.append(re.escape(literal))
+        if field is None:
+            continue
+        if field in values:
+            pattern.append(re.escape(str(values[field])))
+        elif field in seen:
+            pattern.append('(?P={})'.format(field))
+        else:
+            seen.add(field)
+            pattern.append('(?P<{}>{})'.format(
+                field, patterns.get(field, '.+?')
+            ))
+    return ''.join(pattern)
+
+
+def template_pattern(template, **values):
+    """
+    Builds a regular expression matching the output of a name template.
+    Fields given in values must match exactly, other fields are captured
+    as named groups.
+
+    :param template: Name template
+    :param values: Known field values
+    :return: Compiled regular expression
+    """
+    return re.compile('^{}$'.format(_pattern_source(template, values, {})))
+
+
+def continuous_query_pattern(policy):
+    """
+    Builds a regular expression matching the names of the per-measurement
+    continuous queries of a policy, capturing the measurement.
+
+    :param policy: Policy config dictionary
+    :return: Compiled regular expression
+    """
+    return template_pattern(
+        config['query_name_template'], policy=policy_name(policy)
+    )
+
+
+def wildcard_query_pattern(policy):
+    """
+    Builds a regular expression matching the names of the wildcard
+    continuous queries of a policy, capturing the partition.
+
+    :param policy: Policy config dictionary
+    :return: Compiled regular expression
+    """
+    return template_pattern(
+        config['wildcard_query_name_template'], policy=policy_name(policy)
+    )
+
+
+def owned_queries(policies, queries):
+    """
+    Finds the continuous queries made by the templates, whose names are
+    exactly the names rendered for their measurement or partition and
+    policy. Policies not in the configuration any more are told by their
+    names, like rendered by policy_name_template, with a valid rollup.
+
+    :param policies: Policy config dictionaries of the database
+    :param queries: Iterable of query names
+    :return: Generator of the names of the queries made by the templates
+    """
+    named = {policy_name(policy): policy for policy in policies}
+    policy = _pattern_source(config['policy_name_template'], {}, {
+        'rollup': r'(?:\d+(?:{}))+'.format(
+            '|'.join(sorted(UNITS, key=len, reverse=True))
+        )
+    })
+    names = [
+        (re.compile('^{}$'.format(_pattern_source(config[key], {}, {
+            'policy': policy, 'partition': r'\d+'
+        }))), field, render)
+        for key, field, render in [
+            ('query_name_template', 'measurement', continuous_query_name),
+            ('wildcard_query_name_template', 'partition',
+             wildcard_query_name),
+        ]
+    ]
+
+    for query in queries:
+        for pattern, field, render in names:
+            match = pattern.match(query)
+            if match is None or match.groupdict().get(field) is None:
+                continue
+            groups = match.groupdict()
+            value = groups[field]
+            try:
+                if render(named.get(groups.get('policy'),
+                                    {'rollup': groups.get('rollup')}),
+                          int(value) if field == 'partition' else value
+                          ) == query:
+                    yield query
+                    break
+            except (KeyError, IndexError, ValueError):
+                # Templates using fields of policies no longer known
+                continue
@@ -0,0 +1,369 @@
+import logging
+import math
+import random
+import re
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from influxdb_aggregation import main, metrics
+from influxdb_aggregation.backfill import (
+    BackfillQueue, backfill_query, data_age, run_backfill, select_query
+)
+from influxdb_aggregation.conf import config
+from influxdb_aggregation.durations import SECOND, parse_duration
+from influxdb_aggregation.influxql import group_by_time
+
+__all__ = ['Window', 'WindowResult', 'expected_query', 'rollup_query',
+           'sample_windows', 'compare_points', 'plan_windows',
+           'check_window', 'verify_windows', 'repair', 'run']
+
+# Checks that the continuous queries write what they should. For sampled
+# windows of time, the SELECT of a continuous query is run without its
+# INTO, recomputing the points it should have written from what it reads,
+# and compared with the points in its rollup policy. Missing points are
+# gaps, like those left while a query was broken or before it was
+# re-created; points with other values are mismatches. Chained rollups are
+# checked against the rollup they read from, link by link.
+
+logger = logging.getLogger(__name__)
+
+_into = re.compile(r'\sINTO\s+(.*?)\s+FROM\s', re.IGNORECASE | re.DOTALL)
+
+# A window of time of one continuous query
+Window = namedtuple('Window', ['db_config', 'name', 'info', 'start', 'end'])
+
+# Outcome of checking a window: the number of points expected, missing,
+# with other values, and written without being expected
+WindowResult = namedtuple('WindowResult', [
+    'window', 'expected', 'missing', 'mismatched', 'unexpected', 'error'
+])
+
+
+def expected_query(select, start, end):
+    """
+    Turns the SELECT ... INTO of a continuous query into a query of the
+    points it writes over a range of time.
+
+    :param select: SELECT ... INTO query
+    :param start: Start of the range in nanoseconds, inclusive
+    :param end: End of the range in nanoseconds, exclusive
+    :return: SELECT query
+    """
+    return backfill_query(_into.sub(' FROM ', select, count=1), start, end)
+
+
+def rollup_query(select, start, end, pattern=None):
+    """
+    Renders a query of the points the SELECT ... INTO of a continuous query
+    wrote over a range of time.
+
+    :param select: SELECT ... INTO query
+    :param start: Start of the range in nanoseconds, inclusive
+    :param end: End of the range in nanoseconds, exclusive
+    :param pattern: Pattern of the measurements of a wildcard query
+    :return: SELECT query
+    :raises ValueError: If the query has no INTO clause
+    """
+    match = _into.search(select)
+    if match is None:
+        raise ValueError("Not a SELECT ... INTO: {!r}".format(select))
+    target = match.group(1)
+    if pattern is not None:
+        target = target.replace(':MEASUREMENT', '/{}/'.format(pattern))
+    return 'SELECT * FROM {} WHERE time >= {} AND time < {} GROUP BY *' \
+        .format(target, start, end)
+
+
+def sample_windows(interval, offset, oldest, newest, samples, intervals,
+                   generator):
+    """
+    Picks windows of whole GROUP BY time() intervals at random.
+
+    :param interval: GROUP BY time() interval in nanoseconds
+    :param offset: GROUP BY time() offset in nanoseconds
+    :param oldest: Earliest start of a window in nanoseconds
+    :param newest: Latest end of a window in nanoseconds
+    :param samples: Number of windows
+    :param intervals: Number of intervals in a window
+    :param generator: random.Random
+    :return: Sorted list of (start, end) tuples, fewer when the range does
+             not hold that many
+    """
+    length = intervals * interval
+    first = -((offset - oldest) // interval) * interval + offset
+    last = (newest - offset) // interval * interval + offset - length
+    if last < first:
+        return []
+    positions = (last - first) // interval + 1
+    return sorted(
+        (first + position * interval, first + position * interval + length)
+        for position in generator.sample(range(positions),
+                                         min(samples, positions))
+    )
+
+
+def _index(result):
+    """
+    :param result: ResultSet with times in nanoseconds
+    :return: Dictionary of the fields of the points by (measurement,
+             tags, time), tags without empty values
+    """
+    points = {}
+    for (name, tags), series in result.items():
+        tags = tuple(sorted(
+            (key, value) for key, value in (tags or {}).items() if value
+        ))
+        for point in series:
+            points[(name, tags, point.pop('time'))] = point
+    return points
+
+
+def _equal(expected, actual, tolerance):
+    if isinstance(expected, (int, float)) and \
+            isinstance(actual, (int, float)):
+        return math.isclose(expected, actual, rel_tol=tolerance,
+                            abs_tol=tolerance)
+    return expected == actual
+
+
+def compare_points(expected, actual, tolerance=1e-9):
+    """
+    Compares the points a continuous query should have written with those
+    it wrote. Intervals without input have no expected point.
+
+    :param expected: ResultSet of the expected_query
+    :param actual: ResultSet of the rollup_query
+    :param tolerance: Relative and absolute difference of values allowed
+    :return: Number of points expected, missing, mismatched and unexpected
+    """
+    actual = _index(actual)
+    expected = {
+        key: fields for key, fields in _index(expected).items()
+        if any(value is not None for value in fields.values())
+    }
+    missing = mismatched = 0
+    for key, fields in expected.items():
+        point = actual.get(key)
+        if point is None:
+            missing += 1
+        elif any(value is not None and
+                 not _equal(value, point.get(field), tolerance)
+                 for field, value in fields.items()):
+            mismatched += 1
+    unexpected = len(set(actual) - set(expected))
+    return len(expected), missing, mismatched, unexpected
+
+
+def plan_windows(client, db_config, now=None, generator=None):
+    """
+    Samples the windows of time to check of the continuous queries of a
+    database, within the retention of the policies they read and write.
+
+    :param client: Influx client (connection)
+    :param db_config: configuration dictionary for this database
+    :param now: Current time in nanoseconds
+    :param generator: random.Random picking the queries and windows
+    :return: List of Window
+    """
+    settings = config['verify']
+    now = int(time.time() * SECOND) if now is None else now
+    generator = random.Random() if generator is None else generator
+    max_age = parse_duration(settings['max_age'])
+
+    stats = {}
+    tag_keys = {}
+    measurements = main.read_measurements(client, db_config, set(), stats,
+                                          tag_keys)
+    # Only the queries planned are checked, not those the cost budget
+    # refuses
+    queries = list(main.desired_queries(db_config, measurements, stats,
+                                        tag_keys))
+    if settings['queries'] is not None and \
+            len(queries) > settings['queries']:
+        queries = generator.sample(queries, settings['queries'])
+
+    windows = []
+    for name, info in queries:
+        grouping = group_by_time(select_query(info['query']))
+        if grouping is None:
+            continue
+        interval, offset = grouping
+        oldest = now - data_age(db_config, info, max_age)
+        # The latest intervals may not have been written yet
+        newest = now - settings['recent_intervals'] * interval
+        for start, end in sample_windows(
+                interval, offset, oldest, newest,
+                settings['samples'], settings['intervals'], generator):
+            windows.append(Window(db_config, name, info, start, end))
+    return windows
+
+
+def check_window(client, window, tolerance):
+    """
+    Compares the points of a window of a continuous query with a
+    recomputation, in one request.
+
+    :param client: Influx client (connection)
+    :param window: Window
+    :param tolerance: See compare_points
+    :return: WindowResult
+    """
+    select = select_query(window.info['query'])
+    try:
+        expected, actual = client.query('{}; {}'.format(
+            expected_query(select, window.start, window.end),
+            rollup_query(select, window.start, window.end,
+                         window.info.get('pattern'))
+        ), epoch='ns')
+    except Exception as e:
+        logger.error("Verifying {} failed: {}".format(window.name, e))
+        return WindowResult(window, 0, 0, 0, 0, str(e))
+    return WindowResult(window, *compare_points(expected, actual, tolerance),
+                        error=None)
+
+
+def _format_time(nanoseconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                         time.gmtime(nanoseconds // SECOND))
+
+
+def _report(result):
+    window = result.window
+    if result.error is not None:
+        outcome = 'error'
+    elif result.missing:
+        outcome = 'gap'
+    elif result.mismatched or result.unexpected:
+        outcome = 'mismatch'
+    else:
+        outcome = 'ok'
+    metrics.inc('verify_windows_total', help='Windows of continuous queries '
+                'verified, by result', result=outcome)
+    if outcome in ('gap', 'mismatch'):
+        logger.warning(
+            "{}:{}/{} {}: {} of {} points missing, {} differ, {} "
+            "unexpected from {} to {}".format(
+                window.db_config['host'], window.db_config['port'],
+                window.db_config['database'], window.name, result.missing,
+                result.expected, result.mismatched, result.unexpected,
+                _format_time(window.start), _format_time(window.end)
+            )
+        )
+
+
+def verify_windows(windows, pool, workers=8, workers_per_host=2):
+    """
+    Checks windows in parallel.
+
+    :param windows: List of Window
+    :param pool: ClientPool the clients are taken from
+    :param workers: Number of windows checked at the same time
+    :param workers_per_host: Number of windows checked at the same time on
+                             one host:port
+    :return: List of WindowResult, in the order of the windows
+    """
+    tolerance = config['verify']['tolerance']
+    host_limits = {}
+    for window in windows:
+        host_limits.setdefault(
+            (window.db_config['host'], window.db_config['port']),
+            threading.BoundedSemaphore(max(workers_per_host, 1))
+        )
+
+    def check(window):
+        db_config = window.db_config
+        with host_limits[(db_config['host'], db_config['port'])]:
+            result = check_window(pool.client(db_config), window, tolerance)
+        _report(result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        return list(executor.map(check, windows))
+
+
+def repair(results, queue):
+    """
+    Queues the backfill of the windows with gaps or mismatches.
+
+    :param results: List of WindowResult
+    :param queue: BackfillQueue
+    :return: Number of windows queued
+    """
+    windows = {}
+    for result in results:
+        if result.error is None and (result.missing or result.mismatched):
+            window = result.window
+            key = (window.db_config['host'], window.db_config['port'],
+                   window.db_config['database'])
+            windows.setdefault(key, (window.db_config, []))[1].append(
+                (window.name, window.info, window.start, window.end)
+            )
+    for db_config, database_windows in windows.values():
+        queue.add_windows(db_config, database_windows)
+    return sum(len(database_windows) for _, database_windows
+               in windows.values())
+
+
+def run(db_configs, pool, fix=False, seed=None, workers=8,
+        workers_per_host=2):
+    """
+    Verifies the continuous queries of databases, for the command line.
+
+    :param db_configs: List of database configuration dictionaries
+    :param pool: ClientPool the clients are taken from
+    :param fix: Backfills the windows with gaps or mismatches
+    :param seed: Seed of the sampling, random if None
+    :param workers: Number of requests running at the same time
+    :param workers_per_host: Number of requests running at the same time
+                             on one host:port
+    :return: Exit code, 1 if a window is wrong and was not repaired
+    """
+    generator = random.Random(seed)
+    now = int(time.time() * SECOND)
+
+    def plan(db_config):
+        try:
+            return plan_windows(pool.client(db_config), db_config, now,
+                                random.Random(generator.random()))
+        except Exception:
+            logger.exception("Sampling the queries of {} failed".format(
+                db_config['database']
+            ))
+            return None
+
+    with metrics.span('verify'):
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            planned = list(executor.map(plan, db_configs))
+        windows = [window for database_windows in planned
+                   if database_windows for window in database_windows]
+        results = verify_windows(windows, pool, workers, workers_per_host)
+
+    wrong = [result for result in results
+             if result.missing or result.mismatched or result.unexpected]
+    failed = sum(1 for result in results if result.error is not None) + \
+        sum(1 for database_windows in planned if database_windows is None)
+    logger.info("Verified {} windows of {} databases: {} with gaps, {} "
+                "with mismatches, {} failed".format(
+                    len(results), len(db_configs),
+                    sum(1 for result in wrong if result.missing),
+                    sum(1 for result in wrong if not result.missing),
+                    failed
+                ))
+
+    if fix and wrong:
+        settings = config['backfill']
+        queue = BackfillQueue(settings['checkpoint'])
+        logger.info("Backfilling {} windows".format(repair(wrong, queue)))
+        with metrics.span('backfill'):
+            failed += run_backfill(
+                queue, pool,
+                workers=settings['workers'],
+                workers_per_host=settings['workers_per_host'],
+                pause=parse_duration(settings['pause']) / SECOND
+            )
+        wrong = [result for result in wrong
+                 if not (result.missing or result.mismatched)]
+
+    return 1 if wrong or failed else 0
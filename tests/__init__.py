@@ -0,0 +1,24 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+from influxdb_aggregation.conf import CACHE_ENV, config
+
+# The tests never write the compiled configuration to the user cache
+_cache_directory = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, _cache_directory, True)
+os.environ[CACHE_ENV] = os.path.join(_cache_directory, 'config.json')
+
+
+def override_config(test, values):
+    """
+    Overrides configuration values for the rest of a test, see
+    LazyConfig.override.
+
+    :param test: unittest.TestCase
+    :param values: Dictionary of configuration values
+    """
+    override = config.override(values)
+    override.__enter__()
+    test.addCleanup(override.__exit__, None, None, None)
@@ -1,12 +1,39 @@
+import re
+
+from influxdb.exceptions import InfluxDBClientError
 from mock import Mock
 
+PAGE = re.compile(r'^(.*) LIMIT (\d+) OFFSET (\d+)$')
+# Statements returning a series per measurement
+PER_MEASUREMENT = ("SELECT ", "SHOW SERIES EXACT CARDINALITY", "SHOW TAG KEYS",
+                   "SHOW TAG VALUES EXACT CARDINALITY")
+SELECT_FROM = re.compile(r' FROM (.*?)(?: WHERE | WITH |$)')
+
+
+def selected_series(q, values):
+    """
+    Series a SELECT or SHOW SERIES returns, one for each measurement in its
+    FROM clause that has a value.
+    """
+    names = [
+        source.split(".")[-1].strip('"')
+        for source in SELECT_FROM.search(q).group(1).split(", ")
+    ]
+    return [(name, values[name]) for name in names if name in values]
+
 
 def make_client(measurements=None, continuous_queries=None,
-                retention_policies=None, show=None):
+                retention_policies=None, show=None, errors=None,
+                active=None, rates=None, cardinality=None, tag_keys=None,
+                tag_values=None):
     client = Mock()
+    if rates is None:
+        rates = {name: 1 for name in active or ()}
 
     if show is None:
         show = {}
+    if errors is None:
+        errors = {}
     if measurements is not None:
         show["MEASUREMENTS"] = measurements
     if continuous_queries is not None:
@@ -14,12 +41,18 @@ def make_client(measurements=None, continuous_queries=None,
     if retention_policies is not None:
         show["RETENTION POLICIES"] = retention_policies
 
-    def mock_query_result(q):
+    def mock_statement_result(q):
         if q.startswith("SHOW "):
             key = q[5:]
+            page = PAGE.match(key)
+            if page:
+                key = page.group(1)
             points = []
             if key in show:
                 points = show[key]
+            if page:
+                offset = int(page.group(3))
+                points = points[offset:offset + int(page.group(2))]
         elif q.startswith("CREATE "):
             client.create_query(q[7:])
             points = Mock()
@@ -29,14 +62,121 @@ def make_client(measurements=None, continuous_queries=None,
         elif q.startswith("DROP "):
             client.drop_query(q[5:])
             points = Mock()
+        elif q.startswith("SELECT "):
+            client.select_query(q)
+            points = Mock()
         else:
             client.other_query(q)
             points = Mock()
+        return points
+
+    def mock_query_result(q, raise_errors=True, **kwargs):
+        results = []
+        for statement_id, statement in enumerate(q.split("; ")):
+            query_result = Mock()
+            query_result.raw = {"statement_id": statement_id}
+            query_result.error = errors.get(statement)
+            if query_result.error is not None:
+                if raise_errors:
+                    raise InfluxDBClientError(query_result.error)
+                query_result.raw["error"] = query_result.error
+                results.append(query_result)
+                break
+            query_result.get_points.return_value = \
+                mock_statement_result(statement)
+            series = None
+            if statement.startswith("SELECT "):
+                series = [
+                    (name, [{"time": 0, "count_value": count}])
+                    for name, count in selected_series(statement, rates)
+                ]
+            elif statement.startswith("SHOW SERIES EXACT CARDINALITY"):
+                series = [
+                    (name, [{"count": count}])
+                    for name, count in selected_series(
+                        statement, cardinality or {}
+                    )
+                ]
+            elif statement.startswith("SHOW TAG VALUES EXACT CARDINALITY"):
+                key = statement.split(" WITH KEY = ")[1].strip('"')
+                series = [
+                    (name, [{"count": counts[key]}])
+                    for name, counts in selected_series(
+                        statement, tag_values or {}
+                    )
+                    if key in counts
+                ]
+            elif statement.startswith("SHOW TAG KEYS"):
+                series = [
+                    (name, [{"tagKey": key} for key in keys])
+                    for name, keys in selected_series(
+                        statement, tag_keys or {}
+                    )
+                ]
+            if series is not None:
+                query_result.keys.return_value = [
+                    (name, None) for name, _ in series
+                ]
+                query_result.items.return_value = [
+                    ((name, None), points) for name, points in series
+                ]
+            results.append(query_result)
 
-        query_result = Mock()
-        query_result.get_points.return_value = points
-        return query_result
+        if len(results) == 1:
+            return results[0]
+        return results
 
     client.query.side_effect = mock_query_result
 
     return client
+
+
+def make_async_client(**kwargs):
+    """
+    Wraps a mock client from make_client in the interface of
+    aio.AsyncInfluxClient, the mock client is the sync attribute.
+    """
+    sync = make_client(**kwargs)
+
+    def raw(statement, result):
+        raw_result = dict(result.raw)
+        if statement.startswith(PER_MEASUREMENT) and \
+                "error" not in raw_result:
+            raw_result["series"] = [
+                {"name": name, "columns": sorted(points[0]) if points else [],
+                 "values": [[p[c] for c in sorted(p)] for p in points]}
+                for (name, _), points in result.items.return_value
+            ]
+        elif "error" not in raw_result:
+            points = result.get_points.return_value
+            if isinstance(points, list) and points:
+                columns = sorted(points[0])
+                raw_result["series"] = [{
+                    "columns": columns,
+                    "values": [[p[c] for c in columns] for p in points]
+                }]
+        return raw_result
+
+    class AsyncClient(object):
+        async def query(self, query):
+            results = sync.query(query, raise_errors=False)
+            if not isinstance(results, list):
+                results = [results]
+            return [
+                raw(statement, result)
+                for statement, result in zip(query.split("; "), results)
+            ]
+
+        async def points(self, query):
+            results = await self.query(query)
+            if "error" in results[0]:
+                raise InfluxDBClientError(results[0]["error"])
+            return [
+                dict(zip(series["columns"], values))
+                for series in results[0].get("series", [])
+                for values in series["values"]
+            ]
+
+    client = AsyncClient()
+    client.sync = sync
+    return client
@@ -0,0 +1,124 @@
+import asyncio
+import copy
+import unittest
+
+from mock import AsyncMock, MagicMock, Mock, call
+
+from influxdb_aggregation import aio, cost
+from tests import test_main
+from tests.influx_mock import make_async_client
+
+
+class AsyncEngineTests(unittest.TestCase):
+    def setUp(self):
+        fixtures = test_main.AggregatorTests
+        self.db_config = copy.deepcopy(fixtures.db_config)
+        self.client = make_async_client(
+            measurements=copy.deepcopy(fixtures.measurements),
+            retention_policies=copy.deepcopy(
+                fixtures.expected_policy_result
+            ),
+            continuous_queries=copy.deepcopy(fixtures.expected_query_result)
+        )
+
+    def test_get_points(self):
+        self.assertEqual(
+            aio.get_points({"series": [
+                {"columns": ["name"], "values": [["a"], ["b"]]},
+                {"columns": ["name"], "values": [["c"]]},
+            ]}),
+            [{"name": "a"}, {"name": "b"}, {"name": "c"}]
+        )
+        self.assertEqual(aio.get_points({"statement_id": 0}), [])
+
+    def test_client_posts_statements_in_body(self):
+        response = MagicMock(status=200)
+        response.json = AsyncMock(return_value={"results": [{}]})
+        session = Mock()
+        session.request.return_value.__aenter__ = AsyncMock(
+            return_value=response
+        )
+        session.request.return_value.__aexit__ = AsyncMock(
+            return_value=False
+        )
+        client = aio.AsyncInfluxClient(session, "h", 1, "test")
+
+        asyncio.run(client.query("SHOW MEASUREMENTS"))
+        asyncio.run(client.query("CREATE CONTINUOUS QUERY a"))
+
+        self.assertEqual(session.request.call_args_list, [
+            call("GET", "http://h:1/query",
+                 params={"db": "test", "q": "SHOW MEASUREMENTS"}, data=None),
+            call("POST", "http://h:1/query", params={"db": "test"},
+                 data={"q": "CREATE CONTINUOUS QUERY a"}),
+        ])
+
+    def test_reconcile_database(self):
+        self.db_config["desired_policies"].append({
+            "rollup": "2m",
+            "retention": "24h0m0s",
+            "replication": 1,
+            "shard_duration": "4h"
+        })
+
+        requests = asyncio.run(
+            aio.reconcile_database(self.client, self.db_config)
+        )
+
+        self.assertEqual(requests, 1)
+        self.client.sync.create_query.assert_any_call(
+            "RETENTION POLICY rollup_2m ON test "
+            "DURATION 24h0m0s REPLICATION 1 SHARD DURATION 4h"
+        )
+        self.client.sync.create_query.assert_any_call(
+            "CONTINUOUS QUERY test_measurement_rollup_2m ON test BEGIN "
+            "SELECT mean(value) AS value, max(value) AS max_value, "
+            "min(value) AS min_value INTO test.rollup_2m.test_measurement "
+            "FROM test.input.test_measurement GROUP BY *, time(2m) END"
+        )
+
+    def test_reconcile_database_budget(self):
+        client = make_async_client(
+            measurements=[{"name": "big"}, {"name": "test_measurement"}],
+            retention_policies=copy.deepcopy(
+                test_main.AggregatorTests.expected_policy_result
+            ),
+            continuous_queries=copy.deepcopy(
+                test_main.AggregatorTests.expected_query_result
+            ),
+            rates={"big": 600000, "test_measurement": 600},
+            cardinality={"big": 50000, "test_measurement": 10}
+        )
+        self.db_config["cost_budget"] = {"max_series": 1000}
+
+        with self.assertLogs(cost.logger) as logs:
+            asyncio.run(aio.reconcile_database(client, self.db_config))
+        self.assertIn("big_rollup_20m is over the series budget",
+                      logs.output[0])
+        client.sync.create_query.assert_called_once()
+
+        client.sync.create_query.reset_mock()
+        self.db_config["cost_budget"]["action"] = "refuse"
+        with self.assertLogs(cost.logger) as logs:
+            requests = asyncio.run(
+                aio.reconcile_database(client, self.db_config)
+            )
+        self.assertEqual(requests, 0)
+        self.assertIn("Not creating big_rollup_20m", logs.output[0])
+        client.sync.create_query.assert_not_called()
+
+    def test_process_databases(self):
+        failing = make_async_client(errors={
+            "SHOW RETENTION POLICIES": "database not found"
+        })
+        clients = {"test": self.client, "other": failing}
+        configs = [self.db_config, dict(self.db_config, database="other")]
+
+        results = asyncio.run(aio.process_databases(
+            configs, lambda db_config: clients[db_config["database"]],
+            concurrency=2, per_host=1, timeout=5
+        ))
+
+        self.assertEqual([r.database for r in results], ["test", "other"])
+        self.assertIsNone(results[0].error)
+        self.assertIsNotNone(results[1].error)
@@ -0,0 +1,184 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from mock import patch
+
+from influxdb_aggregation import apply
+from influxdb_aggregation.apply import Statement
+from tests.influx_mock import make_client
+
+
+class ApplyTests(unittest.TestCase):
+    statements = [
+        Statement(apply.QUERY_CREATE, "CREATE CONTINUOUS QUERY a", "a"),
+        Statement(apply.QUERY_DROP, "DROP CONTINUOUS QUERY a", "drop a"),
+        Statement(apply.POLICY_CREATE, "CREATE RETENTION POLICY p", "p"),
+        Statement(apply.QUERY_CREATE, "CREATE CONTINUOUS QUERY b", "b"),
+    ]
+
+    def test_order_statements(self):
+        self.assertEqual(
+            [s.description for s in apply.order_statements(self.statements)],
+            ["p", "drop a", "a", "b"]
+        )
+
+    def test_batch_statements_count(self):
+        batches = list(apply.batch_statements(self.statements, 3, 65536))
+        self.assertEqual([len(batch) for batch in batches], [3, 1])
+
+    def test_batch_statements_bytes(self):
+        batches = list(apply.batch_statements(self.statements, 100, 50))
+        self.assertEqual([len(batch) for batch in batches], [2, 1, 1])
+
+        batches = list(apply.batch_statements(self.statements, 100, 10))
+        self.assertEqual([len(batch) for batch in batches], [1, 1, 1, 1])
+
+    def test_apply_statements(self):
+        client = make_client()
+
+        requests = apply.apply_statements(client, self.statements, 10)
+
+        self.assertEqual(requests, 1)
+        client.query.assert_called_once_with(
+            "CREATE RETENTION POLICY p; DROP CONTINUOUS QUERY a; "
+            "CREATE CONTINUOUS QUERY a; CREATE CONTINUOUS QUERY b",
+            raise_errors=False, method='POST'
+        )
+
+    def test_apply_statements_error(self):
+        client = make_client(errors={"CREATE CONTINUOUS QUERY a": "boom"})
+
+        with self.assertRaises(apply.ApplyError) as context:
+            apply.apply_statements(client, self.statements, 10)
+
+        self.assertEqual(context.exception.statement.description, "a")
+        self.assertEqual(context.exception.error, "boom")
+        client.create_query.assert_called_once_with("RETENTION POLICY p")
+
+    def test_apply_statements_parse_error(self):
+        client = make_client()
+        client.query.side_effect = InfluxDBClientError(
+            "error parsing query: found EOF, expected BEGIN at line 1, "
+            "char 60"
+        )
+
+        with self.assertRaises(apply.ApplyError) as context:
+            apply.apply_statements(client, self.statements, 10)
+
+        self.assertEqual(context.exception.statement.description, "a")
+
+    def test_rate_limiter_aimd(self):
+        limiter = apply.RateLimiter(rate=10, min_rate=2, max_rate=12,
+                                    target_latency=0.5, increase=5,
+                                    decrease=0.5)
+        limiter.observe(0.1)
+        self.assertEqual(limiter.rate, 12)
+        limiter.observe(1)
+        self.assertEqual(limiter.rate, 6)
+        limiter.backoff()
+        limiter.backoff()
+        self.assertEqual(limiter.rate, 2)
+
+    @patch("influxdb_aggregation.apply.time")
+    def test_rate_limiter_wait(self, mock_time):
+        mock_time.time.return_value = 100.0
+        limiter = apply.RateLimiter(rate=10, min_rate=1, max_rate=10,
+                                    target_latency=1, increase=1,
+                                    decrease=0.5)
+        limiter.wait(5)
+        mock_time.sleep.assert_not_called()
+        limiter.wait(1)
+        mock_time.sleep.assert_called_once_with(0.5)
+
+    def test_is_transient(self):
+        self.assertTrue(apply.is_transient(InfluxDBServerError("500")))
+        self.assertTrue(apply.is_transient("timeout"))
+        self.assertTrue(apply.is_transient(
+            InfluxDBClientError("Too Many Requests", 429)
+        ))
+        self.assertFalse(apply.is_transient(
+            "continuous query already exists"
+        ))
+
+    def test_retry_delay(self):
+        with patch("influxdb_aggregation.apply.random.uniform",
+                   side_effect=lambda low, high: high):
+            self.assertEqual(apply.retry_delay(0, 1, 30), 1)
+            self.assertEqual(apply.retry_delay(3, 1, 30), 8)
+            self.assertEqual(apply.retry_delay(10, 1, 30), 30)
+        with patch("influxdb_aggregation.apply.random.uniform",
+                   side_effect=lambda low, high: low):
+            self.assertEqual(apply.retry_delay(3, 1, 30), 4)
+
+    @patch("influxdb_aggregation.apply.time.sleep")
+    def test_apply_statements_retries_transient_errors(self, sleep):
+        errors = {"CREATE CONTINUOUS QUERY a": "timeout"}
+        client = make_client(errors=errors)
+        sleep.side_effect = lambda seconds: errors.clear()
+
+        requests = apply.apply_statements(client, self.statements, 10,
+                                          retries=2)
+
+        self.assertEqual(requests, 2)
+        # Retried from the statement that failed
+        client.query.assert_called_with(
+            "CREATE CONTINUOUS QUERY a; CREATE CONTINUOUS QUERY b",
+            raise_errors=False, method='POST'
+        )
+
+    @patch("influxdb_aggregation.apply.time.sleep")
+    def test_apply_statements_gives_up(self, sleep):
+        client = make_client(errors={"CREATE CONTINUOUS QUERY a": "timeout"})
+
+        with self.assertRaises(apply.ApplyError):
+            apply.apply_statements(client, self.statements, 10, retries=2)
+        self.assertEqual(client.query.call_count, 3)
+
+        client = make_client(errors={"CREATE CONTINUOUS QUERY a": "boom"})
+        with self.assertRaises(apply.ApplyError):
+            apply.apply_statements(client, self.statements, 10, retries=2)
+        client.query.assert_called_once()
+
+    def test_journal_skips_applied_statements(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "journal.json")
+        client = make_client(errors={"CREATE CONTINUOUS QUERY a": "boom"})
+
+        with self.assertRaises(apply.ApplyError):
+            apply.apply_statements(client, self.statements, 10,
+                                   journal=apply.ApplyJournal(path), key="k")
+
+        journal = apply.ApplyJournal(path)
+        self.assertEqual(len(journal.entries["k"]), 2)
+        client = make_client()
+        apply.apply_statements(client, self.statements, 10,
+                               journal=journal, key="k")
+        client.query.assert_called_once_with(
+            "CREATE CONTINUOUS QUERY a; CREATE CONTINUOUS QUERY b",
+            raise_errors=False, method='POST'
+        )
+        # Forgotten once all statements are applied
+        self.assertEqual(apply.ApplyJournal(path).entries, {})
+
+    def test_journal_scoped_to_plan(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        journal = apply.ApplyJournal(os.path.join(directory, "journal.json"))
+        key = journal.plan_key("h:1/db", self.statements)
+        other = journal.plan_key("h:1/db", self.statements[1:])
+        self.assertNotEqual(key, other)
+
+        journal.record(key, self.statements[:1])
+        journal.record(journal.plan_key("h:1/db2", []), self.statements[:1])
+        self.assertFalse(journal.applied(other, self.statements[0]))
+
+        # Another plan of the database forgets the entries of the first
+        journal.start(other)
+        self.assertEqual(
+            sorted(journal.entries),
+            [journal.plan_key("h:1/db2", [])]
+        )
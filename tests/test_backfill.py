@@ -0,0 +1,217 @@
+import copy
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mock import Mock, patch
+
+from influxdb_aggregation import backfill, main
+from influxdb_aggregation.durations import HOUR, MINUTE
+from influxdb_aggregation.pool import ClientPool
+from tests import override_config, test_main
+from tests.influx_mock import make_client
+
+CREATE = "CREATE CONTINUOUS QUERY m_rollup_1h ON test BEGIN " \
+         "SELECT mean(value) AS value INTO test.rollup_1h.m " \
+         "FROM test.input.m GROUP BY *, time(1h, 15m) END"
+SELECT = "SELECT mean(value) AS value INTO test.rollup_1h.m " \
+         "FROM test.input.m GROUP BY *, time(1h, 15m)"
+DB_CONFIG = {"host": "h", "port": 1, "database": "test",
+             "default_policy": {"retention": "48h"}}
+NOW = 1000 * HOUR + 40 * MINUTE
+
+
+class BackfillTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "backfill.json")
+        override_config(self, {"backfill": {"chunk": "4h",
+                                            "max_age": "30d"}})
+
+    def test_select_query(self):
+        self.assertEqual(backfill.select_query(CREATE), SELECT)
+        with self.assertRaises(ValueError):
+            backfill.select_query("SELECT 1")
+
+    def test_backfill_query(self):
+        self.assertEqual(
+            backfill.backfill_query(SELECT, 10, 20),
+            "SELECT mean(value) AS value INTO test.rollup_1h.m "
+            "FROM test.input.m WHERE time >= 10 AND time < 20 "
+            "GROUP BY *, time(1h, 15m)"
+        )
+
+    def test_backfill_filtering_query(self):
+        select = "SELECT mean(value) AS value INTO test.rollup_1h.m " \
+                 "FROM test.input.m WHERE host = 'a' OR host = 'b' " \
+                 "GROUP BY *, time(1h, 15m)"
+        self.assertEqual(
+            backfill.backfill_query(select, 10, 20),
+            "SELECT mean(value) AS value INTO test.rollup_1h.m "
+            "FROM test.input.m WHERE time >= 10 AND time < 20 AND "
+            "(host = 'a' OR host = 'b') GROUP BY *, time(1h, 15m)"
+        )
+
+    def test_add(self):
+        queue = backfill.BackfillQueue(self.path)
+        queue.add(DB_CONFIG, [
+            ("m_rollup_1h",
+             {"query": CREATE, "retention": "10h", "measurement": "m"})
+        ], now=NOW)
+
+        entry = queue.entries["h:1/test/m_rollup_1h"]
+        # Whole intervals, shifted by the GROUP BY offset
+        self.assertEqual(entry["end"], 1000 * HOUR + 15 * MINUTE)
+        self.assertEqual(entry["start"], 990 * HOUR + 15 * MINUTE)
+        self.assertEqual(entry["step"], 4 * HOUR)
+        self.assertEqual(entry["query"], SELECT)
+
+        # The checkpoint survives
+        self.assertEqual(backfill.BackfillQueue(self.path).entries,
+                         queue.entries)
+
+    def test_add_bounded_by_data_read(self):
+        queue = backfill.BackfillQueue(None)
+        with main.config.override({"backfill": {"chunk": "1d"}}):
+            queue.add(DB_CONFIG, [
+                ("m_rollup_1h",
+                 {"query": CREATE, "retention": "90d", "measurement": "m"})
+            ], now=NOW)
+        client = make_client()
+
+        with ClientPool(Mock(return_value=client)) as pool:
+            self.assertEqual(backfill.run_backfill(queue, pool, pause=0), 0)
+
+        # Only the 48h of the input policy, not the 30d of max_age
+        self.assertEqual(client.select_query.call_count, 2)
+        client.select_query.assert_called_with(backfill.backfill_query(
+            SELECT, 952 * HOUR + 15 * MINUTE, 976 * HOUR + 15 * MINUTE
+        ))
+
+    def test_add_chained_bounded_by_source(self):
+        db_config = dict(DB_CONFIG, chained_rollups=True, desired_policies=[
+            {"rollup": "5m", "retention": "10h"},
+            {"rollup": "1h", "retention": "90d"},
+        ])
+        queue = backfill.BackfillQueue(None)
+        queue.add(db_config, [
+            ("m_rollup_1h",
+             {"query": CREATE, "rollup": "1h", "retention": "90d",
+              "measurement": "m"})
+        ], now=NOW)
+
+        entry = queue.entries["h:1/test/m_rollup_1h"]
+        self.assertEqual(entry["end"] - entry["start"], 10 * HOUR)
+
+    def test_run_backfill_resumes(self):
+        client = make_client()
+        client.select_query.side_effect = [None, RuntimeError("timeout")]
+        queue = backfill.BackfillQueue(self.path)
+        queue.add(DB_CONFIG, [
+            ("m_rollup_1h",
+             {"query": CREATE, "retention": "10h", "measurement": "m"})
+        ], now=NOW)
+
+        with ClientPool(Mock(return_value=client)) as pool:
+            self.assertEqual(backfill.run_backfill(queue, pool, pause=0), 1)
+
+        # Newest chunk first, the failed one is still to do
+        client.select_query.assert_any_call(backfill.backfill_query(
+            SELECT, 996 * HOUR + 15 * MINUTE, 1000 * HOUR + 15 * MINUTE
+        ))
+        queue = backfill.BackfillQueue(self.path)
+        self.assertEqual(queue.entries["h:1/test/m_rollup_1h"]["end"],
+                         996 * HOUR + 15 * MINUTE)
+
+        client.select_query.reset_mock(side_effect=True)
+        with ClientPool(Mock(return_value=client)) as pool:
+            self.assertEqual(backfill.run_backfill(queue, pool, pause=0), 0)
+        self.assertEqual(client.select_query.call_count, 2)
+        self.assertEqual(backfill.BackfillQueue(self.path).entries, {})
+
+    def test_run_backfill_host_does_not_block_others(self):
+        other_host_ran = threading.Event()
+
+        def select_query(query):
+            if "FROM other.input.m" in query:
+                other_host_ran.set()
+            # The second group of h waits for its host, the group of the
+            # other host must not wait behind it
+            elif not other_host_ran.wait(5):
+                raise RuntimeError("other waited for h")
+
+        client = make_client()
+        client.select_query.side_effect = select_query
+        queue = backfill.BackfillQueue(None)
+        queue.add(DB_CONFIG, [
+            ("m_rollup_1h",
+             {"query": CREATE, "retention": "4h", "measurement": "m"}),
+            ("n_rollup_1h",
+             {"query": CREATE.replace(".m ", ".n "), "retention": "4h",
+              "measurement": "n"}),
+        ], now=NOW)
+        queue.add(dict(DB_CONFIG, host="other", database="other"), [
+            ("m_rollup_1h",
+             {"query": CREATE.replace("test.", "other."), "retention": "4h",
+              "measurement": "m"}),
+        ], now=NOW)
+
+        with ClientPool(Mock(return_value=client)) as pool:
+            self.assertEqual(
+                backfill.run_backfill(queue, pool, workers=2,
+                                      workers_per_host=1, pause=0),
+                0
+            )
+        self.assertEqual(queue.entries, {})
+
+    def test_groups_run_finer_rollups_first(self):
+        queue = backfill.BackfillQueue(None)
+        queue.add(DB_CONFIG, [
+            ("m_rollup_1d", {
+                "query": CREATE.replace("time(1h, 15m)", "time(1d)"),
+                "retention": "0s", "measurement": "m"
+            }),
+            ("m_rollup_1h",
+             {"query": CREATE, "retention": "10h", "measurement": "m"}),
+            ("n_rollup_1h",
+             {"query": CREATE, "retention": "10h", "measurement": "n"}),
+        ], now=NOW)
+
+        self.assertEqual(
+            [[key for key, _ in group] for group in queue.groups()],
+            [["h:1/test/m_rollup_1h", "h:1/test/m_rollup_1d"],
+             ["h:1/test/n_rollup_1h"]]
+        )
+
+    def test_process_databases_backfills_new_queries(self):
+        fixtures = test_main.AggregatorTests
+        config = copy.deepcopy(fixtures.db_config)
+        config["desired_policies"].append({
+            "rollup": "2m",
+            "retention": "1h",
+            "replication": 1,
+            "shard_duration": "4h"
+        })
+        client = make_client(
+            measurements=copy.deepcopy(fixtures.measurements),
+            retention_policies=copy.deepcopy(
+                fixtures.expected_policy_result
+            ),
+            continuous_queries=copy.deepcopy(fixtures.expected_query_result)
+        )
+        queue = backfill.BackfillQueue(self.path)
+
+        with patch("influxdb_aggregation.main.InfluxDBClient",
+                   return_value=client), \
+                main.config.override({"backfill": {"pause": "0s"}}):
+            main.process_databases([config], backfill=queue)
+
+        # One hour of two minute rollups, in a single chunk
+        client.select_query.assert_called_once()
+        query = client.select_query.call_args[0][0]
+        self.assertIn("INTO test.rollup_2m.test_measurement", query)
+        self.assertIn("WHERE time >= ", query)
+        self.assertEqual(queue.entries, {})
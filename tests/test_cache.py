@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from influxdb_aggregation.cache import StateCache
+
+
+class StateCacheTests(unittest.TestCase):
+    db_config = {"host": "test_host", "port": 0, "database": "test"}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "state.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_key(self):
+        self.assertEqual(StateCache.key(self.db_config), "test_host:0/test")
+
+    def test_is_fresh(self):
+        cache = StateCache(self.path, 60)
+        self.assertFalse(cache.is_fresh("a", "f1"))
+
+        cache.update("a", "f1")
+
+        self.assertTrue(cache.is_fresh("a", "f1"))
+        self.assertFalse(cache.is_fresh("a", "f2"))
+        self.assertTrue(StateCache(self.path, 60).is_fresh("a", "f1"))
+
+    def test_ttl(self):
+        cache = StateCache(self.path, 60)
+        with patch("influxdb_aggregation.cache.time.time", return_value=0):
+            cache.update("a", "f1")
+        with patch("influxdb_aggregation.cache.time.time", return_value=61):
+            self.assertFalse(cache.is_fresh("a", "f1"))
+
+    def test_invalidate(self):
+        cache = StateCache(self.path, 60)
+        cache.update("a", "f1")
+        cache.update("b", "f1")
+
+        cache.invalidate("a")
+        self.assertFalse(cache.is_fresh("a", "f1"))
+        self.assertTrue(cache.is_fresh("b", "f1"))
+
+        cache.invalidate()
+        self.assertFalse(StateCache(self.path, 60).is_fresh("b", "f1"))
+
+    def test_broken_file(self):
+        with open(self.path, "w") as cache_file:
+            cache_file.write("{")
+
+        self.assertEqual(StateCache(self.path, 60).entries, {})
@@ -0,0 +1,158 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from mock import patch
+
+from influxdb_aggregation import conf, main
+
+
+class ConfTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = os.path.join(self.directory, "cache", "config.json")
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as config_file:
+            config_file.write(text)
+        return path
+
+    def test_import_does_not_parse(self):
+        code = ("import yaml\n"
+                "yaml.safe_load = None\n"
+                "import influxdb_aggregation.main\n")
+        subprocess.check_call([sys.executable, "-c", code])
+
+    def test_include_and_merge(self):
+        self.write("base.yaml", "apply:\n  rate: 10\nhost: base\n")
+        path = self.write("main.yaml",
+                          "include: base.yaml\n"
+                          "host: main\n"
+                          "configs:\n"
+                          "  - database: a\n"
+                          "  - database: b\n"
+                          "    port: 8087\n")
+
+        configuration = conf.load_config([path])
+
+        self.assertEqual(configuration["apply"]["rate"], 10)
+        self.assertEqual(configuration["apply"]["retries"], 5)
+        self.assertEqual(
+            [(c["database"], c["host"], c["port"])
+             for c in configuration["configs"]],
+            [("a", "main", 8086), ("b", "main", 8087)]
+        )
+
+    def test_directory(self):
+        self.write("conf.d/20-late.yaml", "measurement_page_size: 20\n")
+        self.write("conf.d/10-early.yaml", "measurement_page_size: 10\n"
+                                           "connection_pool_size: 3\n")
+        self.write("conf.d/notes.txt", "measurement_page_size: 30\n")
+
+        configuration = conf.load_config(
+            [os.path.join(self.directory, "conf.d")]
+        )
+
+        self.assertEqual(configuration["measurement_page_size"], 20)
+        self.assertEqual(configuration["connection_pool_size"], 3)
+
+    def test_default_policy_per_database(self):
+        path = self.write("main.yaml",
+                          "configs:\n"
+                          "  - database: a\n"
+                          "    default_policy:\n"
+                          "      shard_duration: 2h\n"
+                          "  - database: b\n")
+
+        first, second = conf.load_config([path])["configs"]
+
+        self.assertEqual(first["default_policy"]["shard_duration"], "2h")
+        self.assertEqual(second["default_policy"]["shard_duration"], "1h")
+        first["desired_policies"][0]["rollup"] = "10m"
+        self.assertEqual(second["desired_policies"][0]["rollup"], "5m")
+
+    def test_validation(self):
+        cases = [
+            ("hots: a\n", "unknown key 'hots'"),
+            ("port: '8086'\n", "port: expected int"),
+            ("stagger: 1\n", "stagger: expected bool"),
+            ("apply:\n  rate: true\n", "apply.rate: expected int or float"),
+            ("daemon:\n  poll_interval: 5 minutes\n", "invalid duration"),
+            ("orphaned_queries: delete\n", "expected one of drop, keep"),
+            ("policy_name_template: 'rollup_{rollup'\n", "invalid template"),
+            ("configs:\n  - database: a\n    desired_policies:\n"
+             "      - retention: 1d\n",
+             "configs[0].desired_policies[0]: missing rollup"),
+            ("include: main.yaml\n", "included by itself"),
+            ("- a\n", "expected a mapping"),
+        ]
+        for text, message in cases:
+            path = self.write("main.yaml", text)
+            with self.assertRaises(conf.ConfigError) as context:
+                conf.load_config([path])
+            self.assertIn(message, str(context.exception))
+
+    def test_cache(self):
+        path = self.write("main.yaml", "measurement_page_size: 10\n")
+        self.assertEqual(
+            conf.load_config([path], self.cache)["measurement_page_size"], 10
+        )
+
+        with patch("influxdb_aggregation.conf.yaml.safe_load",
+                   side_effect=AssertionError("parsed")):
+            self.assertEqual(
+                conf.load_config([path], self.cache)["measurement_page_size"],
+                10
+            )
+            # Touched but unchanged
+            stat = os.stat(path)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            conf.load_config([path], self.cache)
+
+        self.write("main.yaml", "measurement_page_size: 20\n")
+        self.assertEqual(
+            conf.load_config([path], self.cache)["measurement_page_size"], 20
+        )
+
+    def test_no_cache_without_files(self):
+        self.assertEqual(
+            conf.load_config([], self.cache)["measurement_page_size"], 10000
+        )
+        self.assertFalse(os.path.exists(self.cache))
+
+    def test_config_is_read_only(self):
+        configuration = conf.LazyConfig()
+        configuration.replace(conf.load_config())
+
+        with self.assertRaises(TypeError):
+            configuration["measurement_page_size"] = 1
+        with self.assertRaises(TypeError):
+            configuration["apply"]["retries"] = 0
+        with self.assertRaises(TypeError):
+            configuration["configs"][0]["database"] = "other"
+
+        with configuration.override({"apply": {"retries": 0},
+                                     "measurement_page_size": 1}):
+            self.assertEqual(configuration["apply"]["retries"], 0)
+            self.assertEqual(configuration["apply"]["rate"], 50)
+            self.assertEqual(configuration["measurement_page_size"], 1)
+        self.assertEqual(configuration["apply"]["retries"], 5)
+        self.assertEqual(configuration["measurement_page_size"], 10000)
+
+        copied = configuration.copy()
+        copied["configs"][0]["database"] = "other"
+        self.assertEqual(configuration["configs"][0]["database"],
+                         "prometheus")
+
+    def test_main_reports_invalid_config(self):
+        path = self.write("main.yaml", "hots: a\n")
+        with patch("sys.stderr"), self.assertRaises(SystemExit) as context:
+            main.main(["--config", path, "--config-cache", ""])
+        self.assertEqual(context.exception.code, 2)
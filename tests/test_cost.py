@@ -0,0 +1,192 @@
+import copy
+import unittest
+
+from influxdb_aggregation import cost, main
+from influxdb_aggregation.durations import MINUTE
+from tests import test_main
+from tests.influx_mock import make_client
+
+
+class CostTests(unittest.TestCase):
+    def setUp(self):
+        fixtures = test_main.AggregatorTests
+        self.db_config = copy.deepcopy(fixtures.db_config)
+        self.measurements = [{"name": "big"}, {"name": "test_measurement"}]
+        self.client = make_client(
+            measurements=self.measurements,
+            retention_policies=copy.deepcopy(
+                fixtures.expected_policy_result
+            ),
+            continuous_queries=copy.deepcopy(fixtures.expected_query_result),
+            # Points in the 10 minute rate window
+            rates={"big": 600000, "test_measurement": 600},
+            cardinality={"big": 50000, "test_measurement": 10}
+        )
+
+    def test_stats_query(self):
+        self.assertEqual(
+            cost.stats_query("test", ["cpu", "go-gc"], 10 * MINUTE),
+            'SHOW SERIES EXACT CARDINALITY FROM test.input.cpu, '
+            'test.input."go-gc"; SELECT count(*) FROM test.input.cpu, '
+            'test.input."go-gc" WHERE time > now() - 600s'
+        )
+        self.assertEqual(
+            cost.stats_query("test", ["cpu"], 10 * MINUTE, ["host", "pod"]),
+            'SHOW SERIES EXACT CARDINALITY FROM test.input.cpu; '
+            'SELECT count(*) FROM test.input.cpu WHERE time > now() - 600s; '
+            'SHOW TAG VALUES EXACT CARDINALITY FROM test.input.cpu '
+            'WITH KEY = host; '
+            'SHOW TAG VALUES EXACT CARDINALITY FROM test.input.cpu '
+            'WITH KEY = pod'
+        )
+
+    def test_collect_stats(self):
+        stats = {}
+        measurements = cost.collect_stats(
+            self.client, dict(self.db_config, cost_budget={}),
+            ["big", "test_measurement"], stats
+        )
+        self.assertEqual(list(measurements), ["big", "test_measurement"])
+        self.assertEqual(stats, {})
+
+        measurements = cost.collect_stats(
+            self.client, dict(self.db_config, cost_budget={"max_points": 1}),
+            ["big", "test_measurement"], stats
+        )
+        self.assertEqual(next(measurements), "big")
+        self.assertEqual(stats, {
+            "big": {"series": 50000, "rate": 1000.0, "tags": {}},
+            "test_measurement": {"series": 10, "rate": 1.0, "tags": {}},
+        })
+
+    def test_collect_tag_values(self):
+        self.client = make_client(
+            measurements=self.measurements,
+            rates={"big": 600000, "test_measurement": 600},
+            cardinality={"big": 50000, "test_measurement": 10},
+            tag_values={"big": {"host": 100, "pod": 500},
+                        "test_measurement": {"host": 2}}
+        )
+        db_config = dict(self.db_config, cost_budget={"max_points": 1})
+        db_config["desired_policies"] = [
+            dict(self.db_config["desired_policies"][0], keep_tags=["host"]),
+            dict(self.db_config["desired_policies"][0], rollup="1h",
+                 drop_tags=["pod"]),
+        ]
+        self.assertEqual(cost.budget_tag_keys(db_config), ["host", "pod"])
+
+        stats = {}
+        list(cost.collect_stats(self.client, db_config,
+                                ["big", "test_measurement"], stats))
+        self.assertEqual(stats, {
+            "big": {"series": 50000, "rate": 1000.0,
+                    "tags": {"host": 100, "pod": 500}},
+            "test_measurement": {"series": 10, "rate": 1.0,
+                                 "tags": {"host": 2}},
+        })
+
+    def test_query_cost(self):
+        self.assertEqual(
+            cost.query_cost({"series": 10, "rate": 1.5}, 20 * MINUTE),
+            {"points": 1800, "series": 10}
+        )
+        # A chained rollup reads the points of the rollup it reads
+        self.assertEqual(
+            cost.query_cost({"series": 10, "rate": 1.5}, 60 * MINUTE,
+                            source=(20 * MINUTE, 4)),
+            {"points": 12, "series": 10}
+        )
+
+    def test_series_written(self):
+        stats = {"series": 50000, "rate": 1000.0,
+                 "tags": {"host": 100, "pod": 500}}
+        self.assertEqual(cost.series_written(stats), 50000)
+        self.assertEqual(cost.series_written(stats, []), 1)
+        self.assertEqual(cost.series_written(stats, ["host"]), 100)
+        self.assertEqual(cost.series_written(stats, ["host", "pod"]), 50000)
+        # The values of region are not counted, the tags left out merge series
+        self.assertEqual(cost.series_written(stats, ["host", "region"]), 100)
+        self.assertEqual(cost.series_written(stats, ["pod", "region"]), 500)
+        self.assertEqual(cost.series_written(dict(stats, series=0), []), 0)
+
+    def test_chained_rollups_cost(self):
+        db_config = dict(self.db_config, chained_rollups=True,
+                         cost_budget={"max_points": 1000000,
+                                      "action": "refuse"})
+        db_config["desired_policies"] = [
+            self.db_config["desired_policies"][0],
+            dict(self.db_config["desired_policies"][0], rollup="2h",
+                 keep_tags=["host"]),
+        ]
+        stats = {"big": {"series": 50000, "rate": 1000.0,
+                         "tags": {"host": 100}}}
+        refused = set()
+
+        with main.config.override({"cost": {"report": 2}}), \
+                self.assertLogs(cost.logger) as logs:
+            queries = [name for name, _ in cost.within_budget(
+                db_config,
+                main.iter_query_info(db_config, ["big"],
+                                     {"big": ["host", "pod"]}),
+                stats, refused
+            )]
+
+        # Reading the 20m rollup, the 2h rollup reads 6 points of each of
+        # its series instead of 2h of input
+        self.assertEqual(queries, ["big_rollup_2h"])
+        self.assertEqual(refused, {"big_rollup_20m"})
+        self.assertIn("Cost of big_rollup_2h per run: 300000 points, 100 "
+                      "series", logs.output[-1])
+
+    def test_flag_over_budget(self):
+        self.db_config["cost_budget"] = {"max_series": 1000}
+
+        with self.assertLogs(cost.logger) as logs:
+            main.reconcile_database(self.client, self.db_config)
+
+        self.assertIn("big_rollup_20m is over the series budget",
+                      logs.output[0])
+        self.assertIn("Cost of big_rollup_20m per run: 1200000 points, "
+                      "50000 series", logs.output[1])
+        self.client.create_query.assert_called_once()
+
+    def test_refuse_over_budget(self):
+        self.db_config["cost_budget"] = {
+            "max_points": 100000, "action": "refuse"
+        }
+
+        with main.config.override({"cost": {"report": 0}}), \
+                self.assertLogs(cost.logger) as logs:
+            main.reconcile_database(self.client, self.db_config)
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("Not creating big_rollup_20m, over the points budget",
+                      logs.output[0])
+        self.client.create_query.assert_not_called()
+
+    def test_refused_queries_are_not_orphans(self):
+        self.db_config["cost_budget"] = {
+            "max_points": 100000, "action": "refuse"
+        }
+        self.db_config["orphaned_queries"] = "drop"
+        self.client = make_client(
+            measurements=self.measurements,
+            retention_policies=copy.deepcopy(
+                test_main.AggregatorTests.expected_policy_result
+            ),
+            continuous_queries=[{
+                "name": "big_rollup_20m",
+                "query": "CREATE CONTINUOUS QUERY big_rollup_20m ..."
+            }] + copy.deepcopy(
+                test_main.AggregatorTests.expected_query_result
+            ),
+            rates={"big": 600000, "test_measurement": 600},
+            cardinality={"big": 50000, "test_measurement": 10}
+        )
+
+        with main.config.override({"cost": {"report": 0}}), \
+                self.assertLogs(cost.logger):
+            main.reconcile_database(self.client, self.db_config)
+
+        self.client.drop_query.assert_not_called()
+        self.client.create_query.assert_not_called()
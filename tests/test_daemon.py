@@ -0,0 +1,185 @@
+import copy
+import threading
+import unittest
+
+from mock import Mock, patch
+
+from influxdb_aggregation import cost, daemon
+from tests.influx_mock import make_client
+from tests import test_main
+
+
+class DatabaseWatcherTests(unittest.TestCase):
+    db_config = test_main.AggregatorTests.db_config
+
+    def make_watcher(self, client):
+        return daemon.DatabaseWatcher(
+            client, copy.deepcopy(self.db_config),
+            poll_interval=10, max_poll_interval=80, slow_poll=5,
+            full_interval=100
+        )
+
+    def setUp(self):
+        fixtures = test_main.AggregatorTests
+        self.measurements = copy.deepcopy(fixtures.measurements)
+        self.client = make_client(
+            measurements=self.measurements,
+            retention_policies=copy.deepcopy(
+                fixtures.expected_policy_result
+            ),
+            continuous_queries=copy.deepcopy(
+                fixtures.expected_query_result
+            )
+        )
+
+    def test_discovers_new_measurements(self):
+        watcher = self.make_watcher(self.client)
+        watcher.poll(now=0)
+        self.assertEqual(watcher.known, {"test_measurement"})
+        self.assertEqual(watcher.next_poll, 10)
+        self.client.create_query.assert_not_called()
+
+        self.measurements.insert(0, {"name": "new_measurement"})
+        self.client.query.reset_mock()
+        watcher.poll(now=10)
+
+        self.client.create_query.assert_called_once_with(
+            "CONTINUOUS QUERY new_measurement_rollup_20m ON test "
+            "BEGIN SELECT mean(value) AS value, max(value) AS max_value, "
+            "min(value) AS min_value INTO test.rollup_20m.new_measurement "
+            "FROM test.input.new_measurement GROUP BY *, time(20m) END"
+        )
+        self.client.query.assert_any_call(
+            "SHOW MEASUREMENTS LIMIT 10000 OFFSET 0"
+        )
+        self.client.query.assert_any_call("SHOW CONTINUOUS QUERIES")
+        # Incremental polls do not look at the policies
+        self.assertEqual(self.client.query.call_count, 3)
+        self.assertIn("new_measurement", watcher.known)
+
+    def test_discover_keeps_existing_queries(self):
+        continuous_queries = copy.deepcopy(
+            test_main.AggregatorTests.expected_query_result
+        )
+        self.client = make_client(
+            measurements=self.measurements,
+            retention_policies=copy.deepcopy(
+                test_main.AggregatorTests.expected_policy_result
+            ),
+            continuous_queries=continuous_queries
+        )
+        watcher = self.make_watcher(self.client)
+        watcher.poll(now=0)
+
+        # The measurement goes away, its query is kept as an orphan
+        del self.measurements[:]
+        watcher.reconcile()
+        self.assertEqual(watcher.known, set())
+
+        # It comes back with its query in place
+        self.measurements.append({"name": "test_measurement"})
+        watcher.poll(now=10)
+        self.assertEqual(watcher.known, {"test_measurement"})
+        self.client.create_query.assert_not_called()
+        self.client.drop_query.assert_not_called()
+
+        # It comes back with a query that changed
+        del self.measurements[:]
+        watcher.reconcile()
+        continuous_queries[0]["query"] = \
+            continuous_queries[0]["query"].replace("time(20m)", "time(10m)")
+        self.measurements.append({"name": "test_measurement"})
+        watcher.poll(now=20)
+        self.client.drop_query.assert_called_once_with(
+            "CONTINUOUS QUERY test_measurement_rollup_20m ON test"
+        )
+        self.client.create_query.assert_called_once()
+
+    def test_discover_checks_budget_and_activity(self):
+        client = make_client(
+            measurements=self.measurements,
+            retention_policies=copy.deepcopy(
+                test_main.AggregatorTests.expected_policy_result
+            ),
+            continuous_queries=copy.deepcopy(
+                test_main.AggregatorTests.expected_query_result
+            ),
+            rates={"big": 600000, "test_measurement": 600},
+            cardinality={"big": 50000, "test_measurement": 10}
+        )
+        watcher = self.make_watcher(client)
+        watcher.db_config.update(
+            hibernate_after="30d",
+            cost_budget={"max_points": 100000, "action": "refuse"}
+        )
+        watcher.poll(now=0)
+
+        self.measurements[:0] = [{"name": "big"}, {"name": "idle"}]
+        with self.assertLogs(cost.logger) as logs:
+            watcher.poll(now=10)
+
+        client.create_query.assert_not_called()
+        self.assertIn("Not creating big_rollup_20m", logs.output[0])
+        self.assertEqual(watcher.known, {"big", "idle", "test_measurement"})
+
+    def test_full_reconciliation(self):
+        watcher = self.make_watcher(self.client)
+        watcher.poll(now=0)
+
+        with patch.object(watcher, "reconcile") as reconcile:
+            watcher.poll(now=50)
+            reconcile.assert_not_called()
+            watcher.poll(now=100)
+            reconcile.assert_called_once_with()
+
+    def test_backoff(self):
+        client = make_client()
+        client.query.side_effect = RuntimeError("timeout")
+        watcher = self.make_watcher(client)
+
+        for interval in [20, 40, 80, 80]:
+            watcher.poll(now=0)
+            self.assertEqual(watcher.interval, interval)
+
+        client.query.side_effect = self.client.query.side_effect
+        for interval in [40, 20, 10, 10]:
+            watcher.poll(now=0)
+            self.assertEqual(watcher.interval, interval)
+
+    def test_run_daemon_stops(self):
+        stop = threading.Event()
+
+        with patch("influxdb_aggregation.main.InfluxDBClient",
+                   return_value=self.client):
+            thread = threading.Thread(
+                target=daemon.run_daemon,
+                args=([copy.deepcopy(self.db_config)],),
+                kwargs=dict(stop=stop)
+            )
+            thread.start()
+            stop.set()
+            thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.client.close.assert_called_once_with()
+
+    def test_run_daemon_closes_clients_on_error(self):
+        stop = Mock()
+        stop.is_set.return_value = False
+        stop.wait.side_effect = RuntimeError("interrupted")
+        errors = []
+
+        def run():
+            try:
+                daemon.run_daemon([copy.deepcopy(self.db_config)], stop=stop)
+            except RuntimeError as e:
+                errors.append(e)
+
+        with patch("influxdb_aggregation.main.InfluxDBClient",
+                   return_value=self.client):
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join(5)
+
+        self.assertEqual(len(errors), 1)
+        self.client.close.assert_called_once_with()
@@ -0,0 +1,37 @@
+import unittest
+
+from influxdb_aggregation import durations
+
+
+class DurationTests(unittest.TestCase):
+    def test_parse_duration(self):
+        self.assertEqual(durations.parse_duration("5m"), 5 * durations.MINUTE)
+        self.assertEqual(durations.parse_duration("48h0m0s"),
+                         2 * durations.DAY)
+        self.assertEqual(durations.parse_duration("1h30m"),
+                         90 * durations.MINUTE)
+        self.assertEqual(durations.parse_duration("2w"), 14 * durations.DAY)
+        self.assertEqual(durations.parse_duration("0s"), 0)
+        self.assertEqual(durations.parse_duration("INF"), 0)
+
+    def test_parse_invalid_duration(self):
+        for duration in ["", "5", "m", "5x", "5m 3s", "h5m"]:
+            with self.assertRaises(ValueError):
+                durations.parse_duration(duration)
+
+    def test_format_duration(self):
+        self.assertEqual(durations.format_duration(0), "0s")
+        self.assertEqual(durations.format_duration(2 * durations.WEEK), "2w")
+        self.assertEqual(durations.format_duration(25 * durations.HOUR),
+                         "25h")
+        self.assertEqual(durations.format_duration(90 * durations.SECOND),
+                         "90s")
+
+    def test_format_go_duration(self):
+        self.assertEqual(durations.format_go_duration(0), "0s")
+        self.assertEqual(durations.format_go_duration(2 * durations.DAY),
+                         "48h0m0s")
+        self.assertEqual(durations.format_go_duration(90 * durations.SECOND),
+                         "1m30s")
+        self.assertEqual(durations.format_go_duration(durations.MILLISECOND),
+                         "1ms")
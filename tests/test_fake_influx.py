@@ -0,0 +1,65 @@
+import copy
+import unittest
+
+from influxdb import InfluxDBClient
+from benchmarks import bench_reconcile
+from benchmarks.fake_influx import FakeInfluxServer
+from influxdb_aggregation import main
+from influxdb_aggregation.pool import ClientPool
+from tests import override_config, test_main
+
+
+class FakeInfluxTests(unittest.TestCase):
+    def setUp(self):
+        override_config(self, {"apply": {"rate": None}})
+        self.server = FakeInfluxServer(databases=["test"], measurements=3)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.db_config = dict(
+            copy.deepcopy(test_main.AggregatorTests.db_config),
+            host="127.0.0.1", port=self.server.port
+        )
+
+    def reconcile(self, db_config):
+        with ClientPool(InfluxDBClient) as pool:
+            main.process_database(db_config, pool=pool)
+
+    def test_reconcile(self):
+        self.reconcile(self.db_config)
+
+        state = self.server.state.databases["test"]
+        self.assertEqual(sorted(state["policies"]), ["input", "rollup_20m"])
+        self.assertEqual(len(state["queries"]), 3)
+
+        # Nothing left to apply, only the SHOW requests are sent
+        self.server.reset_counters()
+        self.reconcile(self.db_config)
+        self.assertEqual(self.server.requests, 3)
+
+        self.db_config["desired_policies"][0]["retention"] = "25h"
+        self.reconcile(self.db_config)
+        self.assertEqual(
+            state["policies"]["rollup_20m"]["duration"],
+            25 * 3600 * 10 ** 9
+        )
+
+    def test_retries_injected_errors(self):
+        self.server.error_rate = 1
+        with main.config.override({"apply": {"retries": 0}}), \
+                self.assertRaises(Exception):
+            self.reconcile(self.db_config)
+        self.assertEqual(self.server.errors, 1)
+
+        self.server.error_rate = 0.5
+        with main.config.override({"apply": {"retry_delay": "1ms"}}):
+            self.reconcile(self.db_config)
+        self.assertEqual(len(self.server.state.databases["test"]["queries"]),
+                         3)
+
+    def test_run_scenario(self):
+        result = bench_reconcile.run_scenario(
+            "unchanged", bench_reconcile.unchanged, 10, 0, 0
+        )
+        self.assertEqual(result["requests"], 3)
+        self.assertIsNone(result["error"])
+        self.assertGreater(result["peak_memory"], 0)
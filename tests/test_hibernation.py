@@ -0,0 +1,150 @@
+import asyncio
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+
+from influxdb_aggregation import aio, hibernation, main
+from influxdb_aggregation.cache import StateCache
+from tests import test_main
+from tests.influx_mock import make_async_client, make_client
+
+
+class HibernationTests(unittest.TestCase):
+    def setUp(self):
+        fixtures = test_main.AggregatorTests
+        self.db_config = dict(copy.deepcopy(fixtures.db_config),
+                              hibernate_after="30d")
+        self.measurements = [{"name": "idle"}, {"name": "test_measurement"}]
+        self.continuous_queries = copy.deepcopy(
+            fixtures.expected_query_result
+        ) + [{
+            "name": "idle_rollup_20m",
+            "query": "CREATE CONTINUOUS QUERY idle_rollup_20m ON test "
+                     "BEGIN SELECT mean(value) AS value, "
+                     "max(value) AS max_value, min(value) AS min_value "
+                     "INTO test.rollup_20m.idle FROM test.input.idle "
+                     "GROUP BY *, time(20m) END",
+        }]
+        self.retention_policies = copy.deepcopy(
+            fixtures.expected_policy_result
+        )
+
+    def test_activity_query(self):
+        self.assertEqual(
+            hibernation.activity_query("test", ["cpu", "go-gc"],
+                                       30 * 24 * 3600 * 10 ** 9),
+            'SELECT * FROM test.input.cpu WHERE time > now() - 30d LIMIT 1; '
+            'SELECT * FROM test.input."go-gc" WHERE time > now() - 30d '
+            'LIMIT 1'
+        )
+
+    def test_hibernation_window(self):
+        self.assertEqual(hibernation.hibernation_window({}), 0)
+        self.assertEqual(
+            hibernation.hibernation_window(
+                dict(self.db_config, continuous_query_mode="wildcard")
+            ),
+            0
+        )
+        self.assertEqual(hibernation.hibernation_window(self.db_config),
+                         30 * 24 * 3600 * 10 ** 9)
+
+    def test_active_measurements(self):
+        client = make_client(active={"m1", "m3"})
+        idle = set()
+
+        with main.config.override({"hibernation": {"batch_size": 2}}):
+            active = list(hibernation.active_measurements(
+                client, self.db_config,
+                ["m{}".format(i) for i in range(5)], idle
+            ))
+
+        self.assertEqual(active, ["m1", "m3"])
+        self.assertEqual(idle, {"m0", "m2", "m4"})
+        # A request per batch, a statement per measurement
+        self.assertEqual(client.query.call_count, 3)
+        self.assertEqual(client.select_query.call_count, 5)
+
+    def test_database_handler_hibernation(self):
+        client = make_client(
+            measurements=self.measurements,
+            retention_policies=self.retention_policies,
+            continuous_queries=self.continuous_queries,
+            active={"test_measurement"}
+        )
+
+        main.reconcile_database(client, self.db_config)
+        client.drop_query.assert_called_once_with(
+            "CONTINUOUS QUERY idle_rollup_20m ON test"
+        )
+        client.create_query.assert_not_called()
+
+        # Writes resumed
+        client = make_client(
+            measurements=self.measurements,
+            retention_policies=self.retention_policies,
+            continuous_queries=self.continuous_queries[:1],
+            active={"idle", "test_measurement"}
+        )
+        main.reconcile_database(client, self.db_config)
+        client.create_query.assert_called_once_with(
+            self.continuous_queries[1]["query"][7:]
+        )
+        client.drop_query.assert_not_called()
+
+    def test_state_cache_sees_activity(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = StateCache(os.path.join(directory, "state.json"), 3600)
+        client = make_client(
+            measurements=self.measurements,
+            retention_policies=self.retention_policies,
+            continuous_queries=self.continuous_queries[:1],
+            active={"test_measurement"}
+        )
+        main.reconcile_database(client, self.db_config, cache)
+        client.create_query.assert_not_called()
+        self.assertTrue(cache.entries)
+
+        # Writes resumed within the ttl
+        client = make_client(
+            measurements=self.measurements,
+            retention_policies=self.retention_policies,
+            continuous_queries=self.continuous_queries[:1],
+            active={"idle", "test_measurement"}
+        )
+        main.reconcile_database(client, self.db_config, cache)
+        client.create_query.assert_called_once_with(
+            self.continuous_queries[1]["query"][7:]
+        )
+
+    def test_hibernation_is_not_orphan_collection(self):
+        client = make_client(
+            measurements=self.measurements,
+            retention_policies=self.retention_policies,
+            continuous_queries=self.continuous_queries,
+            active={"test_measurement"}
+        )
+
+        main.reconcile_database(
+            client, dict(self.db_config, orphaned_queries="drop")
+        )
+        client.drop_query.assert_called_once_with(
+            "CONTINUOUS QUERY idle_rollup_20m ON test"
+        )
+
+    def test_async_hibernation(self):
+        client = make_async_client(
+            measurements=self.measurements,
+            retention_policies=self.retention_policies,
+            continuous_queries=self.continuous_queries,
+            active={"test_measurement"}
+        )
+
+        asyncio.run(aio.reconcile_database(client, self.db_config))
+        client.sync.drop_query.assert_called_once_with(
+            "CONTINUOUS QUERY idle_rollup_20m ON test"
+        )
+        client.sync.create_query.assert_not_called()
@@ -0,0 +1,149 @@
+import unittest
+
+from influxdb_aggregation import influxql
+from influxdb_aggregation.main import query_digest
+
+# Pairs of a query as rendered by the templates and as returned by
+# SHOW CONTINUOUS QUERIES after influx stored it
+SERVER_REWRITES = [
+    (
+        "CREATE CONTINUOUS QUERY cpu_rollup_1h ON test BEGIN "
+        "SELECT mean(value) AS value, max(value) AS max_value, "
+        "min(value) AS min_value INTO test.rollup_1h.cpu "
+        "FROM test.input.cpu GROUP BY *, time(1h) END",
+        'CREATE CONTINUOUS QUERY cpu_rollup_1h ON test BEGIN '
+        'SELECT mean(value) AS value, max(value) AS max_value, '
+        'min(value) AS min_value INTO test.rollup_1h.cpu '
+        'FROM test.input.cpu GROUP BY time(1h), * END',
+    ),
+    (
+        "CREATE CONTINUOUS QUERY cpu_rollup_1d ON test BEGIN "
+        "SELECT mean(value) AS value INTO test.rollup_1d.cpu "
+        "FROM test.input.cpu GROUP BY *, time(24h) END",
+        'CREATE CONTINUOUS QUERY cpu_rollup_1d ON test BEGIN '
+        'SELECT mean(value) AS value INTO test.rollup_1d.cpu '
+        'FROM test.input.cpu GROUP BY time(1d), * END',
+    ),
+    (
+        "CREATE CONTINUOUS QUERY select_rollup_1h ON test BEGIN "
+        "SELECT mean(value) AS value INTO test.rollup_1h.\"select\" "
+        "FROM test.input.\"select\" GROUP BY *, time(1h) END",
+        'CREATE CONTINUOUS QUERY select_rollup_1h ON test BEGIN '
+        'SELECT mean(value) AS value INTO test.rollup_1h."select" '
+        'FROM test.input."select" GROUP BY time(1h), * END',
+    ),
+    (
+        "CREATE CONTINUOUS QUERY \"go-gc_rollup_1h\" ON \"test\" BEGIN "
+        "SELECT mean(\"value\") AS \"value\" "
+        "INTO \"test\".\"rollup_1h\".\"go-gc\" "
+        "FROM \"test\".\"input\".\"go-gc\" GROUP BY *, time(1h) END",
+        'CREATE CONTINUOUS QUERY "go-gc_rollup_1h" ON test BEGIN '
+        'SELECT mean(value) AS value INTO test.rollup_1h."go-gc" '
+        'FROM test.input."go-gc" GROUP BY time(1h), * END',
+    ),
+    (
+        "CREATE CONTINUOUS QUERY cpu_rollup_1h ON test "
+        "RESAMPLE EVERY 20m FOR 80m BEGIN "
+        "SELECT sum(sum_value) / sum(count_value) AS value "
+        "INTO test.rollup_1h.cpu FROM test.rollup_20m.cpu "
+        "GROUP BY *, time(1h, 90s) END",
+        'CREATE CONTINUOUS QUERY cpu_rollup_1h ON test '
+        'RESAMPLE EVERY 20m FOR 1h20m BEGIN '
+        'SELECT sum(sum_value) / sum(count_value) AS value '
+        'INTO test.rollup_1h.cpu FROM test.rollup_20m.cpu '
+        'GROUP BY time(1h, 1m30s), * END',
+    ),
+    (
+        "CREATE CONTINUOUS QUERY rollup_1h_wildcard_0 ON test BEGIN "
+        "SELECT mean(value) AS value "
+        "INTO test.rollup_1h.:MEASUREMENT FROM test.input./^[a-m]/ "
+        "GROUP BY *, time(1h) END",
+        'CREATE CONTINUOUS QUERY rollup_1h_wildcard_0 ON test BEGIN '
+        'SELECT mean(value) AS value '
+        'INTO test.rollup_1h.:MEASUREMENT FROM test.input./^[a-m]/ '
+        'GROUP BY time(1h), * END',
+    ),
+    (
+        "CREATE CONTINUOUS QUERY cpu_rollup_1h ON test BEGIN "
+        "SELECT mean(value) AS value INTO test.rollup_1h.cpu "
+        "FROM test.input.cpu GROUP BY *, time(1h) fill(none) END",
+        'CREATE CONTINUOUS QUERY cpu_rollup_1h ON test BEGIN '
+        'SELECT mean(value) AS value INTO test.rollup_1h.cpu '
+        'FROM test.input.cpu GROUP BY time(1h), * fill(none) END',
+    ),
+    (
+        "CREATE CONTINUOUS QUERY cpu_rollup_1h ON test BEGIN "
+        "SELECT mean(value) AS value INTO test.rollup_1h.cpu "
+        "FROM test.input.cpu GROUP BY host, time(1h) fill(0) END",
+        'CREATE CONTINUOUS QUERY cpu_rollup_1h ON test BEGIN '
+        'SELECT mean(value) AS value INTO test.rollup_1h.cpu '
+        'FROM test.input.cpu GROUP BY time(1h), host fill(0) END',
+    ),
+    (
+        "CREATE CONTINUOUS QUERY cpu_rollup_1h ON test BEGIN "
+        "SELECT mean(value) AS value INTO test.rollup_1h.cpu "
+        "FROM test.input.cpu GROUP BY *, time(1h) fill(null) END",
+        'CREATE CONTINUOUS QUERY cpu_rollup_1h ON test BEGIN '
+        'SELECT mean(value) AS value INTO test.rollup_1h.cpu '
+        'FROM test.input.cpu GROUP BY time(1h), * END',
+    ),
+    (
+        "create continuous query cpu_rollup_1h on test begin\n"
+        "    select MEAN(value) as value into test.rollup_1h.cpu\n"
+        "    from test.input.cpu group by *, time(60m)\n"
+        "end",
+        'CREATE CONTINUOUS QUERY cpu_rollup_1h ON test BEGIN '
+        'SELECT mean(value) AS value INTO test.rollup_1h.cpu '
+        'FROM test.input.cpu GROUP BY time(1h), * END',
+    ),
+]
+
+
+class InfluxQLTests(unittest.TestCase):
+    def test_tokenize(self):
+        self.assertEqual(
+            influxql.tokenize('select "my value" from /a\\/b/ group by '
+                              'time(1h30m)'),
+            [
+                influxql.Token(influxql.KEYWORD, "SELECT"),
+                influxql.Token(influxql.IDENTIFIER, "my value"),
+                influxql.Token(influxql.KEYWORD, "FROM"),
+                influxql.Token(influxql.REGEX, "/a\\/b/"),
+                influxql.Token(influxql.KEYWORD, "GROUP"),
+                influxql.Token(influxql.KEYWORD, "BY"),
+                influxql.Token(influxql.IDENTIFIER, "time"),
+                influxql.Token(influxql.PUNCTUATION, "("),
+                influxql.Token(influxql.DURATION, 90 * 60 * 10 ** 9),
+                influxql.Token(influxql.PUNCTUATION, ")"),
+            ]
+        )
+
+    def test_quote_identifier(self):
+        self.assertEqual(influxql.quote_identifier("cpu"), "cpu")
+        self.assertEqual(influxql.quote_identifier("go-gc"), '"go-gc"')
+        self.assertEqual(influxql.quote_identifier("select"), '"select"')
+        self.assertEqual(influxql.quote_identifier('a"b'), '"a\\"b"')
+
+    def test_division_is_not_regex(self):
+        self.assertEqual(
+            influxql.canonical_query("SELECT sum(a)/sum(b) FROM m"),
+            "SELECT sum ( a ) / sum ( b ) FROM m"
+        )
+
+    def test_server_rewrites(self):
+        for rendered, stored in SERVER_REWRITES:
+            self.assertEqual(influxql.canonical_query(rendered),
+                             influxql.canonical_query(stored))
+            self.assertEqual(query_digest(rendered), query_digest(stored))
+
+    def test_differences_remain(self):
+        rendered, stored = SERVER_REWRITES[0]
+        for changed in [
+            stored.replace("time(1h)", "time(2h)"),
+            stored.replace("max(value)", "max(other)"),
+            stored.replace("rollup_1h.cpu", "rollup_1h.Cpu"),
+            stored.replace("time(1h), *", "time(1h), host"),
+            stored.replace("time(1h), *", "time(1h), * fill(none)"),
+        ]:
+            self.assertNotEqual(influxql.canonical_query(rendered),
+                                influxql.canonical_query(changed))
@@ -1,10 +1,15 @@
 import copy
 import json
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
 from mock import patch
 
 from influxdb_aggregation import main
+from influxdb_aggregation.cache import StateCache
 from tests.influx_mock import make_client
 
 
@@ -33,14 +38,14 @@ class AggregatorTests(unittest.TestCase):
         {
             "name": "input",
             "duration": "2h0m0s",
-            "shardGroupDuration": "1h0m0s",
+            "shardGroupDuration": "4h0m0s",
             "replicaN": 1,
             "default": True
         },
         {
             "name": "rollup_20m",
             "duration": "24h0m0s",
-            "shardGroupDuration": "4h",
+            "shardGroupDuration": "4h0m0s",
             "replicaN": 1,
             "default": False
         }
@@ -49,14 +54,14 @@ class AggregatorTests(unittest.TestCase):
         "input": {
             "name": "input",
             "duration": "2h0m0s",
-            "shardGroupDuration": "1h0m0s",
+            "shardGroupDuration": "4h0m0s",
             "replicaN": 1,
             "default": True
         },
         "rollup_20m": {
             "name": "rollup_20m",
             "duration": "24h0m0s",
-            "shardGroupDuration": "4h",
+            "shardGroupDuration": "4h0m0s",
             "replicaN": 1,
             "default": False
         }
@@ -85,18 +90,13 @@ class AggregatorTests(unittest.TestCase):
         'rollup_20m': {
             'create': 'CREATE RETENTION POLICY rollup_20m ON test '
                       'DURATION 24h0m0s REPLICATION 1 SHARD DURATION 4h',
-            'update': 'ALTER RETENTION POLICY rollup_20m ON test DURATION '
-                      '24h0m0s REPLICATION 1 SHARD DURATION 4h',
             'rollup': '20m', 'retention': '24h0m0s', 'replication': 1,
             'shard_duration': '4h'}, 'input': {
             'create': 'CREATE RETENTION POLICY rollup_20m ON test '
                       'DURATION 2h0m0s REPLICATION 1 SHARD DURATION 4h '
                       'DEFAULT',
-            'update': 'ALTER RETENTION POLICY rollup_20m ON test '
-                      'DURATION 2h0m0s REPLICATION 1 SHARD DURATION 4h '
-                      'DEFAULT',
-            'rollup': '20m', 'retention': '2h0m0s', 'replication': 1,
-            'shard_duration': '4h'}
+            'default': True, 'rollup': '20m', 'retention': '2h0m0s',
+            'replication': 1, 'shard_duration': '4h'}
     }
     expected_query_info = {
         "test_measurement_rollup_20m": {
@@ -172,20 +172,61 @@ class AggregatorTests(unittest.TestCase):
         self.client.alter_query.assert_not_called()
         self.client.drop_query.assert_not_called()
 
+    def test_database_handler_batches_statements(self):
+        config = copy.deepcopy(self.db_config)
+        config["desired_policies"].append({
+            "rollup": "2m",
+            "retention": "24h0m0s",
+            "replication": 1,
+            "shard_duration": "4h"
+        })
+        main.process_database(config)
+
+        # Three SHOW queries and a single request for both statements
+        self.assertEqual(self.client.query.call_count, 4)
+        self.assertEqual(self.client.create_query.call_count, 2)
+
     def test_database_handler_update_policy(self):
         config = copy.deepcopy(self.db_config)
         config["desired_policies"][0]["retention"] = "25h0m0s"
 
         main.process_database(config)
 
-        self.client.alter_query.assert_any_call(
-            "RETENTION POLICY rollup_20m ON test DURATION 25h0m0s "
-            "REPLICATION 1 SHARD DURATION 4h"
+        self.client.alter_query.assert_called_once_with(
+            "RETENTION POLICY rollup_20m ON test DURATION 25h0m0s"
         )
         self.client.other_query.assert_not_called()
         self.client.create_query.assert_not_called()
         self.client.drop_query.assert_not_called()
 
+    def test_policy_changes(self):
+        current = self.expected_policies["rollup_20m"]
+        desired = dict(self.db_config["desired_policies"][0],
+                       retention="1d")
+        self.assertEqual(main.policy_changes(current, desired), [])
+
+        desired.update(replication=2, shard_duration="1d", default=True)
+        self.assertEqual(
+            main.policy_changes(current, desired),
+            ["REPLICATION 2", "SHARD DURATION 24h0m0s", "DEFAULT"]
+        )
+
+        # Influx chooses the shard duration
+        desired = dict(desired, shard_duration="0s", retention="INF",
+                       replication=1, default=False)
+        self.assertEqual(main.policy_changes(current, desired),
+                         ["DURATION 0s"])
+
+    def test_database_handler_update_default_policy(self):
+        config = copy.deepcopy(self.db_config)
+        config["default_policy"]["shard_duration"] = "1h"
+
+        main.process_database(config)
+
+        self.client.alter_query.assert_called_once_with(
+            "RETENTION POLICY input ON test SHARD DURATION 1h0m0s"
+        )
+
     def test_database_handler_delete_policy(self):
         config = copy.deepcopy(self.db_config)
         config["desired_policies"].pop()
@@ -223,3 +264,328 @@ class AggregatorTests(unittest.TestCase):
         )
         self.client.other_query.assert_not_called()
         self.client.alter_query.assert_not_called()
+
+    def test_journal_not_used_when_planning_from_state(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        continuous_queries = copy.deepcopy(self.expected_query_result)
+        continuous_queries[0]["query"] = "CREATE CONTINUOUS QUERY Needs update"
+        create = self.expected_queries["test_measurement_rollup_20m"]
+
+        def run(errors):
+            self.client = make_client(
+                measurements=copy.deepcopy(self.measurements),
+                retention_policies=copy.deepcopy(self.expected_policy_result),
+                continuous_queries=continuous_queries,
+                errors=errors
+            )
+            self.patched_client.return_value = self.client
+            with main.config.override({
+                "configs": [self.db_config],
+                "apply": {"journal": os.path.join(directory, "journal.json"),
+                          "retries": 0}
+            }), self.assertLogs(main.logger):
+                return main.main(["--state-cache", ""])
+
+        # The drop is applied, the create fails
+        self.assertEqual(run({create: "boom"}), 1)
+        self.client.drop_query.assert_called_once()
+
+        # The re-plan still has the drop, the query was not dropped
+        self.assertEqual(run({}), 0)
+        self.client.drop_query.assert_called_once_with(
+            "CONTINUOUS QUERY test_measurement_rollup_20m ON test"
+        )
+        self.client.create_query.assert_called_once_with(create[7:])
+
+    def test_database_handler_orphaned_queries(self):
+        continuous_queries = copy.deepcopy(self.expected_query_result)
+        for name in ["gone_rollup_20m", "test_measurement_rollup_1h",
+                     "manual"]:
+            continuous_queries.append({
+                "name": name,
+                "query": "CREATE CONTINUOUS QUERY {} ...".format(name)
+            })
+        self.client = make_client(
+            measurements=copy.deepcopy(self.measurements),
+            retention_policies=copy.deepcopy(self.expected_policy_result),
+            continuous_queries=continuous_queries
+        )
+        self.patched_client.return_value = self.client
+
+        main.process_database(copy.deepcopy(self.db_config))
+        self.client.drop_query.assert_not_called()
+
+        config = dict(copy.deepcopy(self.db_config), orphaned_queries="report")
+        with self.assertLogs(main.logger, "WARNING") as logs:
+            main.process_database(config)
+        self.assertEqual(len(logs.output), 2)
+        self.client.drop_query.assert_not_called()
+
+        config = dict(config, orphaned_queries="drop", max_orphan_drops=1)
+        main.process_database(config)
+        self.client.drop_query.assert_called_once_with(
+            "CONTINUOUS QUERY gone_rollup_20m ON test"
+        )
+
+        self.client.drop_query.reset_mock()
+        config["max_orphan_drops"] = 100
+        main.process_database(config)
+        self.client.drop_query.assert_any_call(
+            "CONTINUOUS QUERY gone_rollup_20m ON test"
+        )
+        self.client.drop_query.assert_any_call(
+            "CONTINUOUS QUERY test_measurement_rollup_1h ON test"
+        )
+        self.assertEqual(self.client.drop_query.call_count, 2)
+        self.client.create_query.assert_not_called()
+
+    def test_process_databases(self):
+        configs = [copy.deepcopy(self.db_config) for _ in range(3)]
+        configs[1]["database"] = "other"
+        configs[2]["host"] = "other_host"
+
+        results = main.process_databases(configs, workers=2,
+                                         workers_per_host=1)
+
+        self.assertEqual(
+            [(r.host, r.database) for r in results],
+            [("test_host", "test"), ("test_host", "other"),
+             ("other_host", "test")]
+        )
+        self.assertTrue(all(r.error is None for r in results))
+        # One shared client per host:port
+        self.assertEqual(self.patched_client.call_count, 2)
+        self.patched_client.assert_any_call(
+            host="test_host", port=0, pool_size=10
+        )
+        self.client.query.assert_any_call(
+            "SHOW CONTINUOUS QUERIES", database="other"
+        )
+        self.assertEqual(self.client.close.call_count, 2)
+
+    def test_process_databases_isolates_errors(self):
+        failing = make_client()
+        failing.query.side_effect = RuntimeError("connection refused")
+        self.patched_client.side_effect = [failing, self.client]
+
+        configs = [copy.deepcopy(self.db_config) for _ in range(2)]
+        configs[1]["host"] = "other_host"
+
+        results = main.process_databases(configs)
+
+        self.assertIsInstance(results[0].error, RuntimeError)
+        self.assertIsNone(results[1].error)
+
+    def test_run_isolated_host_does_not_block_others(self):
+        configs = [copy.deepcopy(self.db_config) for _ in range(3)]
+        configs[1]["database"] = "other"
+        configs[2]["host"] = "other_host"
+        other_host_ran = threading.Event()
+
+        def handler(db_config):
+            if db_config["host"] == "other_host":
+                other_host_ran.set()
+            # The second database of test_host waits for its host, the
+            # database of other_host must not wait behind it
+            elif not other_host_ran.wait(5):
+                raise RuntimeError("other_host waited for test_host")
+
+        results = main.run_isolated(configs, handler, workers=2,
+                                    workers_per_host=1)
+
+        self.assertEqual(
+            [(r.host, r.database, r.error) for r in results],
+            [("test_host", "test", None), ("test_host", "other", None),
+             ("other_host", "test", None)]
+        )
+
+    def test_data_chained_rollups(self):
+        config = copy.deepcopy(self.db_config)
+        config["chained_rollups"] = True
+        config["desired_policies"].insert(0, {
+            "rollup": "1h",
+            "retention": "48h0m0s",
+            "replication": 1,
+            "shard_duration": "4h"
+        })
+
+        query_info = main.get_database_state(self.client, config)[3]
+
+        self.assertIn(
+            "FROM test.input.test_measurement",
+            query_info["test_measurement_rollup_20m"]["query"]
+        )
+        self.assertIn(
+            "FROM test.rollup_20m.test_measurement",
+            query_info["test_measurement_rollup_1h"]["query"]
+        )
+
+    def test_database_handler_stagger(self):
+        config = copy.deepcopy(self.db_config)
+        config["stagger"] = True
+
+        main.process_database(config)
+
+        self.client.drop_query.assert_called_once_with(
+            "CONTINUOUS QUERY test_measurement_rollup_20m ON test"
+        )
+        created = self.client.create_query.call_args[0][0]
+        self.assertRegex(created, r"GROUP BY \*, time\(20m, \d+[sm]\) END$")
+
+    def test_database_handler_wildcard(self):
+        config = copy.deepcopy(self.db_config)
+        config["continuous_query_mode"] = "wildcard"
+        config["wildcard_partitions"] = ["^[a-m]", "^[^a-m]"]
+
+        main.process_database(config)
+
+        self.client.create_query.assert_any_call(
+            "CONTINUOUS QUERY rollup_20m_wildcard_0 ON test BEGIN "
+            "SELECT mean(value) AS value, max(value) AS max_value, "
+            "min(value) AS min_value INTO test.rollup_20m.:MEASUREMENT "
+            "FROM test.input./^[a-m]/ GROUP BY *, time(20m) END"
+        )
+        self.assertEqual(self.client.create_query.call_count, 2)
+        self.client.drop_query.assert_called_once_with(
+            "CONTINUOUS QUERY test_measurement_rollup_20m ON test"
+        )
+        self.client.alter_query.assert_not_called()
+
+    def test_database_handler_wildcard_to_measurement(self):
+        self.client = make_client(
+            measurements=copy.deepcopy(self.measurements),
+            retention_policies=copy.deepcopy(self.expected_policy_result),
+            continuous_queries=[{
+                "name": "rollup_20m_wildcard_0",
+                "query": "CREATE CONTINUOUS QUERY rollup_20m_wildcard_0 ..."
+            }]
+        )
+        self.patched_client.return_value = self.client
+
+        main.process_database(copy.deepcopy(self.db_config))
+
+        self.client.create_query.assert_called_once_with(
+            "CONTINUOUS QUERY test_measurement_rollup_20m ON test "
+            "BEGIN SELECT mean(value) AS value, max(value) AS max_value, "
+            "min(value) AS min_value INTO test.rollup_20m.test_measurement "
+            "FROM test.input.test_measurement GROUP BY *, time(20m) END"
+        )
+        self.client.drop_query.assert_called_once_with(
+            "CONTINUOUS QUERY rollup_20m_wildcard_0 ON test"
+        )
+        # The replacement is created before the old query is dropped
+        self.assertEqual(
+            [c[0] for c in self.client.method_calls
+             if c[0] in ("create_query", "drop_query")],
+            ["create_query", "drop_query"]
+        )
+
+    def test_iter_measurements(self):
+        client = make_client(measurements=[
+            {"name": "a"}, {"name": "b"}, {"name": "c"},
+            {"name": "b"}, {"name": "d"}
+        ])
+
+        self.assertEqual(
+            list(main.iter_measurements(client, 2)), ["a", "b", "c", "d"]
+        )
+        # Every page starts with the last measurement of the previous one
+        self.assertEqual(
+            [c[0][0] for c in client.query.call_args_list],
+            ["SHOW MEASUREMENTS LIMIT 2 OFFSET {}".format(offset)
+             for offset in range(5)]
+        )
+
+    def test_orphans_kept_when_measurements_shift(self):
+        measurements = [{"name": "a"}, {"name": "b"},
+                        {"name": "test_measurement"}, {"name": "x"},
+                        {"name": "z"}]
+        continuous_queries = copy.deepcopy(self.expected_query_result)
+        client = make_client(
+            measurements=measurements,
+            retention_policies=copy.deepcopy(self.expected_policy_result),
+            continuous_queries=continuous_queries
+        )
+        make_query = client.query.side_effect
+
+        def query(q, *args, **kwargs):
+            result = make_query(q, *args, **kwargs)
+            # Deletions after the first page move test_measurement into
+            # the page already read
+            if q == "SHOW MEASUREMENTS LIMIT 2 OFFSET 0":
+                del measurements[:2]
+            return result
+
+        client.query.side_effect = query
+        config = dict(copy.deepcopy(self.db_config), orphaned_queries="drop")
+
+        with main.config.override({"measurement_page_size": 2}), \
+                self.assertLogs(main.logger, "WARNING") as logs:
+            statements = list(main.stream_database_plan(client, config))
+
+        # test_measurement was not listed, its query looks orphaned
+        self.assertEqual(
+            [s.query for s in statements if s.query.startswith("DROP ")], []
+        )
+        self.assertEqual(logs.output, [
+            "WARNING:influxdb_aggregation.main:Measurements changed while "
+            "reading them at 1",
+            "WARNING:influxdb_aggregation.main:Measurements of test changed "
+            "while reading them, not dropping orphaned queries",
+            "WARNING:influxdb_aggregation.main:Orphaned query "
+            "test_measurement_rollup_20m on test",
+        ])
+
+    def test_stream_database_plan(self):
+        measurements = [{"name": "m{}".format(i)} for i in range(5)]
+        continuous_queries = copy.deepcopy(self.expected_query_result)
+        continuous_queries[0]["query"] = "CREATE CONTINUOUS QUERY Outdated"
+        self.client = make_client(
+            measurements=measurements,
+            retention_policies=copy.deepcopy(self.expected_policy_result),
+            continuous_queries=continuous_queries + [{
+                "name": "rollup_20m_wildcard_0",
+                "query": "CREATE CONTINUOUS QUERY rollup_20m_wildcard_0 ..."
+            }]
+        )
+        config = copy.deepcopy(self.db_config)
+        config["desired_policies"].append({
+            "rollup": "2m",
+            "retention": "24h0m0s",
+            "replication": 1,
+            "shard_duration": "4h"
+        })
+        measurements.append({"name": "test_measurement"})
+
+        with main.config.override({"measurement_page_size": 2}):
+            streamed = list(main.stream_database_plan(self.client, config))
+            planned = main.plan_database(
+                config, main.get_database_state(self.client, config)
+            )
+
+        self.assertEqual(sorted(streamed), sorted(planned))
+        self.assertEqual(
+            [s.phase for s in streamed][-1], main.QUERY_RETIRE
+        )
+        self.assertEqual(len(streamed), 1 + 11 + 2 + 1)
+
+    def test_database_handler_state_cache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = StateCache(os.path.join(directory, "state.json"), 60)
+
+        main.process_database(copy.deepcopy(self.db_config), cache)
+        self.assertTrue(cache.entries)
+        self.client.query.reset_mock()
+
+        main.process_database(copy.deepcopy(self.db_config), cache)
+        # Only the fingerprint queries
+        self.assertEqual(self.client.query.call_count, 3)
+
+        config = copy.deepcopy(self.db_config)
+        config["desired_policies"][0]["retention"] = "25h0m0s"
+        main.process_database(config, cache)
+        self.client.alter_query.assert_called_once_with(
+            "RETENTION POLICY rollup_20m ON test DURATION 25h0m0s"
+        )
@@ -0,0 +1,160 @@
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+from urllib.request import urlopen
+
+from mock import patch
+
+from influxdb_aggregation import main, metrics
+from tests import test_main
+from tests.influx_mock import make_client
+
+
+def phase_seconds(phase):
+    histogram = metrics.registry.histograms['phase_seconds'][
+        (('phase', phase),)
+    ]
+    return histogram['sum']
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        metrics.registry.clear()
+        self.addCleanup(metrics.registry.clear)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        fixtures = test_main.AggregatorTests
+        self.db_config = copy.deepcopy(fixtures.db_config)
+        self.db_config["desired_policies"].append({
+            "rollup": "2m",
+            "retention": "24h0m0s",
+            "replication": 1,
+            "shard_duration": "4h"
+        })
+        self.client = make_client(
+            measurements=copy.deepcopy(fixtures.measurements),
+            retention_policies=copy.deepcopy(
+                fixtures.expected_policy_result
+            ),
+            continuous_queries=copy.deepcopy(fixtures.expected_query_result)
+        )
+
+    def test_render(self):
+        registry = metrics.Registry()
+        registry.inc("runs_total", help="Runs", result="ok")
+        registry.inc("runs_total", 2, result="ok")
+        registry.set_gauge("last", 1.5)
+        registry.observe("seconds", 0.2, phase='say "hi"')
+
+        lines = registry.render().splitlines()
+        self.assertEqual(lines[:3], [
+            "# HELP influx_aggregation_runs_total Runs",
+            "# TYPE influx_aggregation_runs_total counter",
+            'influx_aggregation_runs_total{result="ok"} 3',
+        ])
+        self.assertIn("influx_aggregation_last 1.5", lines)
+        self.assertIn('influx_aggregation_seconds_bucket'
+                      '{phase="say \\"hi\\"",le="0.1"} 0', lines)
+        self.assertIn('influx_aggregation_seconds_bucket'
+                      '{phase="say \\"hi\\"",le="0.25"} 1', lines)
+        self.assertIn('influx_aggregation_seconds_bucket'
+                      '{phase="say \\"hi\\"",le="+Inf"} 1', lines)
+        self.assertIn('influx_aggregation_seconds_count'
+                      '{phase="say \\"hi\\""} 1', lines)
+
+    @patch("influxdb_aggregation.metrics.time.time")
+    def test_nested_phases(self, clock):
+        clock.side_effect = [0, 1, 2, 4, 5, 6, 7, 10]
+
+        def items():
+            with metrics.span("inner"):
+                pass
+            yield 1
+
+        with metrics.span("outer"):
+            for _ in metrics.timed(items(), "produce", count="items_total"):
+                pass
+
+        # Each phase without the phases nested in it
+        self.assertEqual(phase_seconds("inner"), 2)
+        self.assertEqual(phase_seconds("produce"), 3)
+        self.assertEqual(phase_seconds("outer"), 5)
+        self.assertEqual(metrics.registry.value("items_total"), 1)
+
+    def test_span_counts_errors(self):
+        with self.assertRaises(ValueError):
+            with metrics.span("broken"):
+                raise ValueError()
+        self.assertEqual(
+            metrics.registry.value("phase_errors_total", phase="broken"), 1
+        )
+
+    def test_statement_type(self):
+        self.assertEqual(metrics.statement_type("SHOW MEASUREMENTS LIMIT 1"),
+                         "show_measurements")
+        self.assertEqual(
+            metrics.statement_type("ALTER RETENTION POLICY p ON db"),
+            "alter_policy"
+        )
+        self.assertEqual(
+            metrics.statement_type("drop continuous query q on db"),
+            "drop_query"
+        )
+        self.assertEqual(
+            metrics.statement_type("SELECT * INTO a FROM b"), "select_into"
+        )
+        self.assertEqual(metrics.statement_type("GRANT ALL TO x"), "other")
+
+    def test_reconcile_database(self):
+        main.reconcile_database(self.client, self.db_config)
+
+        value = metrics.registry.value
+        self.assertEqual(value("measurements_total"), 1)
+        self.assertEqual(value("queries_created_total"), 1)
+        self.assertEqual(
+            value("statements_applied_total", type="create_policy"), 1
+        )
+        self.assertEqual(
+            value("statements_applied_total", type="create_query"), 1
+        )
+        self.assertEqual(value("request_seconds", type="show_policies"), 1)
+        self.assertEqual(value("request_seconds", type="create_policy"), 1)
+        for phase in ["read_state", "read_measurements", "render", "apply",
+                      "plan", "report"]:
+            self.assertEqual(value("phase_seconds", phase=phase), 1, phase)
+
+    def test_main_writes_metrics_and_profile(self):
+        path = os.path.join(self.directory, "aggregation.prom")
+        profile = os.path.join(self.directory, "run.prof")
+        memory = os.path.join(self.directory, "memory.txt")
+
+        with patch("influxdb_aggregation.main.InfluxDBClient",
+                   return_value=self.client), \
+                main.config.override({"configs": [self.db_config]}):
+            code = main.main(["--state-cache", "", "--metrics-file", path,
+                              "--profile", profile, "--trace-memory",
+                              memory])
+
+        self.assertEqual(code, 0)
+        with open(path) as textfile:
+            text = textfile.read()
+        self.assertIn('influx_aggregation_databases_total{result="ok"} 1',
+                      text)
+        self.assertIn("influx_aggregation_last_run_success 1", text)
+        self.assertTrue(os.path.getsize(profile))
+        with open(memory) as report:
+            self.assertTrue(report.readline().startswith("Peak: "))
+
+    def test_serve_metrics(self):
+        metrics.inc("polls_total", result="ok")
+        server = metrics.serve_metrics(0, "127.0.0.1")
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        response = urlopen("http://127.0.0.1:{}/metrics".format(
+            server.server_port
+        ))
+        self.assertIn(b'influx_aggregation_polls_total{result="ok"} 1',
+                      response.read())
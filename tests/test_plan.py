@@ -0,0 +1,166 @@
+import copy
+import functools
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+from mock import Mock, patch
+
+from influxdb_aggregation import main, plan
+from influxdb_aggregation.pool import ClientPool
+from tests import test_main
+from tests.influx_mock import make_client
+
+
+class PlanTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        fixtures = test_main.AggregatorTests
+        self.db_config = copy.deepcopy(fixtures.db_config)
+        self.db_config["desired_policies"].append({
+            "rollup": "2m",
+            "retention": "24h0m0s",
+            "replication": 1,
+            "shard_duration": "4h"
+        })
+        self.client = make_client(
+            measurements=copy.deepcopy(fixtures.measurements),
+            retention_policies=copy.deepcopy(
+                fixtures.expected_policy_result
+            ),
+            continuous_queries=copy.deepcopy(fixtures.expected_query_result)
+        )
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def snapshots(self):
+        snapshot = plan.snapshot_database(self.client, self.db_config)
+        return {plan.database_key(self.db_config): snapshot}
+
+    def test_compile_plan_from_saved_snapshot(self):
+        plan.save_snapshot(self.path("snapshot.json"), self.snapshots())
+        snapshots = plan.load_snapshot(self.path("snapshot.json"))
+
+        statements = plan.compile_plan(
+            self.db_config, snapshots["test_host:0/test"]
+        )
+        self.assertEqual(
+            statements,
+            list(main.stream_database_plan(self.client, self.db_config))
+        )
+        self.assertEqual(len(statements), 2)
+        # Only SHOW statements were sent
+        self.client.create_query.assert_not_called()
+
+    def test_load_snapshot_checks_version(self):
+        plan.export_json(self.path("plan.json"), {"version": 0})
+        with self.assertRaises(ValueError):
+            plan.load_snapshot(self.path("plan.json"))
+
+    def test_compile_plans(self):
+        snapshots = self.snapshots()
+        other = dict(self.db_config, database="other")
+
+        with self.assertLogs(plan.logger, "ERROR"):
+            compiled = plan.compile_plans([self.db_config, other], snapshots)
+        self.assertEqual(len(compiled["databases"]), 1)
+
+        snapshots["test_host:0/other"] = dict(
+            snapshots["test_host:0/test"], database="other"
+        )
+        parallel = plan.compile_plans(
+            [self.db_config, other], snapshots, workers=2
+        )
+        self.assertEqual(parallel["databases"][0], compiled["databases"][0])
+        self.assertEqual(parallel["databases"][1]["database"], "other")
+
+    def test_compile_plans_in_spawned_processes(self):
+        snapshots = self.snapshots()
+        other = dict(self.db_config, database="other")
+        snapshots["test_host:0/other"] = dict(
+            snapshots["test_host:0/test"], database="other"
+        )
+        spawn = functools.partial(
+            ProcessPoolExecutor,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+
+        # Spawned workers do not inherit the configuration of this process
+        with main.config.override({
+            "query_name_template": "{measurement}_spawned_{rollup}"
+        }), patch.object(plan, "ProcessPoolExecutor", spawn):
+            compiled = plan.compile_plans(
+                [self.db_config, other], snapshots, workers=2
+            )
+
+        self.assertIn(
+            "CREATE CONTINUOUS QUERY test_measurement_spawned_2m ON other",
+            compiled["databases"][1]["statements"][-1]["query"]
+        )
+
+    def test_render_iql(self):
+        self.assertEqual(
+            plan.render_iql([{
+                "host": "h", "port": 1, "database": "test",
+                "statements": [{
+                    "phase": 2,
+                    "query": "CREATE CONTINUOUS QUERY q ON test\n"
+                             "BEGIN\n  SELECT 1\nEND",
+                    "description": "Creating query q"
+                }]
+            }]),
+            "# DDL\n# h:1/test\n# Creating query q\n"
+            "CREATE CONTINUOUS QUERY q ON test BEGIN SELECT 1 END\n"
+        )
+
+    def test_export_iql_per_server(self):
+        compiled = plan.compile_plans([self.db_config], self.snapshots())
+        compiled["databases"].append(
+            dict(compiled["databases"][0], host="other_host")
+        )
+
+        paths = plan.export_plans(self.path("plan.iql"), compiled)
+        self.assertEqual(paths, [self.path("plan.other_host_0.iql"),
+                                 self.path("plan.test_host_0.iql")])
+        with open(paths[1]) as script:
+            lines = script.read().splitlines()
+        self.assertEqual(lines[:2], ["# DDL", "# test_host:0/test"])
+        self.assertEqual(
+            lines[3],
+            "CREATE RETENTION POLICY rollup_2m ON test DURATION 24h0m0s "
+            "REPLICATION 1 SHARD DURATION 4h"
+        )
+
+    def test_apply_exported_plan(self):
+        compiled = plan.compile_plans([self.db_config], self.snapshots())
+        plan.export_plans(self.path("plan.json"), compiled)
+
+        with ClientPool(Mock(return_value=self.client)) as pool:
+            results = plan.apply_plan(
+                plan.load_plan(self.path("plan.json")), pool
+            )
+
+        self.assertIsNone(results[0].error)
+        self.assertEqual(self.client.create_query.call_count, 2)
+
+    def test_main_from_snapshot(self):
+        plan.save_snapshot(self.path("snapshot.json"), self.snapshots())
+
+        with main.config.override({"configs": [self.db_config]}):
+            code = main.main([
+                "--from-snapshot", self.path("snapshot.json"),
+                "--export", self.path("plan.json")
+            ])
+
+        self.assertEqual(code, 0)
+        databases = plan.load_plan(self.path("plan.json"))
+        self.assertEqual(
+            [s["description"] for s in databases[0]["statements"]],
+            ["Creating rollup_2m", "Creating query "
+             "test_measurement_rollup_2m"]
+        )
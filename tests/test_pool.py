@@ -0,0 +1,31 @@
+import unittest
+
+from mock import Mock
+
+from influxdb_aggregation.pool import ClientPool
+
+
+class ClientPoolTests(unittest.TestCase):
+    def test_shares_clients_per_host(self):
+        factory = Mock(side_effect=lambda **kwargs: Mock())
+
+        with ClientPool(factory, pool_size=4) as pool:
+            first = pool.client({"host": "a", "port": 1, "database": "x"})
+            second = pool.client({"host": "a", "port": 1, "database": "y"})
+            other = pool.client({"host": "b", "port": 1, "database": "x"})
+
+            self.assertIs(first.client, second.client)
+            self.assertIsNot(first.client, other.client)
+            factory.assert_any_call(host="a", port=1, pool_size=4)
+
+            second.query("SHOW MEASUREMENTS")
+            second.client.query.assert_called_once_with(
+                "SHOW MEASUREMENTS", database="y"
+            )
+
+            second.close()
+            second.client.close.assert_not_called()
+
+        first.client.close.assert_called_once_with()
+        other.client.close.assert_called_once_with()
+        self.assertEqual(pool.clients, {})
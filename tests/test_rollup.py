@@ -0,0 +1,172 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from influxdb_aggregation import main, rollup
+from influxdb_aggregation.durations import MINUTE, SECOND
+from tests import override_config
+
+
+def read_points(path):
+    """
+    :return: Dictionary of point lines by retention policy
+    """
+    points = {}
+    policy = None
+    with open(path) as lines:
+        for line in lines:
+            line = line.rstrip('\n')
+            if line.startswith('# CONTEXT-RETENTION-POLICY: '):
+                policy = line.split(': ')[1]
+            elif policy and not line.startswith('#'):
+                points.setdefault(policy, set()).add(line)
+    return points
+
+
+@unittest.skipIf(rollup.np is None, "numpy is not installed")
+class RollupTests(unittest.TestCase):
+    db_config = {
+        "database": "prometheus",
+        "desired_policies": [
+            {"rollup": "5m", "retention": "1d", "replication": 1,
+             "shard_duration": "1h"},
+            {"rollup": "1h", "retention": "1w", "replication": 1,
+             "shard_duration": "1d"},
+        ],
+    }
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.input = os.path.join(self.directory, "export.lp")
+        self.output = os.path.join(self.directory, "rollup.lp")
+        override_config(self, {"rollup": {"chunk_size": 7,
+                                          "partitions": 3}})
+
+    def write(self, lines):
+        with open(self.input, "w") as export:
+            export.write("\n".join(lines) + "\n")
+
+    def test_parse_line(self):
+        self.assertEqual(
+            rollup.parse_line("cpu,host=a value=1.5,other=2 10"),
+            ("cpu,host=a", 1.5, 10)
+        )
+        self.assertEqual(
+            rollup.parse_line('disk\\ io,path=/a\\ b note="x y",value=3i 20'),
+            ("disk\\ io,path=/a\\ b", 3.0, 20)
+        )
+        self.assertIsNone(rollup.parse_line('cpu value="high" 10'))
+        self.assertIsNone(rollup.parse_line("cpu value=true 10"))
+        self.assertIsNone(rollup.parse_line("cpu value=1"))
+        with self.assertRaises(ValueError):
+            rollup.parse_line("cpu")
+
+    def test_parse_series(self):
+        self.assertEqual(
+            rollup.parse_series("net\\,io,z=1,a\\ b=2"),
+            ("net,io", "net\\,io", [("a b", "a\\ b=2"), ("z", "z=1")])
+        )
+
+    def test_matches_reference(self):
+        generator = random.Random(4)
+        series = ["cpu,host=a", "cpu,host=b", "mem,host=a,region=x"]
+        lines = ["# DDL", "CREATE DATABASE prometheus", "# DML",
+                 "# CONTEXT-DATABASE: prometheus",
+                 "# CONTEXT-RETENTION-POLICY: input"]
+        points = []
+        for _ in range(200):
+            key = generator.choice(series)
+            # Sums of quarters are exact in any order
+            value = generator.randrange(-40, 40) / 4.0
+            timestamp = generator.randrange(0, 3 * 3600) * SECOND
+            points.append((key, value, timestamp))
+            lines.append("{} value={} {}".format(key, value, timestamp))
+        # Other policies of the export are not read
+        lines += ["# CONTEXT-RETENTION-POLICY: rollup_5m",
+                  "cpu,host=a value=1000 0"]
+        self.write(lines)
+
+        result = rollup.rollup_file(self.db_config, self.input, self.output)
+
+        expected = {}
+        for name, interval in [("rollup_5m", 5 * MINUTE),
+                               ("rollup_1h", 60 * MINUTE)]:
+            groups = {}
+            for key, value, timestamp in points:
+                start = timestamp - timestamp % interval
+                groups.setdefault((key, start), []).append(value)
+            expected[name] = {
+                "{} {} {}".format(key, rollup.format_fields(
+                    sum(values) / len(values), max(values), min(values)
+                ), start)
+                for (key, start), values in groups.items()
+            }
+        self.assertEqual(read_points(self.output), expected)
+        self.assertEqual(result["points"], 200)
+        self.assertEqual(result["skipped"], 2)
+        self.assertEqual(result["written"], {
+            name: len(lines) for name, lines in expected.items()
+        })
+        with open(self.output) as output:
+            self.assertIn("CREATE RETENTION POLICY rollup_5m ON prometheus",
+                          output.read())
+
+    def test_tags_chain_and_stagger(self):
+        db_config = dict(
+            self.db_config, chained_rollups=True, stagger=True,
+            stagger_window="1m",
+            desired_policies=[
+                dict(self.db_config["desired_policies"][0],
+                     drop_tags=["host"]),
+                self.db_config["desired_policies"][1],
+            ]
+        )
+        offset = main.stagger_offset(
+            db_config, db_config["desired_policies"][0], "cpu"
+        )
+        self.write([
+            "cpu,host=a,region=x value=1 {}".format(offset),
+            "cpu,host=b,region=x value=3 {}".format(offset + 4 * MINUTE),
+            "cpu,host=b,region=x value=5 {}".format(offset - 1),
+        ])
+
+        rollup.rollup_file(db_config, self.input, self.output)
+
+        # The chained hourly rollup keeps the tags of the 5m rollup
+        self.assertEqual(read_points(self.output), {
+            "rollup_5m": {
+                "cpu,region=x value=2.0,max_value=3.0,min_value=1.0,"
+                "sum_value=4.0,count_value=2i {}".format(offset),
+                "cpu,region=x value=5.0,max_value=5.0,min_value=5.0,"
+                "sum_value=5.0,count_value=1i {}".format(
+                    offset - 5 * MINUTE
+                ),
+            },
+            "rollup_1h": {
+                "cpu,region=x value=2.0,max_value=3.0,min_value=1.0,"
+                "sum_value=4.0,count_value=2i {}".format(offset),
+                "cpu,region=x value=5.0,max_value=5.0,min_value=5.0,"
+                "sum_value=5.0,count_value=1i {}".format(
+                    offset - 60 * MINUTE
+                ),
+            },
+        })
+
+    def test_main(self):
+        self.write(["cpu value=1 0", "cpu value=3 60"])
+
+        with main.config.override({"configs": [self.db_config]}):
+            code = main.main(["--rollup", self.input, "--precision", "s",
+                              "--state-cache", ""])
+
+        self.assertEqual(code, 0)
+        self.assertEqual(
+            read_points(os.path.join(self.directory, "export.rollup.lp")),
+            {
+                "rollup_5m": {"cpu value=2.0,max_value=3.0,min_value=1.0 0"},
+                "rollup_1h": {"cpu value=2.0,max_value=3.0,min_value=1.0 0"},
+            }
+        )
@@ -0,0 +1,153 @@
+import asyncio
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+
+from influxdb_aggregation import aio, main, tags
+from influxdb_aggregation.cache import StateCache
+from tests import test_main
+from tests.influx_mock import make_async_client, make_client
+
+
+class TagsTests(unittest.TestCase):
+    def setUp(self):
+        fixtures = test_main.AggregatorTests
+        self.db_config = copy.deepcopy(fixtures.db_config)
+        self.db_config["desired_policies"][0]["drop_tags"] = ["host"]
+        self.client_kwargs = dict(
+            measurements=copy.deepcopy(fixtures.measurements),
+            retention_policies=copy.deepcopy(
+                fixtures.expected_policy_result
+            ),
+            continuous_queries=copy.deepcopy(fixtures.expected_query_result),
+            tag_keys={"test_measurement": ["host", "region"]},
+            show={"SERIES FROM test.input.test_measurement": [
+                {"key": "test_measurement,host=a,region=eu"},
+                {"key": "test_measurement,host=b,region=eu"},
+                {"key": "test_measurement,host=c,region=us"},
+                {"key": "test_measurement,host=d,region=us"},
+            ]}
+        )
+
+    def test_resolve_tags(self):
+        self.assertIsNone(tags.resolve_tags(["a", "b"], {}))
+        self.assertEqual(
+            tags.resolve_tags(["c", "b", "a"], {"keep_tags": ["a", "c", "x"]}),
+            ["a", "c"]
+        )
+        self.assertEqual(
+            tags.resolve_tags(["a", "b"], {"drop_tags": ["b"]}), ["a"]
+        )
+        self.assertEqual(
+            tags.resolve_tags(["a", "b"],
+                              {"keep_tags": ["a"], "drop_tags": ["a"]}),
+            []
+        )
+
+    def test_policy_tags(self):
+        self.assertEqual(
+            tags.policy_tags({"keep_tags": ["b", "a"]}, None), ["a", "b"]
+        )
+        # Dropping tags needs the tags of the measurement
+        self.assertIsNone(tags.policy_tags({"drop_tags": ["a"]}, None))
+        self.assertEqual(
+            tags.policy_tags({"drop_tags": ["a"]}, ["a", "b"]), ["b"]
+        )
+
+    def test_group_by_clause(self):
+        self.assertEqual(tags.group_by_clause(None), "*")
+        self.assertEqual(tags.group_by_clause([]), tags.NO_TAGS)
+        self.assertEqual(tags.group_by_clause(["host", "data-center"]),
+                         'host, "data-center"')
+
+    def test_parse_series_key(self):
+        self.assertEqual(
+            tags.parse_series_key(r"cpu,host=a\,b,region\ name=eu\=west"),
+            {"host": "a,b", "region name": "eu=west"}
+        )
+        self.assertEqual(tags.parse_series_key("cpu"), {})
+
+    def test_chained_rollups_use_source_tags(self):
+        self.db_config["desired_policies"] = [
+            {"rollup": "20m", "retention": "1d", "keep_tags": ["host"]},
+            {"rollup": "1h", "retention": "1w", "drop_tags": ["host"]},
+        ]
+        self.db_config["chained_rollups"] = True
+        info = dict(main.iter_query_info(
+            self.db_config, ["m"], {"m": ["host", "region"]}
+        ))
+        self.assertEqual(info["m_rollup_20m"]["tags"], ["host"])
+        self.assertIn("GROUP BY host, time(20m)",
+                      info["m_rollup_20m"]["query"])
+        self.assertEqual(info["m_rollup_1h"]["tags"], [])
+        self.assertIn("GROUP BY /^$/, time(1h)", info["m_rollup_1h"]["query"])
+
+    def test_database_handler_drop_tags(self):
+        client = make_client(**self.client_kwargs)
+
+        with self.assertLogs(tags.logger) as logs:
+            main.reconcile_database(client, self.db_config)
+
+        client.drop_query.assert_called_once_with(
+            "CONTINUOUS QUERY test_measurement_rollup_20m ON test"
+        )
+        client.create_query.assert_called_once()
+        self.assertIn("GROUP BY region, time(20m)",
+                      client.create_query.call_args[0][0])
+        self.assertEqual(logs.output, [
+            "INFO:influxdb_aggregation.tags:test_measurement_rollup_20m "
+            "writes 2 series for 4 input series (50% less)"
+        ])
+
+    def test_report_cardinality_pages_series(self):
+        client = make_client(**self.client_kwargs)
+        created = [("test_measurement_rollup_20m",
+                    {"measurement": "test_measurement",
+                     "tags": ["region"]})]
+
+        with main.config.override({"measurement_page_size": 3}), \
+                self.assertLogs(tags.logger) as logs:
+            tags.report_cardinality(client, self.db_config, created)
+
+        self.assertEqual(
+            [call[0][0] for call in client.query.call_args_list],
+            ["SHOW SERIES FROM test.input.test_measurement LIMIT 3 OFFSET 0",
+             "SHOW SERIES FROM test.input.test_measurement LIMIT 3 OFFSET 3"]
+        )
+        self.assertEqual(logs.output, [
+            "INFO:influxdb_aggregation.tags:test_measurement_rollup_20m "
+            "writes 2 series for 4 input series (50% less)"
+        ])
+
+    def test_state_cache_sees_tag_keys(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = StateCache(os.path.join(directory, "state.json"), 3600)
+        client = make_client(**self.client_kwargs)
+        main.reconcile_database(client, self.db_config)
+        kwargs = dict(self.client_kwargs, continuous_queries=[{
+            "name": "test_measurement_rollup_20m",
+            "query": "CREATE " + client.create_query.call_args[0][0]
+        }])
+
+        client = make_client(**kwargs)
+        main.reconcile_database(client, self.db_config, cache)
+        client.create_query.assert_not_called()
+        self.assertTrue(cache.entries)
+
+        # A tag key added within the ttl
+        kwargs["tag_keys"] = {"test_measurement": ["host", "region", "zone"]}
+        client = make_client(**kwargs)
+        main.reconcile_database(client, self.db_config, cache)
+        self.assertIn("GROUP BY region, zone, time(20m)",
+                      client.create_query.call_args[0][0])
+
+    def test_async_drop_tags(self):
+        client = make_async_client(**self.client_kwargs)
+
+        asyncio.run(aio.reconcile_database(client, self.db_config))
+        client.sync.create_query.assert_called_once()
+        self.assertIn("GROUP BY region, time(20m)",
+                      client.sync.create_query.call_args[0][0])
@@ -1,6 +1,6 @@
 import unittest
 
-from influxdb_aggregation import templating
+from influxdb_aggregation import durations, templating
 
 
 class TemplatingTests(unittest.TestCase):
@@ -45,12 +45,21 @@ class TemplatingTests(unittest.TestCase):
 
     def test_policy_update_query(self):
         expected = "ALTER RETENTION POLICY rollup_20m ON test_database " \
-                   "DURATION 24h0m0s REPLICATION 1 SHARD DURATION 4h"
+                   "DURATION 24h0m0s SHARD DURATION 4h0m0s"
 
         self.assertEqual(
-            templating.policy_update_query(self.policy, self.database),
+            templating.policy_update_query(
+                self.policy, self.database,
+                ["DURATION 24h0m0s", "SHARD DURATION 4h0m0s"]
+            ),
             expected
         )
+        self.assertEqual(
+            templating.policy_update_query(
+                self.policy, self.database, ["DEFAULT"], name="input"
+            ),
+            "ALTER RETENTION POLICY input ON test_database DEFAULT"
+        )
 
     def test_continuous_query_name(self):
         expected = "test_measurement_rollup_20m"
@@ -87,3 +96,187 @@ class TemplatingTests(unittest.TestCase):
             ),
             expected
         )
+
+    def test_wildcard_query_create(self):
+        expected = "CREATE CONTINUOUS QUERY rollup_20m_wildcard_0 " \
+                   "ON test_database BEGIN SELECT mean(value) AS value, " \
+                   "max(value) AS max_value, min(value) AS min_value " \
+                   "INTO test_database.rollup_20m.:MEASUREMENT " \
+                   "FROM test_database.input./^[a-m]/ " \
+                   "GROUP BY *, time(20m) END"
+
+        self.assertEqual(
+            templating.wildcard_query_create(
+                self.policy, 0, "^[a-m]", self.database
+            ),
+            expected
+        )
+
+    def test_continuous_query_pattern(self):
+        pattern = templating.continuous_query_pattern(self.policy)
+
+        match = pattern.match("test_measurement_rollup_20m")
+        self.assertEqual(match.group("measurement"), "test_measurement")
+        self.assertIsNone(pattern.match("test_measurement_rollup_2m"))
+        self.assertIsNone(pattern.match("rollup_20m_wildcard_0"))
+
+    def test_wildcard_query_pattern(self):
+        pattern = templating.wildcard_query_pattern(self.policy)
+
+        self.assertEqual(
+            pattern.match("rollup_20m_wildcard_3").group("partition"), "3"
+        )
+        self.assertIsNone(pattern.match("test_measurement_rollup_20m"))
+
+    def test_owned_queries(self):
+        policies = [{"rollup": "20m"}]
+        names = ["test_measurement_rollup_20m", "rollup_1h_wildcard_0",
+                 "my_rollup_measurement_rollup_1d", "manual",
+                 "test_measurement_downsample", "my_rollup_name",
+                 "rollup_1h_wildcard_00", "rollup_1h_wildcard_x"]
+
+        self.assertEqual(
+            list(templating.owned_queries(policies, names)),
+            ["test_measurement_rollup_20m", "rollup_1h_wildcard_0",
+             "my_rollup_measurement_rollup_1d"]
+        )
+
+    def test_sort_policies(self):
+        policies = [{"rollup": "1d"}, {"rollup": "5m"}, {"rollup": "1h"}]
+
+        self.assertEqual(
+            [p["rollup"] for p in templating.sort_policies(policies)],
+            ["5m", "1h", "1d"]
+        )
+
+    def test_chain_policies(self):
+        policies = [{"rollup": "1d"}, {"rollup": "5m"}, {"rollup": "1h"}]
+
+        self.assertEqual(
+            [(p["rollup"], s.get("rollup"))
+             for p, s in templating.chain_policies(policies)],
+            [("5m", None), ("1h", "5m"), ("1d", "1h")]
+        )
+
+        with self.assertRaises(ValueError):
+            templating.chain_policies([{"rollup": "7m"}, {"rollup": "1h"}])
+
+    def test_chained_continuous_query_create(self):
+        expected = "CREATE CONTINUOUS QUERY test_measurement_rollup_1h " \
+                   "ON test_database RESAMPLE EVERY 20m FOR 80m BEGIN " \
+                   "SELECT sum(sum_value) / sum(count_value) AS value, " \
+                   "max(max_value) AS max_value, " \
+                   "min(min_value) AS min_value, " \
+                   "sum(sum_value) AS sum_value, " \
+                   "sum(count_value) AS count_value " \
+                   "INTO test_database.rollup_1h.test_measurement " \
+                   "FROM test_database.rollup_20m.test_measurement " \
+                   "GROUP BY *, time(1h) END"
+
+        self.assertEqual(
+            templating.continuous_query_create(
+                dict(self.policy, rollup="1h"), self.measurement,
+                self.database, self.policy
+            ),
+            expected
+        )
+
+    def test_chained_input_continuous_query_query(self):
+        expected = "SELECT mean(value) AS value, max(value) AS max_value, " \
+                   "min(value) AS min_value, sum(value) AS sum_value, " \
+                   "count(value) AS count_value " \
+                   "INTO test_database.rollup_20m.test_measurement " \
+                   "FROM test_database.input.test_measurement " \
+                   "GROUP BY *, time(20m)"
+
+        self.assertEqual(
+            templating.continuous_query_query(
+                self.policy, self.measurement, self.database, {}
+            ),
+            expected
+        )
+
+    def test_stagger_offset(self):
+        offset = templating.stagger_offset(self.policy, self.measurement)
+        self.assertEqual(
+            offset, templating.stagger_offset(self.policy, self.measurement)
+        )
+        self.assertEqual(offset % durations.SECOND, 0)
+        self.assertLess(offset, 20 * durations.MINUTE)
+
+        offset = templating.stagger_offset(
+            self.policy, self.measurement, "1m"
+        )
+        self.assertLess(offset, durations.MINUTE)
+
+        offsets = set(
+            templating.stagger_offset(self.policy, "m{}".format(i))
+            for i in range(100)
+        )
+        self.assertGreater(len(offsets), 90)
+
+    def test_stagger_offset_chained(self):
+        coarse = dict(self.policy, rollup="1h")
+        for measurement in ["a", "b", "c", self.measurement]:
+            self.assertEqual(
+                templating.stagger_offset(coarse, measurement) %
+                (20 * durations.MINUTE),
+                templating.stagger_offset(self.policy, measurement)
+            )
+
+    def test_continuous_query_query_offset(self):
+        self.assertTrue(
+            templating.continuous_query_query(
+                self.policy, self.measurement, self.database,
+                offset=90 * durations.SECOND
+            ).endswith("GROUP BY *, time(20m, 90s)")
+        )
+
+    def test_template_render(self):
+        text = """
+        CREATE  {name} ON {database} {resample}
+        BEGIN {query} END
+        """
+        template = templating.Template(text)
+        for values in [
+            dict(name="a", database="db", resample="", query="q"),
+            dict(name="a", database="db", resample="RESAMPLE EVERY 1h",
+                 query="SELECT  *\n FROM x"),
+            dict(name=" a", database="d b", resample=" ", query=""),
+        ]:
+            self.assertEqual(
+                template.render(**values),
+                templating.strip_query(text.format(**values))
+            )
+
+    def test_template_bind(self):
+        text = "SELECT {value!r} INTO {{x}}.{policy} GROUP BY time({rollup})"
+        bound = templating.Template(text).bind(policy="p", rollup="5m")
+
+        self.assertEqual(
+            bound.text, "SELECT {value!r} INTO {{x}}.p GROUP BY time(5m)"
+        )
+        self.assertEqual(
+            bound.render(value="v"), "SELECT 'v' INTO {x}.p GROUP BY time(5m)"
+        )
+
+    def test_template_cache(self):
+        self.assertIs(
+            templating.template('continuous_query_template'),
+            templating.template('continuous_query_template')
+        )
+        self.assertIs(
+            templating.bound_template('query_name_template', self.policy),
+            templating.bound_template('query_name_template', self.policy)
+        )
+
+    def test_template_bind_nested(self):
+        inner = templating.Template("SELECT {field}\n FROM {measurement}")
+        outer = templating.Template("CREATE {name} BEGIN {query} END")
+
+        bound = outer.bind(name="q", query=inner.bind(field="value"))
+
+        self.assertEqual(
+            bound.render(measurement="m"),
+            "CREATE q BEGIN SELECT value FROM m END"
+        )
@@ -0,0 +1,151 @@
+import copy
+import random
+import re
+import unittest
+
+from influxdb.resultset import ResultSet
+from mock import Mock
+
+from influxdb_aggregation import cost, main, verify
+from influxdb_aggregation.durations import MINUTE
+from tests import test_main
+from tests.influx_mock import make_client
+
+SELECT = ("SELECT mean(value) AS value, max(value) AS max_value "
+          "INTO test.rollup_20m.cpu FROM test.input.cpu "
+          "GROUP BY *, time(20m)")
+RANGE = re.compile(r'time >= (\d+) AND time < (\d+)')
+
+
+def result_set(points):
+    """
+    :param points: List of (measurement, tags, time, value) tuples
+    :return: ResultSet with a series per measurement and tags
+    """
+    series = {}
+    for name, tags, time, value in points:
+        series.setdefault((name, tuple(sorted(tags.items()))), []).append(
+            [time, value, value]
+        )
+    return ResultSet({"series": [
+        dict(name=name, tags=dict(tags), values=values,
+             columns=["time", "value", "max_value"])
+        for (name, tags), values in sorted(series.items())
+    ]})
+
+
+class VerifyTests(unittest.TestCase):
+    def test_queries(self):
+        self.assertEqual(
+            verify.expected_query(SELECT, 0, 10),
+            "SELECT mean(value) AS value, max(value) AS max_value "
+            "FROM test.input.cpu WHERE time >= 0 AND time < 10 "
+            "GROUP BY *, time(20m)"
+        )
+        self.assertEqual(
+            verify.rollup_query(SELECT, 0, 10),
+            "SELECT * FROM test.rollup_20m.cpu "
+            "WHERE time >= 0 AND time < 10 GROUP BY *"
+        )
+        self.assertEqual(
+            verify.rollup_query(
+                SELECT.replace("rollup_20m.cpu", "rollup_20m.:MEASUREMENT"),
+                0, 10, pattern="^c"
+            ),
+            "SELECT * FROM test.rollup_20m./^c/ "
+            "WHERE time >= 0 AND time < 10 GROUP BY *"
+        )
+
+    def test_sample_windows(self):
+        windows = verify.sample_windows(
+            interval=10, offset=3, oldest=5, newest=100, samples=20,
+            intervals=2, generator=random.Random(1)
+        )
+        # Every whole window from 13 to 93
+        self.assertEqual(windows, [(start, start + 20)
+                                   for start in range(13, 74, 10)])
+        self.assertEqual(
+            len(verify.sample_windows(10, 3, 5, 100, 3, 2, random.Random())),
+            3
+        )
+        self.assertEqual(
+            verify.sample_windows(10, 0, 5, 20, 3, 2, random.Random()), []
+        )
+
+    def test_compare_points(self):
+        expected = result_set([
+            ("cpu", {"host": "a"}, 0, 1.0),
+            ("cpu", {"host": "a"}, 10, 2.0),
+            ("cpu", {"host": "b"}, 0, 3.0),
+            # An interval without input
+            ("cpu", {"host": "b"}, 10, None),
+        ])
+        actual = result_set([
+            ("cpu", {"host": "a"}, 0, 1.0 + 1e-12),
+            ("cpu", {"host": "b"}, 0, 4.0),
+            ("cpu", {"host": "c"}, 0, 1.0),
+        ])
+
+        self.assertEqual(verify.compare_points(expected, actual),
+                         (3, 1, 1, 1))
+
+    def test_verify_and_repair(self):
+        fixtures = test_main.AggregatorTests
+        db_config = copy.deepcopy(fixtures.db_config)
+        client = make_client(measurements=copy.deepcopy(fixtures.measurements))
+        repaired = []
+
+        def query(q, *args, **kwargs):
+            if not q.startswith("SELECT") or "; " not in q:
+                return make_query(q, *args, **kwargs)
+            start, end = (int(t) for t in RANGE.search(q).groups())
+            points = [("test_measurement", {"host": "a"}, time, 1.0)
+                      for time in range(start, end, 20 * MINUTE)]
+            # The first window is not written until it is repaired
+            written = points[1:] if not repaired else points
+            return [result_set(points), result_set(written)]
+
+        make_query = client.query.side_effect
+        client.query.side_effect = query
+        client.select_query.side_effect = repaired.append
+        pool = Mock()
+        pool.client.return_value = client
+
+        with main.config.override({
+            "verify": {"samples": 2, "intervals": 1},
+            "backfill": {"checkpoint": None, "pause": "0s"}
+        }):
+            self.assertEqual(verify.run([db_config], pool, seed=1), 1)
+            self.assertEqual(repaired, [])
+            self.assertEqual(verify.run([db_config], pool, fix=True, seed=1),
+                             0)
+
+        self.assertEqual(len(repaired), 2)
+        self.assertTrue(all(
+            q.startswith("SELECT mean(value) AS value") and
+            " INTO test.rollup_20m.test_measurement " in q
+            for q in repaired
+        ))
+        self.assertEqual(verify.run([db_config], pool, seed=1), 0)
+
+    def test_plan_windows_skips_refused_queries(self):
+        db_config = copy.deepcopy(test_main.AggregatorTests.db_config)
+        db_config["cost_budget"] = {"max_points": 100000,
+                                    "action": "refuse"}
+        client = make_client(
+            measurements=[{"name": "big"}, {"name": "test_measurement"}],
+            rates={"big": 600000, "test_measurement": 600},
+            cardinality={"big": 50000, "test_measurement": 10}
+        )
+
+        with main.config.override({
+            "verify": {"samples": 2, "intervals": 1, "recent_intervals": 1},
+            "cost": {"report": 0}
+        }), self.assertLogs(cost.logger):
+            windows = verify.plan_windows(client, db_config,
+                                          now=1000 * 20 * MINUTE,
+                                          generator=random.Random(1))
+
+        self.assertEqual(len(windows), 2)
+        self.assertEqual(set(window.name for window in windows),
+                         {"test_measurement_rollup_20m"})